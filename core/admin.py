@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund
+from django.http import StreamingHttpResponse
+
+from . import exports
+from .models import Item, OrderItem, Order, Address, Payment, PaymentJob, Coupon, Refund
 
 
 def make_refun_accepted(modeladmin, request, queryset):
@@ -9,9 +12,31 @@ def make_refun_accepted(modeladmin, request, queryset):
 make_refun_accepted.short_description = 'update orders to refund granted'
 
 
+def export_response(queryset, format):
+    export, content_type = exports.EXPORTS[format]
+    response = StreamingHttpResponse(
+        export(exports.orders_between(orders=queryset)), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="orders.{format}"'
+    return response
+
+
+def export_orders_csv(modeladmin, request, queryset):
+    return export_response(queryset, 'csv')
+
+
+export_orders_csv.short_description = 'export placed orders as CSV'
+
+
+def export_orders_json(modeladmin, request, queryset):
+    return export_response(queryset, 'json')
+
+
+export_orders_json.short_description = 'export placed orders as JSON'
+
+
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ['user', 'billing_address', 'shipping_address', 'payment', 'coupon', 'ordered', 'being_delivered',
-                    'received', 'refund_requested', 'refund_granted']
+    list_display = ['user', 'billing_address', 'shipping_address', 'payment', 'coupon', 'total', 'ordered',
+                    'being_delivered', 'received', 'refund_requested', 'refund_granted']
     list_display_links = [
         'user', 'billing_address', 'shipping_address', 'payment', 'coupon'
     ]
@@ -21,10 +46,21 @@ class OrderAdmin(admin.ModelAdmin):
         'user__username',
         'ref_code'
     ]
+    # narrows the exports to a date range
+    date_hierarchy = 'ordered_date'
     actions = [
-        make_refun_accepted
+        make_refun_accepted,
+        export_orders_csv,
+        export_orders_json,
     ]
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_totals()
+
+    def total(self, obj):
+        return obj.total
+    total.admin_order_field = 'total'
+
 
 class AddressAdmin(admin.ModelAdmin):
     list_display = [
@@ -50,10 +86,23 @@ class AddressAdmin(admin.ModelAdmin):
     ]
 
 
+class CouponAdmin(admin.ModelAdmin):
+    list_display = ['code', 'amount', 'valid_from', 'valid_until', 'uses',
+                    'max_uses', 'max_uses_per_user']
+    readonly_fields = ['uses']
+    search_fields = ['code']
+
+
+class PaymentJobAdmin(admin.ModelAdmin):
+    list_display = ['order', 'user', 'amount', 'status', 'attempts', 'error', 'created', 'updated']
+    list_filter = ['status']
+
+
 admin.site.register(Item)
 admin.site.register(OrderItem)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Payment)
-admin.site.register(Coupon)
+admin.site.register(PaymentJob, PaymentJobAdmin)
+admin.site.register(Coupon, CouponAdmin)
 admin.site.register(Refund)
@@ -0,0 +1,214 @@
+import json
+from collections import Counter
+from decimal import Decimal
+
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views.generic import View
+
+from . import services
+from .coupons import CouponError
+from .facets import facet_summary
+from .models import Item, Order
+from .session_cart import CartFull, SessionCart
+from .views import HomeView, SearchView, filter_query
+
+# more than anyone buys at once, and well inside the column's range
+MAX_QUANTITY = 1000
+
+
+def item_json(item):
+    return {
+        'id': item.pk,
+        'title': item.title,
+        'slug': item.slug,
+        'price': item.price,
+        'discount_price': item.discount_price,
+        'effective_price': item.effective_price,
+        'catagory': item.catagory,
+        'label': item.label,
+        'url': item.get_absolute_url(),
+        'image': item.image.url if item.image else None,
+    }
+
+
+class ItemListView(HomeView):
+    """JSON version of the home page listing, with the same cursors."""
+
+    def get(self, request, *args, **kwargs):
+        self.cursor = self.get_cursor()
+        self.filters = self.get_filters()
+        page = self.get_paginator(
+            self.get_queryset(), self.paginate_by).page(**self.cursor)
+        url = reverse('core:api-items') + '?'
+        query = filter_query(self.filters)
+        if query:
+            url += query + '&'
+        return JsonResponse({
+            'items': [item_json(item) for item in page],
+            'facets': {
+                facet: [{'name': name, 'count': count, **params}
+                        for params, name, count in entries]
+                for facet, entries in facet_summary().items()
+            },
+            'previous': f'{url}before={page.before}' if page.has_previous else None,
+            'next': f'{url}after={page.after}' if page.has_next else None,
+        })
+
+
+class ItemSearchView(SearchView):
+    def get(self, *args, **kwargs):
+        items, has_next = self.search()
+        url = reverse('core:api-search') + '?'
+        return JsonResponse({
+            'items': [item_json(item) for item in items],
+            'previous': url + self.page_query(self.page - 1) if self.page > 1 else None,
+            'next': url + self.page_query(self.page + 1) if has_next else None,
+        })
+
+
+def line_json(line):
+    return {
+        'item': item_json(line.item),
+        'quantity': line.quantity,
+        'final_price': line.get_final_price(),
+        'amount_saved': line.get_amount_save(),
+    }
+
+
+def cart_json(request):
+    if request.user.is_authenticated:
+        order = Order.objects.with_totals().with_cart_items().filter(
+            user=request.user, ordered=False).first()
+        lines = list(order.items.all()) if order else []
+        coupon = order.coupon if order else None
+        total = order.get_total_price() if order else Decimal('0.00')
+    else:
+        cart = SessionCart(request.session)
+        lines = cart.lines()
+        coupon = None
+        total = cart.get_total_price()
+    return {
+        'lines': [line_json(line) for line in lines],
+        'coupon': {'code': coupon.code, 'amount': coupon.amount} if coupon else None,
+        'total': total,
+        # the nav badge
+        'count': len(lines),
+    }
+
+
+def json_error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+class JSONBodyMixin:
+    def get_json(self):
+        """The request body as a dict, or None if it isn't a JSON object."""
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+class CartView(View):
+    """The cart as JSON, for updating the page in place."""
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(cart_json(request))
+
+
+class CartLineView(JSONBodyMixin, View):
+    """PATCH {"quantity": n} sets a line's quantity (0 removes it), DELETE
+    removes it. Both answer with the updated cart.
+    """
+
+    def patch(self, request, *args, **kwargs):
+        item = get_object_or_404(Item, slug=kwargs['slug'])
+        quantity = (self.get_json() or {}).get('quantity')
+        if type(quantity) is not int or not 0 <= quantity <= MAX_QUANTITY:
+            return json_error(f"quantity must be a whole number from 0 to {MAX_QUANTITY}")
+        try:
+            if request.user.is_authenticated:
+                services.set_quantity(request.user, item, quantity)
+            else:
+                SessionCart(request.session).set_quantity(item, quantity)
+        except services.CartLocked as e:
+            return json_error(e.message, status=409)
+        except CartFull as e:
+            return json_error(e.message)
+        return JsonResponse(cart_json(request))
+
+    def delete(self, request, *args, **kwargs):
+        item = get_object_or_404(Item, slug=kwargs['slug'])
+        try:
+            if request.user.is_authenticated:
+                services.remove_from_cart(request.user, item)
+            else:
+                SessionCart(request.session).remove(item)
+        except services.CartLocked as e:
+            return json_error(e.message, status=409)
+        return JsonResponse(cart_json(request))
+
+
+class CartCouponView(JSONBodyMixin, View):
+    """POST {"code": "..."} applies a coupon to the cart."""
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return json_error("Log in to use a coupon", status=403)
+        code = (self.get_json() or {}).get('code')
+        if not isinstance(code, str) or not code:
+            return json_error("code is required")
+        try:
+            coupon = services.apply_coupon(request.user, code)
+        except CouponError as e:
+            return json_error(e.message)
+        except services.CartLocked as e:
+            return json_error(e.message, status=409)
+        if coupon is None:
+            return json_error("This is not a valid coupon", status=404)
+        return JsonResponse(cart_json(request))
+
+
+class CartBatchView(JSONBodyMixin, View):
+    """POST {"lines": [{"slug": "...", "quantity": n}, ...]} adds every line
+    to the cart at once. Nothing is added unless every line is valid.
+    """
+
+    max_lines = 500
+
+    def post(self, request, *args, **kwargs):
+        lines = (self.get_json() or {}).get('lines')
+        if not isinstance(lines, list) or not lines:
+            return json_error("lines must be a list of {slug, quantity}")
+        if len(lines) > self.max_lines:
+            return json_error(f"at most {self.max_lines} lines at a time")
+        wanted = Counter()
+        for line in lines:
+            if not isinstance(line, dict):
+                return json_error("lines must be a list of {slug, quantity}")
+            slug, quantity = line.get('slug'), line.get('quantity', 1)
+            if not isinstance(slug, str) or type(quantity) is not int or quantity < 1:
+                return json_error("each line needs a slug and a quantity of 1 or more")
+            wanted[slug] += quantity
+            if wanted[slug] > MAX_QUANTITY:
+                return json_error(f"at most {MAX_QUANTITY} of an item at a time")
+
+        pks = dict(Item.objects.filter(slug__in=wanted).values_list('slug', 'pk'))
+        unknown = sorted(set(wanted) - set(pks))
+        if unknown:
+            return JsonResponse({'error': "unknown items", 'slugs': unknown}, status=400)
+
+        quantities = {pks[slug]: quantity for slug, quantity in wanted.items()}
+        try:
+            if request.user.is_authenticated:
+                services.bulk_add_to_cart(request.user, quantities)
+            else:
+                SessionCart(request.session).bulk_add(quantities)
+        except services.CartLocked as e:
+            return json_error(e.message, status=409)
+        except CartFull as e:
+            return json_error(e.message)
+        return JsonResponse(cart_json(request))
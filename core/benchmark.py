@@ -0,0 +1,231 @@
+"""Storefront benchmarks.
+
+Simulated shoppers walk the main flows through the Django test client:
+the home page, a few product pages with an add to cart each, the order
+summary, checkout and payment. Every request is timed and its queries
+counted, and the results are summarised per step as p50/p95 latency and
+mean queries per request, with the overall requests per second.
+
+A summary can be saved as a baseline and later runs compared against it
+(see the `benchmark` command). Query counts don't depend on the machine,
+so they're compared exactly; the p50 latency gets a tolerance. The p95
+is only reported: over a few dozen requests it's one slow outlier.
+"""
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.db import DatabaseError, connection
+from django.test import Client
+from django.urls import resolve, reverse
+
+from . import jobs
+from .models import Item
+
+STEPS = ['home', 'product', 'add_to_cart', 'order_summary', 'checkout',
+         'checkout_submit', 'payment']
+
+CHECKOUT_FORM = {
+    'street_address': '1 Benchmark Road',
+    'appertment_address': '',
+    'country': 'IN',
+    'zip': '400001',
+    'payment_options': 'S',
+}
+
+
+class Recorder:
+    """Collects (seconds, queries, failed) samples per step."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def request(self, step, send, *args, **kwargs):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        response = None
+        try:
+            with connection.execute_wrapper(count):
+                response = send(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            failed = response is None or response.status_code >= 400
+            with self._lock:
+                self.samples[step].append((elapsed, queries, failed))
+        return response
+
+
+class Shopper:
+    def __init__(self, user, slugs, rng, picks):
+        self.client = Client()
+        self.client.force_login(user)
+        self.slugs = slugs
+        self.rng = rng
+        self.picks = picks
+        self.user = user
+        # tokens pay for one order each
+        self.payments = itertools.count(1)
+
+    def journey(self, recorder):
+        client = self.client
+        recorder.request('home', client.get, reverse('core:home'))
+        for slug in self.rng.sample(self.slugs, min(self.picks, len(self.slugs))):
+            recorder.request('product', client.get,
+                             reverse('core:product', kwargs={'slug': slug}))
+            recorder.request('add_to_cart', client.get,
+                             reverse('core:add_to_cart', kwargs={'slug': slug}))
+        recorder.request('order_summary', client.get, reverse('core:ordersummary'))
+        recorder.request('checkout', client.get, reverse('core:checkout'))
+        recorder.request('checkout_submit', client.post, reverse('core:checkout'),
+                         CHECKOUT_FORM)
+        response = recorder.request(
+            'payment', client.post,
+            reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+            {'stripeToken': f'tok_benchmark_{self.user.pk}_{next(self.payments)}'})
+        # the charge belongs to the `process_payments` worker, so it's run
+        # here untimed, leaving the next journey a fresh cart
+        match = resolve(response.url)
+        if match.url_name == 'payment-status':
+            job = jobs.claim_job(match.kwargs['pk'])
+            if job is not None:
+                jobs.run_payment_job(job)
+
+
+def percentile(values, fraction):
+    # nearest rank
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+class Report:
+    def __init__(self, samples, wall_time):
+        self.samples = samples
+        self.wall_time = wall_time
+
+    @property
+    def requests(self):
+        return sum(len(samples) for samples in self.samples.values())
+
+    @property
+    def requests_per_second(self):
+        return self.requests / self.wall_time if self.wall_time else 0
+
+    def summary(self):
+        summary = {}
+        for step in STEPS:
+            samples = self.samples.get(step)
+            if not samples:
+                continue
+            timings = [seconds * 1000 for seconds, _, _ in samples]
+            summary[step] = {
+                'requests': len(samples),
+                'errors': sum(failed for _, _, failed in samples),
+                'p50_ms': round(percentile(timings, 0.5), 2),
+                'p95_ms': round(percentile(timings, 0.95), 2),
+                'queries': round(sum(queries for _, queries, _ in samples) / len(samples), 2),
+            }
+        return summary
+
+    def table(self):
+        lines = ['%-16s %8s %6s %8s %8s %8s' % (
+            'step', 'requests', 'errors', 'p50 ms', 'p95 ms', 'queries')]
+        for step, row in self.summary().items():
+            lines.append('%-16s %8d %6d %8.2f %8.2f %8.2f' % (
+                step, row['requests'], row['errors'], row['p50_ms'],
+                row['p95_ms'], row['queries']))
+        lines.append('%d requests in %.2fs, %.1f requests/sec' % (
+            self.requests, self.wall_time, self.requests_per_second))
+        return '\n'.join(lines)
+
+
+def run_benchmark(users, journeys=3, concurrency=1, picks=3, seed=0):
+    """Send each of `users` through `journeys` shopping journeys of `picks`
+    items each, from `concurrency` threads. Returns a Report.
+    """
+    slugs = list(Item.objects.order_by('pk').values_list('slug', flat=True))
+    rng = random.Random(seed)
+    shoppers = [Shopper(user, slugs, random.Random(rng.random()), picks)
+                for user in users]
+    recorder = Recorder()
+    queue = list(reversed(shoppers))
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    if not queue:
+                        return
+                    shopper = queue.pop()
+                for _ in range(journeys):
+                    try:
+                        shopper.journey(recorder)
+                    except DatabaseError:
+                        # a lock timeout under contention; the request was
+                        # recorded as failed, carry on with the next journey
+                        pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if concurrency > 1:
+                connection.close()
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        worker()
+    wall_time = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return Report(recorder.samples, wall_time)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, summary, params):
+    with open(path, 'w') as f:
+        json.dump({'params': params, 'steps': summary}, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def compare(summary, baseline, tolerance=0.5):
+    """Regressions of `summary` against a saved baseline, as messages:
+    any baseline step missing from the run, or running more queries, with
+    more errors, or with its p50 more than `tolerance` (a fraction) slower.
+    """
+    regressions = []
+    for step, base in baseline['steps'].items():
+        row = summary.get(step)
+        if row is None:
+            regressions.append(f'{step}: missing from the run')
+            continue
+        if row.get('errors', 0) > base.get('errors', 0):
+            regressions.append(f"{step}: {row['errors']} errors, "
+                               f"baseline {base.get('errors', 0)}")
+        if row['queries'] > base['queries']:
+            regressions.append(f"{step}: {row['queries']} queries per request, "
+                               f"baseline {base['queries']}")
+        if row['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{step}: p50 {row['p50_ms']}ms, "
+                               f"baseline {base['p50_ms']}ms")
+    return regressions
@@ -0,0 +1,51 @@
+import uuid
+
+from django.core.cache import cache
+from django.db.models import Count
+
+from .models import Order
+
+CART_COUNT_TIMEOUT = 60 * 60
+
+CATALOGUE_VERSION_KEY = 'catalogue-version'
+# with a per-process cache this also bounds how stale other workers can be
+CATALOGUE_TIMEOUT = 60 * 15
+
+
+def cart_count_key(user):
+    return f'cart-count:{user.pk}'
+
+
+def get_cart_item_count(user):
+    key = cart_count_key(user)
+    count = cache.get(key)
+    if count is None:
+        count = Order.objects.filter(user=user, ordered=False).aggregate(
+            count=Count('items'))['count']
+        cache.set(key, count, CART_COUNT_TIMEOUT)
+    return count
+
+
+def invalidate_cart_item_count(user):
+    cache.delete(cart_count_key(user))
+
+
+def catalogue_version():
+    version = cache.get(CATALOGUE_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOGUE_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(CATALOGUE_VERSION_KEY)
+    return version
+
+
+def bump_catalogue_version():
+    # a fresh random version rather than incr(), so a version evicted from
+    # the cache can't come back and revive pages rendered under it
+    cache.set(CATALOGUE_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+def catalogue_key(*parts):
+    """Cache key for rendered catalogue markup. Every key changes when the
+    catalogue version is bumped, so nothing has to be deleted one by one.
+    """
+    return ':'.join(['catalogue', catalogue_version(), *map(str, parts)])
@@ -0,0 +1,68 @@
+"""Purging abandoned carts.
+
+Work is done in batches of primary keys, each deleted in its own short
+transaction, so a nightly run on a large table never holds many row locks
+at once. A run that's interrupted can simply be started again: whatever
+was deleted stays deleted and the rest is picked up where it was left.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import inventory
+from .models import Order, OrderItem, PaymentJob
+
+CART_MAX_AGE = 30
+
+
+def stale_carts(days=CART_MAX_AGE):
+    """Open orders untouched for `days` days with no payment in flight."""
+    cutoff = timezone.now() - timedelta(days=days)
+    return Order.objects.filter(ordered=False, updated__lt=cutoff).exclude(
+        payment_jobs__status__in=[PaymentJob.PENDING, PaymentJob.RUNNING])
+
+
+def orphan_lines():
+    """Unordered lines that no longer belong to any order."""
+    return OrderItem.objects.filter(ordered=False, order=None)
+
+
+def batches(queryset, batch_size):
+    """Yield lists of up to `batch_size` pks from `queryset`, lowest first.
+
+    Walks up the pk rather than re-reading the first batch, so it makes
+    progress on a dry run where nothing is deleted.
+    """
+    last = None
+    while True:
+        page = queryset.order_by('pk')
+        if last is not None:
+            page = page.filter(pk__gt=last)
+        pks = list(page.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last = pks[-1]
+
+
+def delete_carts(pks, days=CART_MAX_AGE):
+    """Delete the carts in `pks` that are still stale, with their lines,
+    giving back any stock they hold. Returns (carts, lines) deleted.
+    """
+    with transaction.atomic():
+        # checked again under the lock: the customer may have come back, or
+        # queued a payment, since the batch was read
+        orders = list(stale_carts(days).filter(pk__in=pks).select_for_update())
+        for order in orders:
+            if order.reserved_at is not None:
+                inventory.release_stock(order)
+        _, lines = OrderItem.objects.filter(order__in=orders, ordered=False).delete()
+        _, carts = Order.objects.filter(pk__in=[order.pk for order in orders]).delete()
+    return carts.get(Order._meta.label, 0), lines.get(OrderItem._meta.label, 0)
+
+
+def delete_lines(pks):
+    """Delete the lines in `pks` that are still orphaned. Returns how many."""
+    _, deleted = orphan_lines().filter(pk__in=pks).delete()
+    return deleted.get(OrderItem._meta.label, 0)
@@ -0,0 +1,94 @@
+"""Coupon lookup and redemption.
+
+Codes are resolved through a small in-process TTL cache, misses included:
+a promo launch sends a burst of the same few codes. The Coupon signals
+clear it when a coupon changes in this process, other processes catch up
+within CACHE_TTL seconds. Use counts never come from the cache, they're
+claimed with conditional UPDATEs when a payment is queued.
+"""
+import threading
+import time
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Coupon, CouponUse
+
+CACHE_TTL = 60
+# random codes shouldn't grow the cache without bound
+CACHE_MAX_ENTRIES = 1000
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class CouponError(Exception):
+    """A coupon that can't be used. `message` is safe to show the customer."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def get_coupon(code):
+    """The coupon with `code`, or None."""
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(code)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    coupon = Coupon.objects.filter(code=code).first()
+    with _cache_lock:
+        if len(_cache) >= CACHE_MAX_ENTRIES:
+            _cache.clear()
+        _cache[code] = (now + CACHE_TTL, coupon)
+    return coupon
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def check_coupon(coupon, now=None):
+    """Raise CouponError if `coupon` is outside its validity window. Use
+    limits are only enforced by `redeem_coupon`.
+    """
+    now = now or timezone.now()
+    if coupon.valid_from is not None and now < coupon.valid_from:
+        raise CouponError("This coupon isn't valid yet")
+    if coupon.valid_until is not None and now >= coupon.valid_until:
+        raise CouponError("This coupon has expired")
+
+
+def redeem_coupon(coupon, user_id):
+    """Claim one use of `coupon` for the user, raising CouponError if it's
+    expired or used up. Nothing is claimed when it raises.
+    """
+    check_coupon(coupon)
+    with transaction.atomic():
+        # the limit is checked by the UPDATE itself, so concurrent
+        # checkouts can't both take the last use
+        claimed = Coupon.objects.filter(
+            Q(max_uses=None) | Q(uses__lt=F('max_uses')), pk=coupon.pk,
+        ).update(uses=F('uses') + 1)
+        if not claimed:
+            raise CouponError("This coupon has been used up")
+
+        use, _ = CouponUse.objects.get_or_create(coupon_id=coupon.pk, user_id=user_id)
+        per_user = CouponUse.objects.filter(pk=use.pk)
+        if coupon.max_uses_per_user is not None:
+            per_user = per_user.filter(uses__lt=coupon.max_uses_per_user)
+        if not per_user.update(uses=F('uses') + 1):
+            # rolls back the claim on the coupon too
+            raise CouponError("You have already used this coupon")
+
+
+def release_coupon(coupon_id, user_id):
+    """Give back a use claimed by `redeem_coupon`."""
+    with transaction.atomic():
+        Coupon.objects.filter(pk=coupon_id, uses__gt=0).update(uses=F('uses') - 1)
+        CouponUse.objects.filter(
+            coupon_id=coupon_id, user_id=user_id, uses__gt=0,
+        ).update(uses=F('uses') - 1)
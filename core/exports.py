@@ -0,0 +1,117 @@
+"""Order exports for finance.
+
+An export is one query over the order/line join table with the order's
+payment, coupon, addresses and each line's item joined in, read with
+`.iterator()` (a server-side cursor on PostgreSQL) and written out as it
+goes. Memory stays flat however many orders there are: nothing is
+collected, and JSON orders are assembled from consecutive rows.
+
+CSV has a row per order line with the order's columns repeated; JSON has
+an object per order with its lines nested.
+"""
+import csv
+import json
+from datetime import datetime, time, timedelta
+from itertools import groupby
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import Order
+
+CHUNK_SIZE = 2000
+
+# (column, lookup from the order/line join table)
+ORDER_COLUMNS = [
+    ('order', 'order_id'),
+    ('ref_code', 'order__ref_code'),
+    ('customer', 'order__user__username'),
+    ('ordered_date', 'order__ordered_date'),
+    ('charge_id', 'order__payment__stripe_charge_id'),
+    ('amount_paid', 'order__payment__amount'),
+    ('paid_at', 'order__payment__timestamp'),
+    ('coupon', 'order__coupon__code'),
+    ('coupon_amount', 'order__coupon__amount'),
+    ('billing_street', 'order__billing_address__street_address'),
+    ('billing_apartment', 'order__billing_address__appertment_address'),
+    ('billing_zip', 'order__billing_address__zip'),
+    ('billing_country', 'order__billing_address__country'),
+    ('shipping_street', 'order__shipping_address__street_address'),
+    ('shipping_apartment', 'order__shipping_address__appertment_address'),
+    ('shipping_zip', 'order__shipping_address__zip'),
+    ('shipping_country', 'order__shipping_address__country'),
+]
+LINE_COLUMNS = [
+    ('item', 'orderitem__item__slug'),
+    ('title', 'orderitem__item__title'),
+    ('quantity', 'orderitem__quantity'),
+    # what the item sells for now, lines don't keep the price paid
+    ('unit_price', 'orderitem__item__effective_price'),
+]
+COLUMNS = ORDER_COLUMNS + LINE_COLUMNS
+
+
+def day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def orders_between(since=None, until=None, orders=None):
+    """Placed orders (from `orders`, all of them by default) paid for from
+    the start of the day `since` to the end of the day `until`, going by
+    their ordered_date.
+    """
+    if orders is None:
+        orders = Order.objects.all()
+    orders = orders.filter(ordered=True)
+    if since is not None:
+        orders = orders.filter(ordered_date__gte=day_start(since))
+    if until is not None:
+        orders = orders.filter(ordered_date__lt=day_start(until + timedelta(days=1)))
+    return orders
+
+
+def export_rows(orders, chunk_size=CHUNK_SIZE):
+    """A tuple per order line, in COLUMNS order, grouped by order."""
+    # orders_between's filters, or the admin's annotations, stay in the
+    # subquery so the export itself is a plain join
+    lines = Order.items.through.objects.filter(order__in=orders.order_by().values('pk'))
+    return (lines.order_by('order_id', 'orderitem_id')
+            .values_list(*(lookup for _, lookup in COLUMNS))
+            .iterator(chunk_size=chunk_size))
+
+
+class Echo:
+    """A file-like object handing back whatever is written to it, so
+    csv.writer can format one row at a time.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_export(orders, chunk_size=CHUNK_SIZE):
+    writer = csv.writer(Echo())
+    yield writer.writerow([column for column, _ in COLUMNS])
+    for row in export_rows(orders, chunk_size):
+        yield writer.writerow(row)
+
+
+def json_export(orders, chunk_size=CHUNK_SIZE):
+    order_count = len(ORDER_COLUMNS)
+    order_names = [column for column, _ in ORDER_COLUMNS]
+    line_names = [column for column, _ in LINE_COLUMNS]
+    separator = '\n'
+    yield '['
+    for order_values, rows in groupby(export_rows(orders, chunk_size),
+                                      key=lambda row: row[:order_count]):
+        order = dict(zip(order_names, order_values))
+        order['lines'] = [dict(zip(line_names, row[order_count:])) for row in rows]
+        yield separator + json.dumps(order, cls=DjangoJSONEncoder)
+        separator = ',\n'
+    yield '\n]\n'
+
+
+EXPORTS = {
+    'csv': (csv_export, 'text/csv'),
+    'json': (json_export, 'application/json'),
+}
@@ -0,0 +1,114 @@
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, CharField, Count, F, Value, When
+
+from .cache import CATALOGUE_TIMEOUT, catalogue_key
+from .models import (CATAGORY_CHOICES, LABEL_CHOICES, PRICE_RANGES, FacetCount,
+                     Item, price_range_value)
+
+
+def filter_items(queryset, filters):
+    """Apply the cleaned `ItemFilterForm` data in `filters` to an Item
+    queryset. `max_price` is exclusive, matching the price facet ranges.
+    """
+    if filters.get('catagory'):
+        queryset = queryset.filter(catagory=filters['catagory'])
+    if filters.get('label'):
+        queryset = queryset.filter(label=filters['label'])
+    if filters.get('min_price') is not None:
+        queryset = queryset.filter(effective_price__gte=filters['min_price'])
+    if filters.get('max_price') is not None:
+        queryset = queryset.filter(effective_price__lt=filters['max_price'])
+    return queryset
+
+
+def adjust_facets(facets, delta):
+    for facet, value in facets:
+        row, _ = FacetCount.objects.get_or_create(facet=facet, value=value)
+        FacetCount.objects.filter(pk=row.pk).update(count=F('count') + delta)
+
+
+def item_saved(item, created):
+    new = item.get_facets()
+    old = set() if created else getattr(item, '_loaded_facets', None)
+    if new is None or old is None:
+        # we can't tell what the item was counted under before
+        rebuild_facets()
+    else:
+        adjust_facets(old - new, -1)
+        adjust_facets(new - old, 1)
+    item._loaded_facets = new
+
+
+def item_deleted(item):
+    facets = getattr(item, '_loaded_facets', None) or item.get_facets()
+    if facets is None:
+        rebuild_facets()
+    else:
+        adjust_facets(facets, -1)
+
+
+def price_range_expression():
+    whens = [
+        When(effective_price__lt=high, then=Value(price_range_value(low)))
+        for low, high in PRICE_RANGES if high is not None
+    ]
+    low, _ = PRICE_RANGES[-1]
+    return Case(*whens, default=Value(price_range_value(low)),
+                output_field=CharField())
+
+
+def rebuild_facets():
+    """Recount every facet from scratch with one GROUP BY per facet. Run
+    after bulk changes that bypass the model signals.
+    """
+    counts = Counter()
+    items = Item.objects.order_by()
+    for field in ('catagory', 'label'):
+        for row in items.values(field).annotate(count=Count('id')):
+            counts[(field, row[field])] = row['count']
+    prices = (items.annotate(price_range=price_range_expression())
+              .values('price_range').annotate(count=Count('id')))
+    for row in prices:
+        counts[('price', row['price_range'])] = row['count']
+
+    with transaction.atomic():
+        FacetCount.objects.all().delete()
+        FacetCount.objects.bulk_create(
+            FacetCount(facet=facet, value=value, count=count)
+            for (facet, value), count in counts.items())
+
+
+def price_range_name(low, high):
+    return f'${low} - ${high}' if high is not None else f'${low}+'
+
+
+def facet_summary():
+    """Display data for the listing sidebar: per facet, a list of
+    (query params, name, count).
+    """
+    key = catalogue_key('facets')
+    summary = cache.get(key)
+    if summary is None:
+        counts = {(row.facet, row.value): row.count
+                  for row in FacetCount.objects.all()}
+        summary = {
+            'catagory': [
+                ({'catagory': value}, name, counts.get(('catagory', value), 0))
+                for value, name in CATAGORY_CHOICES
+            ],
+            'label': [
+                ({'label': value}, name, counts.get(('label', value), 0))
+                for value, name in LABEL_CHOICES
+            ],
+            'price': [
+                ({'min_price': low, 'max_price': high} if high is not None else {'min_price': low},
+                 price_range_name(low, high),
+                 counts.get(('price', price_range_value(low)), 0))
+                for low, high in PRICE_RANGES
+            ],
+        }
+        cache.set(key, summary, CATALOGUE_TIMEOUT)
+    return summary
@@ -1,6 +1,7 @@
 from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
+from .models import CATAGORY_CHOICES, LABEL_CHOICES
 
 
 PAYMENT_CHOICES = (
@@ -50,3 +51,18 @@ class RefundForm(forms.Form):
         'rows': 4
     }))
     email = forms.EmailField()
+
+
+SORT_CHOICES = (
+    ('price', 'Price: low to high'),
+    ('-price', 'Price: high to low')
+)
+
+
+class ItemFilterForm(forms.Form):
+    catagory = forms.ChoiceField(required=False, choices=CATAGORY_CHOICES)
+    label = forms.ChoiceField(required=False, choices=LABEL_CHOICES)
+    # as Item.price, so a filter is exact and fits the column
+    min_price = forms.DecimalField(required=False, min_value=0, max_digits=10, decimal_places=2)
+    max_price = forms.DecimalField(required=False, min_value=0, max_digits=10, decimal_places=2)
+    sort = forms.ChoiceField(required=False, choices=SORT_CHOICES)
@@ -0,0 +1,246 @@
+"""Payment gateways.
+
+settings.PAYMENT_GATEWAYS maps each checkout payment option ('stripe',
+'paypal') to a BACKEND class and the OPTIONS it's built with, the same
+shape as CACHES. Gateways are built once per process and kept, so their
+HTTP connections are reused from one charge to the next.
+"""
+import itertools
+import threading
+import time
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import stripe
+
+
+class PaymentError(Exception):
+    """A failed charge. `message` is safe to show to the customer and
+    `retryable` marks failures worth trying again later.
+    """
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.message = message
+        self.retryable = retryable
+
+
+class BaseGateway:
+    def charge(self, amount, token, description='', idempotency_key=None):
+        """Charge `amount` (in the store currency) to `token` and return
+        the processor's charge id, raising PaymentError on failure. A
+        repeated charge with the same `idempotency_key` isn't taken again.
+        """
+        raise NotImplementedError
+
+
+def pooled_session(pool_size=10, max_retries=2):
+    # only connection failures are retried here: the request never reached
+    # the processor, so it's safe even for a POST
+    retry = Retry(total=max_retries, connect=max_retries, read=0,
+                  backoff_factor=0.3)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class StripeGateway(BaseGateway):
+    def __init__(self, api_key, currency='inr', exchange_rate=77, timeout=10,
+                 max_retries=2, pool_size=10):
+        self.api_key = api_key
+        self.currency = currency
+        self.exchange_rate = exchange_rate
+        # stripe-python sends every request through its module level client,
+        # and adds idempotency keys to the POSTs it retries itself
+        stripe.default_http_client = stripe.http_client.RequestsClient(
+            timeout=timeout, session=pooled_session(pool_size, max_retries=0))
+        stripe.max_network_retries = max_retries
+
+    def charge(self, amount, token, description='', idempotency_key=None):
+        # `source` is obtained with Stripe.js; see https://stripe.com/docs/payments/accept-a-payment-charges#web-create-token
+        try:
+            charge = stripe.Charge.create(
+                api_key=self.api_key,
+                amount=int(amount) * self.exchange_rate,
+                currency=self.currency,
+                source=token,
+                description=description,
+                idempotency_key=idempotency_key,
+            )
+        except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+            raise PaymentError("Network Error", retryable=True) from e
+        except stripe.error.CardError as e:
+            # Since it's a decline, stripe.error.CardError will be caught
+            raise PaymentError(e.user_message or str(e)) from e
+        except stripe.error.InvalidRequestError as e:
+            raise PaymentError("Invalid Parameters") from e
+        except stripe.error.AuthenticationError as e:
+            # (maybe you changed API keys recently)
+            raise PaymentError("Not authenticated") from e
+        except stripe.error.StripeError as e:
+            raise PaymentError("Something went wrong please try again.") from e
+        return charge['id']
+
+
+class PayPalGateway(BaseGateway):
+    URLS = {
+        'sandbox': 'https://api-m.sandbox.paypal.com',
+        'live': 'https://api-m.paypal.com',
+    }
+
+    def __init__(self, client_id, secret, mode='sandbox', currency='USD',
+                 timeout=10, max_retries=2, pool_size=10):
+        self.client_id = client_id
+        self.secret = secret
+        self.base_url = self.URLS[mode]
+        self.currency = currency
+        self.timeout = timeout
+        self.session = pooled_session(pool_size, max_retries)
+        self._token = None
+        self._token_expires = 0
+        self._lock = threading.Lock()
+
+    def access_token(self):
+        with self._lock:
+            if self._token is None or time.monotonic() >= self._token_expires:
+                response = self.session.post(
+                    f'{self.base_url}/v1/oauth2/token',
+                    auth=(self.client_id, self.secret),
+                    data={'grant_type': 'client_credentials'},
+                    timeout=self.timeout,
+                )
+                if response.status_code == 401:
+                    raise PaymentError("Not authenticated")
+                response.raise_for_status()
+                data = response.json()
+                self._token = data['access_token']
+                # refresh a minute early rather than race the expiry
+                self._token_expires = time.monotonic() + data['expires_in'] - 60
+            return self._token
+
+    def call(self, method, path, headers=None, **kwargs):
+        """Send an API request and return the decoded response, raising
+        PaymentError if it fails.
+        """
+        try:
+            response = self.session.request(
+                method, f'{self.base_url}{path}',
+                headers={'Authorization': f'Bearer {self.access_token()}', **(headers or {})},
+                timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise PaymentError("Network Error", retryable=True) from e
+        if response.status_code == 429 or response.status_code >= 500:
+            raise PaymentError("Network Error", retryable=True)
+        if response.status_code == 401:
+            raise PaymentError("Not authenticated")
+        data = response.json()
+        if not response.ok:
+            raise PaymentError(data.get('message', "Invalid Parameters"))
+        return data
+
+    def money(self, amount):
+        return {'currency_code': self.currency, 'value': f'{Decimal(amount):.2f}'}
+
+    def is_amount(self, money, amount):
+        return {key: money.get(key) for key in ('currency_code', 'value')} == self.money(amount)
+
+    def create_order(self, amount, description=''):
+        """Create an order for `amount` for the buyer to approve with the
+        PayPal JS SDK, and return its id.
+        """
+        data = self.call('POST', '/v2/checkout/orders', json={
+            'intent': 'CAPTURE',
+            'purchase_units': [{'amount': self.money(amount), 'description': description}],
+        })
+        return data['id']
+
+    def charge(self, amount, token, description='', idempotency_key=None):
+        # `token` is the id of an order from `create_order` that the buyer
+        # approved; capturing it moves the money. The amount is the
+        # browser's to tamper with until then, so it's checked first.
+        order = self.call('GET', f'/v2/checkout/orders/{token}')
+        if not self.is_amount(order['purchase_units'][0]['amount'], amount):
+            raise PaymentError("The PayPal payment doesn't match your order total")
+        data = self.call('POST', f'/v2/checkout/orders/{token}/capture', headers={
+            'Content-Type': 'application/json',
+            # makes a repeated capture of the same order a no-op
+            'PayPal-Request-Id': idempotency_key or f'capture-{token}',
+        })
+        capture = data['purchase_units'][0]['payments']['captures'][0]
+        if not self.is_amount(capture['amount'], amount):
+            raise PaymentError("The PayPal payment doesn't match your order total")
+        return capture['id']
+
+
+class FakeGateway(BaseGateway):
+    """In-process gateway for tests and offline benchmarks.
+
+    Approves every token except those starting with 'decline' (a card
+    decline) or 'offline' (a retryable network failure), and orders it
+    created for another amount.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.charges = []
+        # order id: amount, for the orders made by `create_order`
+        self.orders = {}
+        self._ids = itertools.count(1)
+        # idempotency key: charge id
+        self._keys = {}
+
+    def create_order(self, amount, description=''):
+        order_id = f'FAKE-ORDER-{next(self._ids)}'
+        self.orders[order_id] = amount
+        return order_id
+
+    def charge(self, amount, token, description='', idempotency_key=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if token.startswith('decline'):
+            raise PaymentError("Your card was declined.")
+        if token.startswith('offline'):
+            raise PaymentError("Network Error", retryable=True)
+        if self.orders.get(token, amount) != amount:
+            raise PaymentError("The PayPal payment doesn't match your order total")
+        if idempotency_key in self._keys:
+            return self._keys[idempotency_key]
+        self.charges.append(
+            {'amount': amount, 'token': token, 'description': description})
+        charge_id = f'fake_{next(self._ids)}'
+        if idempotency_key is not None:
+            self._keys[idempotency_key] = charge_id
+        return charge_id
+
+
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+
+def get_gateway(name):
+    with _gateways_lock:
+        if name not in _gateways:
+            try:
+                config = settings.PAYMENT_GATEWAYS[name]
+            except KeyError:
+                raise ImproperlyConfigured(
+                    f"No payment gateway configured for '{name}'")
+            backend = import_string(config['BACKEND'])
+            _gateways[name] = backend(**config.get('OPTIONS', {}))
+        return _gateways[name]
+
+
+@receiver(setting_changed)
+def reset_gateways(setting, **kwargs):
+    if setting == 'PAYMENT_GATEWAYS':
+        _gateways.clear()
@@ -0,0 +1,118 @@
+"""Resized renditions of item images.
+
+Each item image gets WebP and JPEG renditions at a few widths, stored
+next to the uploads under names derived from a hash of the original's
+content (`Item.image_hash`). A new image gets new names, so the files
+never change once written and can be cached by browsers forever.
+
+The product cards' sizes are made when items are imported; any other is
+made by the image view the first time it's asked for, and kept.
+"""
+import hashlib
+import io
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, UnidentifiedImageError
+
+from .models import Item
+
+# the product cards, at 1x and 2x
+THUMBNAIL_WIDTHS = (300, 600)
+# every width there can be a rendition at, offered in srcsets
+VARIANT_WIDTHS = (300, 600, 900, 1200)
+# extension: Pillow format
+FORMATS = {'webp': 'WEBP', 'jpg': 'JPEG'}
+CONTENT_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg'}
+QUALITY = 80
+
+
+class ImageError(Exception):
+    """An image that couldn't be read. `message` says why."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def variant_name(image_hash, width, ext):
+    return f'variants/{image_hash[:2]}/{image_hash}-{width}w.{ext}'
+
+
+def render_variant(image, width, ext):
+    if image.width > width:
+        height = round(image.height * width / image.width)
+        # shrinks by whole factors first, nearly as sharp and much faster
+        image = image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+    if FORMATS[ext] == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    output = io.BytesIO()
+    image.save(output, FORMATS[ext], quality=QUALITY)
+    return output.getvalue()
+
+
+def make_variants(name, widths=THUMBNAIL_WIDTHS, formats=FORMATS):
+    """Write any missing renditions of the stored image `name` and return
+    its content hash. Raises ImageError if it isn't a readable image.
+    """
+    try:
+        with default_storage.open(name) as f:
+            data = f.read()
+    except OSError as e:
+        raise ImageError(f'{name}: {e.strerror or e}')
+    image_hash = content_hash(data)
+    wanted = [(width, ext) for width in widths for ext in formats
+              if not default_storage.exists(variant_name(image_hash, width, ext))]
+    if wanted:
+        try:
+            image = Image.open(io.BytesIO(data))
+            # JPEGs can be decoded at a fraction of their size, only as
+            # big as the widest rendition needs
+            widest = max(width for width, _ in wanted)
+            image.draft(None, (widest, image.height * widest // image.width))
+            image.load()
+        except (UnidentifiedImageError, OSError) as e:
+            raise ImageError(f'{name}: {e}')
+        for width, ext in wanted:
+            variant = variant_name(image_hash, width, ext)
+            saved = default_storage.save(variant, ContentFile(render_variant(image, width, ext)))
+            if saved != variant:
+                # someone else wrote it meanwhile, the storage renamed ours
+                default_storage.delete(saved)
+    return image_hash
+
+
+def get_variant(item, width, ext):
+    """Storage name of the item's image at `width` as `ext`, made if it's
+    missing. An item without an image_hash gets one.
+    """
+    if item.image_hash:
+        name = variant_name(item.image_hash, width, ext)
+        if default_storage.exists(name):
+            return name
+    image_hash = make_variants(item.image.name, [width], [ext])
+    if image_hash != item.image_hash:
+        item.image_hash = image_hash
+        Item.objects.filter(pk=item.pk).update(image_hash=image_hash)
+    return variant_name(image_hash, width, ext)
+
+
+def variant_url(item, width, ext='webp'):
+    """URL of the item's image at `width`. Without an image_hash it's one
+    that redirects to the hashed URL once the hash is known.
+    """
+    if not item.image:
+        return ''
+    if item.image_hash:
+        return reverse('core:image-variant', kwargs={
+            'pk': item.pk, 'image_hash': item.image_hash, 'width': width, 'ext': ext})
+    return reverse('core:image', kwargs={'pk': item.pk, 'width': width, 'ext': ext})
+
+
+def srcset(item, ext='webp', widths=VARIANT_WIDTHS):
+    return ', '.join(f'{variant_url(item, width, ext)} {width}w' for width in widths)
@@ -0,0 +1,236 @@
+"""Catalogue imports.
+
+A catalogue is a CSV file or JSON Lines, a row per item keyed on `slug`.
+Rows are read as a stream and written in batches: each batch creates the
+items it doesn't know and updates the ones it does, changing only the
+columns the file has. An item's `image` is the name of a file in media
+storage (copied in from an images directory if need be), and its
+renditions are made in a pool of processes while the batch is written.
+"""
+import csv
+import json
+import multiprocessing
+import os
+
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+from . import images
+from .models import Item
+
+BATCH_SIZE = 500
+
+FIELDS = ['title', 'price', 'discount_price', 'catagory', 'label',
+          'description', 'stock', 'image']
+REQUIRED = {'title', 'price', 'catagory', 'label', 'description', 'image'}
+# blank means none of these, not an empty value
+NULLABLE = {'discount_price', 'stock'}
+
+
+class RowError(Exception):
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+        self.message = message
+
+
+def read_rows(f, format):
+    """Yield (line number, row dict) from a CSV or JSON Lines file."""
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line, text in enumerate(f, 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            raise RowError(line, f'invalid JSON, {e}')
+        yield line, row
+
+
+def clean_row(line, row):
+    """The model field values in `row`, keyed by field name, with 'slug'."""
+    if not isinstance(row, dict):
+        # valid JSON, but not an object
+        raise RowError(line, 'expected an object')
+    values = {}
+    for name in ['slug', *FIELDS]:
+        if name not in row:
+            continue
+        value = row[name]
+        if isinstance(value, str):
+            value = value.strip()
+        if name in NULLABLE and value in ('', None):
+            values[name] = None
+            continue
+        if name == 'image':
+            value = str(value or '')
+            if not value:
+                raise RowError(line, 'image: This field cannot be blank.')
+            if os.path.isabs(value) or '..' in value.split('/'):
+                raise RowError(line, 'image: Give a path relative to the images directory.')
+            values[name] = value
+            continue
+        try:
+            values[name] = Item._meta.get_field(name).clean(value, None)
+        except ValidationError as e:
+            raise RowError(line, f'{name}: {" ".join(e.messages)}')
+    if 'slug' not in values:
+        raise RowError(line, 'slug: This field is required.')
+    return values
+
+
+def store_image(name, images_dir):
+    """Copy `name` from `images_dir` into media storage unless it's there.
+    Returns the stored name, which the storage may have changed.
+    """
+    if images_dir and not default_storage.exists(name):
+        path = os.path.join(images_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return default_storage.save(name, f)
+    return name
+
+
+def upsert(rows):
+    """Create or update the items in `rows` ({slug: (line, values)}).
+    Returns ({slug: item}, created count, updated count, errors).
+    """
+    errors = []
+    with transaction.atomic():
+        existing = Item.objects.in_bulk(rows, field_name='slug')
+        new, changed, fields = [], [], set()
+        for slug, (line, values) in rows.items():
+            item = existing.get(slug)
+            if item is None:
+                missing = REQUIRED - set(values)
+                if missing:
+                    errors.append(RowError(line, 'new items need ' + ', '.join(sorted(missing))))
+                    continue
+                item = Item(**values)
+                new.append(item)
+            else:
+                if values.get('image', item.image.name) != item.image.name:
+                    # the renditions were of the old image
+                    values['image_hash'] = ''
+                for name, value in values.items():
+                    setattr(item, name, value)
+                fields.update(values)
+                changed.append(item)
+            item.effective_price = item.get_effective_price()
+        if changed:
+            fields = (fields - {'slug'}) | {'effective_price'}
+            Item.objects.bulk_update(changed, sorted(fields))
+        Item.objects.bulk_create(new)
+    items = {item.slug: item for item in changed}
+    # not every backend hands back the new pks
+    items.update(Item.objects.in_bulk([item.slug for item in new], field_name='slug'))
+    return items, len(new), len(changed), errors
+
+
+def _make_variants(name):
+    # the process pool entry point
+    try:
+        return name, images.make_variants(name), None
+    except images.ImageError as e:
+        return name, None, e.message
+
+
+class Importer:
+    """Imports rows in batches, keeping count. Image renditions are made by
+    a pool of `workers` processes (one means in this one), or skipped if
+    `make_images` is False. Use it as a context manager to run the pool.
+    """
+
+    def __init__(self, images_dir=None, workers=None, batch_size=BATCH_SIZE,
+                 make_images=True):
+        self.images_dir = images_dir
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.make_images = make_images
+        self.pool = None
+        self.created = self.updated = 0
+        self.errors = []
+        # image name: content hash, for the images done so far
+        self.hashes = {}
+        self.failed = set()
+
+    def __enter__(self):
+        if self.make_images and self.workers > 1:
+            # forked so the workers have Django set up, without our connections
+            connections.close_all()
+            self.pool = multiprocessing.get_context('fork').Pool(self.workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def run(self, rows, progress=None):
+        batch = {}
+        for line, row in rows:
+            try:
+                values = clean_row(line, row)
+            except RowError as e:
+                self.errors.append(e)
+                continue
+            # a slug repeated within the batch: the later row wins
+            batch[values['slug']] = (line, values)
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = {}
+                if progress is not None:
+                    progress(self)
+        if batch:
+            self.import_batch(batch)
+            if progress is not None:
+                progress(self)
+
+    @property
+    def images(self):
+        return len(self.hashes)
+
+    def import_batch(self, batch):
+        names = set()
+        for slug, (line, values) in batch.items():
+            if 'image' in values:
+                values['image'] = store_image(values['image'], self.images_dir)
+                if values['image'] not in self.hashes.keys() | self.failed:
+                    names.add(values['image'])
+
+        # the renditions are rendered while the items are written
+        variants = None
+        if self.make_images and names:
+            if self.pool is not None:
+                variants = self.pool.map_async(_make_variants, sorted(names))
+            else:
+                variants = [_make_variants(name) for name in sorted(names)]
+        items, created, updated, errors = upsert(batch)
+        self.created += created
+        self.updated += updated
+        self.errors.extend(errors)
+        if not self.make_images:
+            return
+
+        if self.pool is not None and variants is not None:
+            variants = variants.get()
+        for name, image_hash, error in variants or []:
+            if error:
+                self.failed.add(name)
+                self.errors.append(RowError(
+                    ', '.join(str(line) for line, values in batch.values()
+                              if values.get('image') == name), error))
+            else:
+                self.hashes[name] = image_hash
+        hashed = []
+        for item in items.values():
+            image_hash = self.hashes.get(item.image.name)
+            if image_hash and item.image_hash != image_hash:
+                item.image_hash = image_hash
+                hashed.append(item)
+        Item.objects.bulk_update(hashed, ['image_hash'])
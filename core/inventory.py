@@ -0,0 +1,109 @@
+"""Stock reservation.
+
+An open order's lines take their units out of `Item.stock` when the
+customer checks out, so a flash sale can't sell more than is on hand. Each
+line is claimed with a conditional UPDATE (`stock >= quantity`) rather
+than a read and a write. The item rows it locks stay locked until the
+reservation commits, so lines are claimed and given back in item order:
+two checkouts sharing items then wait for each other rather than
+deadlock. A reservation
+is kept until the order is paid, or is given back by `release_stock`
+when the checkout is abandoned (see the `release_stock` command).
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Item, Order, OrderItem, PaymentJob
+
+RESERVATION_TIMEOUT = 30 * 60
+
+
+class OutOfStock(Exception):
+    """Not enough units of `item` for the order. `message` is safe to show
+    the customer.
+    """
+
+    def __init__(self, item, available):
+        self.item = item
+        self.available = available
+        if available:
+            self.message = f'Only {available} of "{item}" left in stock'
+        else:
+            self.message = f'"{item}" is out of stock'
+        super().__init__(self.message)
+
+
+def reserve_stock(order):
+    """Reserve the stock for every line of `order`, replacing any earlier
+    reservation so changes to the cart since then are picked up. Raises
+    OutOfStock, reserving nothing, if an item runs short.
+    """
+    with transaction.atomic():
+        # one reservation at a time per order
+        Order.objects.select_for_update().filter(pk=order.pk).exists()
+        release_lines(order)
+        lines = list(OrderItem.objects.filter(order=order, item__stock__isnull=False)
+                     .select_related('item').order_by('item_id'))
+        for line in lines:
+            claimed = Item.objects.filter(
+                pk=line.item_id, stock__gte=line.quantity,
+            ).update(stock=F('stock') - line.quantity)
+            if not claimed:
+                available = Item.objects.values_list('stock', flat=True).get(pk=line.item_id)
+                # rolls back the lines reserved so far
+                raise OutOfStock(line.item, available)
+            line.reserved = line.quantity
+        OrderItem.objects.bulk_update(lines, ['reserved'])
+        order.reserved_at = timezone.now()
+        Order.objects.filter(pk=order.pk).update(reserved_at=order.reserved_at)
+
+
+def release_reserved(lines):
+    """Give back the stock reserved for the OrderItem queryset `lines`.
+    Lines must have theirs given back before they're deleted or shrunk.
+    """
+    reserved = lines.filter(reserved__gt=0)
+    for line in reserved.order_by('item_id'):
+        Item.objects.filter(pk=line.item_id, stock__isnull=False).update(
+            stock=F('stock') + line.reserved)
+    reserved.update(reserved=0)
+
+
+def release_lines(order):
+    release_reserved(OrderItem.objects.filter(order=order))
+
+
+def release_stock(order):
+    """Put the stock reserved for `order` back on the shelf."""
+    with transaction.atomic():
+        Order.objects.select_for_update().filter(pk=order.pk).exists()
+        release_lines(order)
+        order.reserved_at = None
+        Order.objects.filter(pk=order.pk).update(reserved_at=None)
+
+
+def expired_reservations(timeout=RESERVATION_TIMEOUT):
+    """Open orders reserved more than `timeout` seconds ago with no payment
+    in flight.
+    """
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    return Order.objects.filter(ordered=False, reserved_at__lt=cutoff).exclude(
+        payment_jobs__status__in=[PaymentJob.PENDING, PaymentJob.RUNNING])
+
+
+def release_expired(timeout=RESERVATION_TIMEOUT):
+    """Release every expired reservation. Returns how many were released."""
+    released = 0
+    for pk in expired_reservations(timeout).values_list('pk', flat=True):
+        with transaction.atomic():
+            # checked again under the order's lock, a payment may have been
+            # queued since (`reserve_stock` takes the same lock)
+            order = Order.objects.select_for_update().filter(pk=pk).first()
+            if order is None or not expired_reservations(timeout).filter(pk=pk).exists():
+                continue
+            release_stock(order)
+            released += 1
+    return released
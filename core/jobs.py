@@ -0,0 +1,172 @@
+import logging
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from . import coupons, inventory, services
+from .gateways import PaymentError, get_gateway
+from .models import Order, Payment, PaymentJob
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+# seconds a job can be running before it's taken for the work of a dead worker
+JOB_TIMEOUT = 10 * 60
+
+TOKEN_USED = "This payment has already been used, please pay again"
+
+
+def enqueue_payment(order, token, gateway='stripe'):
+    """Queue a charge for `order` unless one is already in flight.
+
+    Reserves the order's stock and claims a use of its coupon first,
+    raising OutOfStock or CouponError if either has run out. Raises
+    PaymentError for a token that's been used before.
+    """
+    try:
+        return queue_job(order, token, gateway)
+    except IntegrityError:
+        # the same token queued for another order meanwhile
+        raise PaymentError(TOKEN_USED)
+
+
+def queue_job(order, token, gateway):
+    with transaction.atomic():
+        # checked and queued under the cart's lock, which cart changes take
+        # too (see `services.get_cart_for_update`)
+        in_flight = PaymentJob.objects.filter(
+            order=OuterRef('pk'), status__in=PaymentJob.IN_FLIGHT)
+        paying, used, paid = Order.objects.select_for_update().annotate(
+            paying=Exists(in_flight),
+            used=Exists(PaymentJob.objects.filter(gateway=gateway, token=token)),
+            paid=Exists(Payment.objects.filter(stripe_charge_id=token)),
+        ).values_list('paying', 'used', 'paid').get(pk=order.pk)
+        job = paying and order.payment_jobs.filter(status__in=PaymentJob.IN_FLIGHT).first()
+        if not job:
+            # an approved PayPal order would be captured again as a no-op,
+            # paying for a second order with the first one's money
+            if used or paid:
+                raise PaymentError(TOKEN_USED)
+            # priced as it is now it's locked
+            order = Order.objects.with_totals().select_related('coupon').get(pk=order.pk)
+            inventory.reserve_stock(order)
+            if order.coupon_id is not None:
+                coupons.redeem_coupon(order.coupon, order.user_id)
+            job = PaymentJob.objects.create(
+                order=order, user_id=order.user_id, gateway=gateway, token=token,
+                amount=order.get_total_price(), coupon_id=order.coupon_id)
+    return job
+
+
+def claim_next_job():
+    """Move the oldest pending job to running and return it, or None.
+
+    The claim is a conditional UPDATE so several workers can poll the same
+    table without handing one job out twice.
+    """
+    pending = PaymentJob.objects.filter(status=PaymentJob.PENDING)
+    for pk in pending.order_by('created').values_list('pk', flat=True)[:10]:
+        job = claim_job(pk)
+        if job is not None:
+            return job
+    return None
+
+
+def claim_job(pk):
+    """Move the job `pk` to running and return it, or None if it isn't
+    pending any more.
+    """
+    # `updated` is when it was claimed, for `reclaim_stuck_jobs`
+    claimed = PaymentJob.objects.filter(
+        pk=pk, status=PaymentJob.PENDING,
+    ).update(status=PaymentJob.RUNNING, attempts=F('attempts') + 1,
+             updated=timezone.now())
+    return PaymentJob.objects.get(pk=pk) if claimed else None
+
+
+def reclaim_stuck_jobs(timeout=JOB_TIMEOUT):
+    """Put jobs left running for more than `timeout` seconds, by a worker
+    that died, back in the queue. Returns how many there were.
+
+    A charge that went through before the worker died isn't taken again:
+    charges carry the job's idempotency key.
+    """
+    now = timezone.now()
+    return PaymentJob.objects.filter(
+        status=PaymentJob.RUNNING, updated__lt=now - timedelta(seconds=timeout),
+    ).update(status=PaymentJob.PENDING, updated=now)
+
+
+def run_payment_job(job, gateway=None):
+    """Charge the job's token and finalize its order.
+
+    `gateway` defaults to the one configured for the job's payment option.
+    A job already charged only has its order finalized.
+    """
+    if job.attempts > MAX_ATTEMPTS:
+        # reclaimed over and over, something kills the worker
+        logger.error('payment job %s gave up after %s attempts', job.pk, job.attempts)
+        return finish_job(job, PaymentJob.FAILED,
+                          "A serious error occurred, we have been notified")
+    if not job.charge_id:
+        if gateway is None:
+            gateway = get_gateway(job.gateway)
+        try:
+            job.charge_id = gateway.charge(
+                job.amount, job.token, description=f"Order {job.order_id}",
+                idempotency_key=f'payment-job-{job.pk}')
+        except PaymentError as e:
+            if e.retryable and job.attempts < MAX_ATTEMPTS:
+                # transient, put it back in the queue
+                logger.warning('payment job %s will be retried: %s', job.pk, e)
+                return finish_job(job, PaymentJob.PENDING)
+            return finish_job(job, PaymentJob.FAILED, e.message)
+        except Exception:
+            logger.exception('payment job %s crashed', job.pk)
+            return finish_job(job, PaymentJob.FAILED,
+                              "A serious error occurred, we have been notified")
+        job.save(update_fields=['charge_id', 'updated'])
+
+    try:
+        order = Order.objects.with_totals().get(pk=job.order_id)
+        if not order.ordered:
+            services.finalize_order(order, job.charge_id, amount=job.amount)
+    except Exception:
+        logger.exception('payment job %s was charged (%s) but its order could '
+                         'not be finalized', job.pk, job.charge_id)
+        if job.attempts < MAX_ATTEMPTS:
+            return finish_job(job, PaymentJob.PENDING)
+        return finish_job(job, PaymentJob.FAILED,
+                          "Your payment was taken but your order couldn't be "
+                          "completed, we have been notified")
+    return finish_job(job, PaymentJob.SUCCEEDED)
+
+
+def finish_job(job, status, error=''):
+    with transaction.atomic():
+        job.status = status
+        job.error = error[:255]
+        job.save(update_fields=['status', 'error', 'updated'])
+        # a coupon that's been paid for stays used
+        if status == PaymentJob.FAILED and job.coupon_id is not None and not job.charge_id:
+            coupons.release_coupon(job.coupon_id, job.user_id)
+    return job
+
+
+def process_payment_jobs(gateway=None, limit=None):
+    """Run pending jobs until the queue is empty or `limit` have run.
+    Returns the number processed.
+    """
+    reclaimed = reclaim_stuck_jobs()
+    if reclaimed:
+        logger.warning('put %s stuck payment job(s) back in the queue', reclaimed)
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_payment_job(job, gateway=gateway)
+        processed += 1
+    return processed
@@ -0,0 +1,101 @@
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+
+from core import benchmark, seed
+from core.models import Item
+
+BENCHMARK_SETTINGS = {
+    'PAYMENT_GATEWAYS': {
+        'stripe': {'BACKEND': 'core.gateways.FakeGateway'},
+        'paypal': {'BACKEND': 'core.gateways.FakeGateway'},
+    },
+    'STATICFILES_STORAGE': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    # nothing cached by real traffic, and nothing left behind for it
+    'CACHES': {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'benchmark',
+        }
+    },
+}
+
+
+class Command(BaseCommand):
+    help = ('Time the storefront flows with simulated shoppers, in a throwaway '
+            'database seeded with a synthetic catalogue')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=200,
+                            help="catalogue size (default %(default)s)")
+        parser.add_argument('--users', type=int, default=5,
+                            help="shoppers (default %(default)s)")
+        parser.add_argument('--cart-lines', type=int, default=2,
+                            help="lines already in each shopper's cart (default %(default)s)")
+        parser.add_argument('--picks', type=int, default=3,
+                            help="items viewed and added per journey (default %(default)s)")
+        parser.add_argument('--journeys', type=int, default=3,
+                            help="journeys per shopper (default %(default)s)")
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help="shoppers at a time (default %(default)s); SQLite "
+                                 "fails some writes under contention, use PostgreSQL")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline',
+                            help="fail if the run regresses against this baseline file")
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help="allowed p50 slowdown against the baseline, as a "
+                                 "fraction (default %(default)s)")
+        parser.add_argument('--save-baseline', metavar='PATH',
+                            help="write this run's results as a baseline")
+
+    def handle(self, *args, **kwargs):
+        params = {name: kwargs[name] for name in
+                  ('items', 'users', 'cart_lines', 'picks', 'journeys',
+                   'concurrency', 'seed')}
+        baseline = kwargs['baseline'] and benchmark.load_baseline(kwargs['baseline'])
+        if baseline and baseline['params'] != params:
+            self.stdout.write(self.style.WARNING(
+                'The baseline was recorded with different options: %s' % baseline['params']))
+
+        setup_test_environment(debug=False)
+        try:
+            with override_settings(**BENCHMARK_SETTINGS), tempfile.TemporaryDirectory() as tmp:
+                report = self.run(params, tmp)
+        finally:
+            teardown_test_environment()
+
+        self.stdout.write(report.table())
+        summary = report.summary()
+        if kwargs['save_baseline']:
+            benchmark.save_baseline(kwargs['save_baseline'], summary, params)
+            self.stdout.write(self.style.SUCCESS(
+                'Saved the baseline to %s' % kwargs['save_baseline']))
+        if baseline:
+            regressions = benchmark.compare(summary, baseline, kwargs['tolerance'])
+            if regressions:
+                raise CommandError('Regressed against the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
+
+    def run(self, params, tmp):
+        if connection.vendor == 'sqlite' and params['concurrency'] > 1:
+            # an in-memory test database fails competing writers outright,
+            # a file makes them wait for the lock
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tmp, 'benchmark.sqlite3')
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            self.stdout.write('Seeding %(items)s items and %(users)s shoppers...' % params)
+            seed.seed_items(params['items'], seed=params['seed'])
+            users = seed.seed_users(params['users'])
+            seed.seed_carts(users, Item.objects.all(), params['cart_lines'],
+                            seed=params['seed'])
+            return benchmark.run_benchmark(
+                users.order_by('pk'), journeys=params['journeys'],
+                concurrency=params['concurrency'], picks=params['picks'],
+                seed=params['seed'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import cleanup
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned carts and cart lines that belong to no order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=cleanup.CART_MAX_AGE,
+                            help="days a cart may go untouched (default %(default)s)")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="rows deleted per transaction (default %(default)s)")
+        parser.add_argument('--sleep', type=float, default=0,
+                            help="seconds to pause between batches")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="count what would be deleted without deleting it")
+
+    def handle(self, *args, **kwargs):
+        days, batch_size = kwargs['days'], kwargs['batch_size']
+        dry_run, pause = kwargs['dry_run'], kwargs['sleep']
+        verb = 'Would delete' if dry_run else 'Deleted'
+
+        carts = lines = 0
+        for pks in cleanup.batches(cleanup.stale_carts(days), batch_size):
+            if dry_run:
+                carts += len(pks)
+            else:
+                deleted_carts, deleted_lines = cleanup.delete_carts(pks, days)
+                carts += deleted_carts
+                lines += deleted_lines
+            self.stdout.write('%s %s cart(s) so far, up to #%s' % (verb, carts, pks[-1]))
+            time.sleep(pause)
+
+        orphans = 0
+        for pks in cleanup.batches(cleanup.orphan_lines(), batch_size):
+            orphans += len(pks) if dry_run else cleanup.delete_lines(pks)
+            self.stdout.write('%s %s orphaned line(s) so far, up to #%s' % (verb, orphans, pks[-1]))
+            time.sleep(pause)
+
+        if dry_run:
+            self.stdout.write(self.style.SUCCESS(
+                '%s %s cart(s) and %s orphaned line(s)' % (verb, carts, orphans)))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                '%s %s cart(s) with %s line(s), and %s orphaned line(s)'
+                % (verb, carts, lines, orphans)))
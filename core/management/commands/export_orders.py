@@ -0,0 +1,41 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import exports
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"'{value}' isn't a YYYY-MM-DD date")
+
+
+class Command(BaseCommand):
+    help = 'Export placed orders with their payments, coupons, addresses and lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(exports.EXPORTS), default='csv')
+        parser.add_argument('--since', type=parse_date,
+                            help="first day to export, YYYY-MM-DD")
+        parser.add_argument('--until', type=parse_date,
+                            help="last day to export, YYYY-MM-DD")
+        parser.add_argument('--output', '-o',
+                            help="file to write, standard output by default")
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE,
+                            help="rows fetched from the database at a time "
+                                 "(default %(default)s)")
+
+    def handle(self, *args, **kwargs):
+        export, _ = exports.EXPORTS[kwargs['format']]
+        orders = exports.orders_between(kwargs['since'], kwargs['until'])
+        chunks = export(orders, kwargs['chunk_size'])
+        if kwargs['output']:
+            # csv.writer ends rows with \r\n itself
+            with open(kwargs['output'], 'w', newline='') as f:
+                f.writelines(chunks)
+            self.stderr.write(self.style.SUCCESS('Exported orders to %s' % kwargs['output']))
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,63 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import importer
+from core.services import refresh_catalogue
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+class Command(BaseCommand):
+    help = ('Create or update items from a CSV or JSON Lines catalogue keyed on '
+            'slug, making resized renditions of their images')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="the catalogue file, - for standard input")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help="csv or jsonl, by default from the file extension")
+        parser.add_argument('--images-dir',
+                            help="directory the catalogue's image paths are relative "
+                                 "to, for images not in media storage yet")
+        parser.add_argument('--batch-size', type=int, default=importer.BATCH_SIZE,
+                            help="items written per transaction (default %(default)s)")
+        parser.add_argument('--workers', type=int,
+                            help="processes making image renditions (default: one per CPU)")
+        parser.add_argument('--skip-images', action='store_true',
+                            help="don't make image renditions")
+
+    def handle(self, *args, **kwargs):
+        path = kwargs['path']
+        format = kwargs['format'] or FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise CommandError("Can't tell the format from the file name, pass --format")
+
+        job = importer.Importer(
+            images_dir=kwargs['images_dir'], workers=kwargs['workers'],
+            batch_size=kwargs['batch_size'], make_images=not kwargs['skip_images'])
+        verbosity = kwargs['verbosity']
+
+        def progress(job):
+            if verbosity > 1:
+                self.stdout.write('%s created, %s updated, %s errors' % (
+                    job.created, job.updated, len(job.errors)))
+
+        f = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        try:
+            with job:
+                job.run(importer.read_rows(f, format), progress)
+        except importer.RowError as e:
+            raise CommandError(str(e))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            # the items were bulk written, without the model signals
+            if job.created or job.updated:
+                refresh_catalogue()
+
+        for error in job.errors:
+            self.stderr.write(str(error))
+        self.stdout.write(self.style.SUCCESS(
+            'Created %s and updated %s item(s), with %s image(s) and %s error(s)'
+            % (job.created, job.updated, job.images, len(job.errors))))
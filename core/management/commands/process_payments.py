@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.jobs import process_payment_jobs
+
+
+class Command(BaseCommand):
+    help = 'Charge queued payments and finalize their orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="drain the queue and exit instead of polling")
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help="seconds to wait between polls of an empty queue")
+
+    def handle(self, *args, **kwargs):
+        while True:
+            processed = process_payment_jobs()
+            if processed:
+                self.stdout.write(self.style.SUCCESS(
+                    'Processed %s payment job(s)' % processed))
+            if kwargs['once']:
+                break
+            if not processed:
+                time.sleep(kwargs['sleep'])
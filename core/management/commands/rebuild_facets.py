@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.cache import bump_catalogue_version
+from core.facets import rebuild_facets
+
+
+class Command(BaseCommand):
+    help = 'Recount the category, label and price facets from the catalogue'
+
+    def handle(self, *args, **kwargs):
+        rebuild_facets()
+        bump_catalogue_version()
+        self.stdout.write(self.style.SUCCESS('Rebuilt facet counts'))
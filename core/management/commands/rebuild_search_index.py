@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index from the catalogue'
+
+    def handle(self, *args, **kwargs):
+        rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Rebuilt the search index'))
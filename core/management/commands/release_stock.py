@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core.inventory import RESERVATION_TIMEOUT, release_expired
+
+
+class Command(BaseCommand):
+    help = 'Return the stock held by checkouts abandoned before payment'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int, default=RESERVATION_TIMEOUT // 60,
+                            help="minutes a checkout may hold stock (default %(default)s)")
+
+    def handle(self, *args, **kwargs):
+        released = release_expired(kwargs['timeout'] * 60)
+        self.stdout.write(self.style.SUCCESS(
+            'Released stock from %s abandoned checkout(s)' % released))
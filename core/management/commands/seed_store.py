@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from core.seed import BATCH_SIZE, StorePlan, seed_store
+
+
+class Command(BaseCommand):
+    help = ('Fill the database with a synthetic store: items, customers with '
+            'addresses, and their orders, lines and payments')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=10000,
+                            help="items to create, 0 to order from the existing "
+                                 "catalogue (default %(default)s)")
+        parser.add_argument('--customers', type=int, default=10000,
+                            help="customers to create (default %(default)s)")
+        parser.add_argument('--max-orders', type=int, default=5,
+                            help="most orders per customer (default %(default)s)")
+        parser.add_argument('--max-lines', type=int, default=5,
+                            help="most lines per order (default %(default)s)")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="the same seed generates the same store (default %(default)s)")
+        parser.add_argument('--prefix', default='seed',
+                            help="prefix for the generated usernames, slugs and references")
+        parser.add_argument('--chunk-size', type=int, default=BATCH_SIZE,
+                            help="items or customers written per transaction "
+                                 "(default %(default)s)")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="processes writing chunks in parallel (default "
+                                 "%(default)s); worth it on PostgreSQL, SQLite takes "
+                                 "one writer at a time")
+
+    def handle(self, *args, **kwargs):
+        plan = StorePlan(
+            kwargs['items'], kwargs['customers'], kwargs['max_orders'],
+            kwargs['max_lines'], seed=kwargs['seed'], prefix=kwargs['prefix'],
+            chunk_size=kwargs['chunk_size'])
+        verbosity = kwargs['verbosity']
+        workers = kwargs['workers']
+        if workers > 1 and connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING(
+                'SQLite takes one writer at a time, ignoring --workers'))
+            workers = 1
+
+        def progress(totals, seconds):
+            if verbosity > 1:
+                self.stdout.write('%.1fs: %s' % (seconds, format_counts(totals)))
+
+        totals = seed_store(plan, workers=workers, progress=progress)
+        self.stdout.write(self.style.SUCCESS('Created %s' % format_counts(totals)))
+
+
+def format_counts(totals):
+    return ', '.join('%s %s' % (count, name) for name, count in totals.items())
@@ -0,0 +1,225 @@
+"""Request instrumentation for production.
+
+`RequestMetricsMiddleware` records, for every request, how many queries it
+ran and how long they took, how long its templates took to render (through
+the `DjangoTemplates` backend below), the response size and the total
+time. Each request is logged to the 'core.metrics' logger, a warning is
+logged when a view runs more queries than its budget (settings.QUERY_BUDGET,
+or VIEW_QUERY_BUDGETS by view name), and per-view totals are served in the
+Prometheus text format by `metrics_view`.
+
+Totals are kept per process, so with several workers each one is scraped
+(or reports) its own.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends import django as django_backend
+from django.utils.crypto import constant_time_compare
+
+logger = logging.getLogger('core.metrics')
+
+_local = threading.local()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self._rendering = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # a connection execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+def current_metrics():
+    """The metrics of the request being handled on this thread, if any."""
+    return getattr(_local, 'metrics', None)
+
+
+class TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        metrics = current_metrics()
+        if metrics is None:
+            return self.template.render(context, request)
+        # a template rendered from inside another one is already timed
+        metrics._rendering += 1
+        start = time.perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            metrics._rendering -= 1
+            if not metrics._rendering:
+                metrics.render_time += time.perf_counter() - start
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing renders for the request metrics."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+class Registry:
+    """Per-view running totals."""
+
+    FIELDS = ['requests', 'queries', 'db_seconds', 'render_seconds',
+              'duration_seconds', 'response_bytes', 'over_query_budget']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.views = defaultdict(lambda: dict.fromkeys(self.FIELDS, 0))
+
+    def record(self, view, **values):
+        with self._lock:
+            totals = self.views[view]
+            totals['requests'] += 1
+            for field, value in values.items():
+                totals[field] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {view: dict(totals) for view, totals in self.views.items()}
+
+    def clear(self):
+        with self._lock:
+            self.views.clear()
+
+
+registry = Registry()
+
+PROMETHEUS_METRICS = [
+    ('requests', 'ecommerce_view_requests_total', 'Requests handled.'),
+    ('queries', 'ecommerce_view_queries_total', 'Database queries run.'),
+    ('db_seconds', 'ecommerce_view_db_seconds_total', 'Time spent in the database.'),
+    ('render_seconds', 'ecommerce_view_render_seconds_total', 'Time spent rendering templates.'),
+    ('duration_seconds', 'ecommerce_view_duration_seconds_total', 'Time spent handling requests.'),
+    ('response_bytes', 'ecommerce_view_response_bytes_total', 'Response body bytes sent.'),
+    ('over_query_budget', 'ecommerce_view_over_query_budget_total',
+     'Requests that ran more queries than the view budget.'),
+]
+
+
+def query_budget(view):
+    return getattr(settings, 'VIEW_QUERY_BUDGETS', {}).get(
+        view, getattr(settings, 'QUERY_BUDGET', None))
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    # unresolved requests (404s, static files) are lumped together so stray
+    # urls can't grow the registry
+    return match.view_name if match is not None else '<unresolved>'
+
+
+def response_size(response):
+    if response.streaming:
+        return 0
+    return len(response.content)
+
+
+class RequestMetricsMiddleware:
+    """Put this first in MIDDLEWARE so the queries of the other middleware
+    count towards the request too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = _local.metrics = RequestMetrics()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _local.metrics = None
+        duration = time.perf_counter() - start
+
+        view = view_name(request)
+        size = response_size(response)
+        budget = query_budget(view)
+        over_budget = budget is not None and metrics.queries > budget
+        registry.record(
+            view,
+            queries=metrics.queries,
+            db_seconds=metrics.db_time,
+            render_seconds=metrics.render_time,
+            duration_seconds=duration,
+            response_bytes=size,
+            over_query_budget=int(over_budget),
+        )
+
+        record = {
+            'view': view,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': metrics.queries,
+            'db_ms': round(metrics.db_time * 1000, 1),
+            'render_ms': round(metrics.render_time * 1000, 1),
+            'total_ms': round(duration * 1000, 1),
+            'bytes': size,
+        }
+        message = ' '.join(f'{key}={value}' for key, value in record.items())
+        if over_budget:
+            logger.warning('over query budget (%s) %s', budget, message,
+                           extra={'metrics': record})
+        else:
+            logger.info(message, extra={'metrics': record})
+        return response
+
+
+def escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render_prometheus(views):
+    lines = []
+    for field, name, help_text in PROMETHEUS_METRICS:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for view, totals in sorted(views.items()):
+            lines.append(f'{name}{{view="{escape_label(view)}"}} {totals[field]}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    """Per-view totals for Prometheus. Scrapers send
+    `Authorization: Bearer <settings.METRICS_TOKEN>`; without a token set
+    only staff can read them.
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        allowed = constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(registry.snapshot()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,70 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:05
+
+from django.db import migrations, models
+
+
+def dedupe_item_slugs(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    seen = set()
+    for item in Item.objects.order_by('pk'):
+        if item.slug in seen:
+            item.slug = f'{item.slug}-{item.pk}'
+            item.save(update_fields=['slug'])
+        seen.add(item.slug)
+
+
+def null_blank_ref_codes(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    Order.objects.filter(ref_code='').update(ref_code=None)
+
+
+def merge_open_carts(apps, schema_editor):
+    # fold any extra open carts into the user's oldest one
+    Order = apps.get_model('core', 'Order')
+    keep = {}
+    for order in Order.objects.filter(ordered=False).order_by('pk'):
+        if order.user_id not in keep:
+            keep[order.user_id] = order
+            continue
+        keep[order.user_id].items.add(*order.items.all())
+        order.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='address',
+            options={'verbose_name_plural': 'Addresses'},
+        ),
+        migrations.RunPython(dedupe_item_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='item',
+            name='slug',
+            field=models.SlugField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.RunPython(null_blank_ref_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='order',
+            name='ref_code',
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(ordered=False), fields=['user', 'item'], name='orderitem_open_line_idx'),
+        ),
+        migrations.RunPython(merge_open_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(ordered=False), fields=('user',), name='order_one_open_cart_per_user'),
+        ),
+    ]
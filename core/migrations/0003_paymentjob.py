@@ -0,0 +1,35 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:08
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0002_indexes_and_constraints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=100)),
+                ('amount', models.FloatField()),
+                ('status', models.CharField(choices=[('P', 'pending'), ('R', 'running'), ('S', 'succeeded'), ('F', 'failed')], default='P', max_length=1)),
+                ('error', models.CharField(blank=True, max_length=255)),
+                ('attempts', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_jobs', to='core.Order')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='paymentjob',
+            index=models.Index(fields=['status', 'created'], name='paymentjob_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_paymentjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentjob',
+            name='gateway',
+            field=models.CharField(default='stripe', max_length=20),
+        ),
+    ]
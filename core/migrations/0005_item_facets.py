@@ -0,0 +1,64 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:15
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Case, CharField, Count, F, Value, When
+from django.db.models.functions import Coalesce, NullIf
+
+# as they were when this migration was written, see core.models
+PRICE_RANGES = ((0, 25), (25, 50), (50, 100), (100, None))
+
+
+def count_facets(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    FacetCount = apps.get_model('core', 'FacetCount')
+    counts = Counter()
+    items = Item.objects.order_by()
+    for field in ('catagory', 'label'):
+        for row in items.values(field).annotate(count=Count('id')):
+            counts[(field, row[field])] = row['count']
+    price_range = Case(
+        *[When(effective__lt=high, then=Value(f'{low}-{high}'))
+          for low, high in PRICE_RANGES if high is not None],
+        default=Value('100-'), output_field=CharField())
+    prices = (items.annotate(effective=Coalesce(NullIf('discount_price', Value(0.0)), F('price')))
+              .annotate(price_range=price_range)
+              .values('price_range').annotate(count=Count('id')))
+    for row in prices:
+        counts[('price', row['price_range'])] = row['count']
+    FacetCount.objects.bulk_create(
+        FacetCount(facet=facet, value=value, count=count)
+        for (facet, value), count in counts.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_paymentjob_gateway'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(choices=[('catagory', 'Category'), ('label', 'Label'), ('price', 'Price')], max_length=10)),
+                ('value', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['catagory', 'id'], name='item_catagory_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['label', 'id'], name='item_label_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='facetcount',
+            constraint=models.UniqueConstraint(fields=('facet', 'value'), name='facetcount_unique_value'),
+        ),
+        migrations.RunPython(count_facets, migrations.RunPython.noop),
+    ]
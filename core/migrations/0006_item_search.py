@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# the schema as core.search had it when this migration was written
+CREATE = {
+    'postgresql': [
+        "CREATE TABLE core_item_search ("
+        "item_id integer PRIMARY KEY REFERENCES core_item (id) "
+        "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+        "document tsvector NOT NULL)",
+        "CREATE INDEX core_item_search_idx ON core_item_search USING GIN (document)",
+        "INSERT INTO core_item_search (item_id, document) SELECT id, "
+        "setweight(to_tsvector('english', title), 'A') || "
+        "setweight(to_tsvector('english', description), 'B') FROM core_item",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE core_item_fts USING fts5("
+        "title, description, tokenize = 'porter unicode61')",
+        "INSERT INTO core_item_fts (rowid, title, description) "
+        "SELECT id, title, description FROM core_item",
+    ],
+}
+
+DROP = {
+    'postgresql': ["DROP TABLE IF EXISTS core_item_search"],
+    'sqlite': ["DROP TABLE IF EXISTS core_item_fts"],
+}
+
+
+def create_search_index(apps, schema_editor):
+    for sql in CREATE.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    for sql in DROP.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_item_facets'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:20
+
+from django.db import migrations, models
+from django.db.models import Case, CharField, Count, F, Value, When
+from django.db.models.functions import Coalesce, NullIf
+
+
+def fill_effective_price(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    Item.objects.update(effective_price=Coalesce(
+        NullIf(F('discount_price'), Value(0)), F('price')))
+
+
+# as they were when this migration was written, see core.models
+PRICE_RANGES = ((0, 25), (25, 50), (50, 100), (100, None))
+
+
+def count_prices(apps, schema_editor):
+    # the price facet now counts the stored price; the others are unchanged
+    Item = apps.get_model('core', 'Item')
+    FacetCount = apps.get_model('core', 'FacetCount')
+    price_range = Case(
+        *[When(effective_price__lt=high, then=Value(f'{low}-{high}'))
+          for low, high in PRICE_RANGES if high is not None],
+        default=Value('100-'), output_field=CharField())
+    prices = (Item.objects.order_by().annotate(price_range=price_range)
+              .values('price_range').annotate(count=Count('id')))
+    FacetCount.objects.filter(facet='price').delete()
+    FacetCount.objects.bulk_create(
+        FacetCount(facet='price', value=row['price_range'], count=row['count'])
+        for row in prices)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_item_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='discount_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='item',
+            name='price',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='paymentjob',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.RunPython(fill_effective_price, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['effective_price', 'id'], name='item_price_idx'),
+        ),
+        migrations.RunPython(count_prices, migrations.RunPython.noop),
+    ]
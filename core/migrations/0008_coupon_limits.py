@@ -0,0 +1,77 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:28
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def dedupe_coupon_codes(apps, schema_editor):
+    # the oldest coupon keeps the code, later copies get their pk appended
+    Coupon = apps.get_model('core', 'Coupon')
+    seen = set()
+    for coupon in Coupon.objects.order_by('pk'):
+        if coupon.code in seen:
+            suffix = f'-{coupon.pk}'
+            coupon.code = coupon.code[:15 - len(suffix)] + suffix
+            coupon.save(update_fields=['code'])
+        seen.add(coupon.code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0007_decimal_prices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses_per_user',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='uses',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_from',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='valid_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='paymentjob',
+            name='coupon',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.Coupon'),
+        ),
+        migrations.RunPython(dedupe_coupon_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='coupon',
+            name='code',
+            field=models.CharField(max_length=15, unique=True),
+        ),
+        migrations.CreateModel(
+            name='CouponUse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uses', models.PositiveIntegerField(default=0)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_uses', to='core.Coupon')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='couponuse',
+            constraint=models.UniqueConstraint(fields=('coupon', 'user'), name='couponuse_unique_user'),
+        ),
+    ]
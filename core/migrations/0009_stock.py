@@ -0,0 +1,32 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_coupon_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='stock',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='reserved_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='reserved',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(ordered=False), fields=['reserved_at'], name='order_open_reserved_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:33
+
+from django.db import migrations, models
+
+
+def fill_updated(apps, schema_editor):
+    # existing carts were last touched no later than we can tell
+    Order = apps.get_model('core', 'Order')
+    Order.objects.update(updated=models.F('start_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_stock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(fill_updated, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(ordered=False), fields=['updated'], name='order_open_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_order_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_item_image_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentjob',
+            name='charge_id',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
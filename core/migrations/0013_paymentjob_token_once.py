@@ -0,0 +1,26 @@
+# Generated by Django 3.0.8 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_paymentjob_charge_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='stripe_charge_id',
+            field=models.CharField(db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='paymentjob',
+            index=models.Index(fields=['token'], name='paymentjob_token_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='paymentjob',
+            constraint=models.UniqueConstraint(condition=models.Q(_negated=True, status='F'), fields=('gateway', 'token'), name='paymentjob_token_once'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.8 on 2026-10-18 21:05
+
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def date_from_payment(apps, schema_editor):
+    # ordered_date was left at the cart's creation, use when it was paid for
+    Order = apps.get_model('core', 'Order')
+    Payment = apps.get_model('core', 'Payment')
+    paid_at = Payment.objects.filter(pk=OuterRef('payment_id')).values('timestamp')
+    Order.objects.filter(ordered=True, payment__isnull=False).update(
+        ordered_date=Subquery(paid_at))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_paymentjob_token_once'),
+    ]
+
+    operations = [
+        migrations.RunPython(date_from_payment, migrations.RunPython.noop),
+    ]
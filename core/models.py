@@ -1,4 +1,8 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.shortcuts import reverse
 from django_countries.fields import CountryField
@@ -21,20 +25,101 @@ ADDRESS_CHOICES = (
     ('S', 'shipping')
 )
 
+FACET_CHOICES = (
+    ('catagory', 'Category'),
+    ('label', 'Label'),
+    ('price', 'Price')
+)
+
+# (low, high) bounds of the price facet buckets, high is exclusive
+PRICE_RANGES = (
+    (0, 25),
+    (25, 50),
+    (50, 100),
+    (100, None)
+)
+
+PAYMENT_JOB_STATUS_CHOICES = (
+    ('P', 'pending'),
+    ('R', 'running'),
+    ('S', 'succeeded'),
+    ('F', 'failed')
+)
+
 
 class Item(models.Model):
     title = models.CharField(max_length=100)
     image = models.ImageField()
-    price = models.FloatField()
-    discount_price = models.FloatField(blank=True, null=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    discount_price = models.DecimalField(max_digits=10, decimal_places=2,
+                                         blank=True, null=True)
+    # what a customer pays for one, kept in step with the prices by save()
+    effective_price = models.DecimalField(max_digits=10, decimal_places=2,
+                                          editable=False)
     catagory = models.CharField(choices=CATAGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=2)
-    slug = models.SlugField()
+    slug = models.SlugField(unique=True)
     description = models.TextField()
+    # units on hand, blank for items that aren't stock tracked
+    stock = models.PositiveIntegerField(blank=True, null=True)
+    # content hash naming the image's resized renditions, see core.images
+    image_hash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # filtered listings walk these newest first
+            models.Index(fields=['catagory', 'id'], name='item_catagory_idx'),
+            models.Index(fields=['label', 'id'], name='item_label_idx'),
+            # price sorted listings and price range filters
+            models.Index(fields=['effective_price', 'id'], name='item_price_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remembered so a save can move the item between facet counts
+        instance._loaded_facets = instance.get_facets()
+        if 'image' in field_names:
+            instance._loaded_image = instance.image.name
+        return instance
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        self.effective_price = self.get_effective_price()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'price', 'discount_price'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'effective_price'}
+        loaded_image = getattr(self, '_loaded_image', None)
+        saves_image = update_fields is None or 'image' in update_fields
+        if saves_image and loaded_image is not None and (
+                self.image.name != loaded_image or not self.image._committed):
+            # the renditions were of the old image
+            self.image_hash = ''
+            if update_fields is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'image_hash'}
+        super().save(*args, **kwargs)
+        if loaded_image is not None:
+            self._loaded_image = self.image.name
+
+    def get_effective_price(self):
+        # a zero discount price means there's no discount
+        return self.discount_price or self.price
+
+    def get_facets(self):
+        """The (facet, value) pairs this item is counted under, or None if
+        some of the fields they need were deferred.
+        """
+        deferred = self.get_deferred_fields()
+        if deferred & {'catagory', 'label', 'effective_price'}:
+            return None
+        return {
+            ('catagory', self.catagory),
+            ('label', self.label),
+            ('price', price_range_value(self.effective_price)),
+        }
+
     def get_absolute_url(self):
         return reverse("core:product", kwargs={"slug": self.slug})
 
@@ -45,6 +130,39 @@ class Item(models.Model):
         return reverse("core:remove_from_cart", kwargs={"slug": self.slug})
 
 
+def price_range_value(price):
+    for low, high in PRICE_RANGES:
+        if high is None or price < high:
+            return f'{low}-{high or ""}'
+
+
+class MoneyField(models.DecimalField):
+    """Output field for price arithmetic. SQLite hands computed decimals
+    back unquantized ('77.5'), so round them to cents like PostgreSQL does.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return Decimal(value).quantize(Decimal('0.01'))
+
+
+def money_field():
+    return MoneyField(max_digits=12, decimal_places=2)
+
+
+class OrderItemQuerySet(models.QuerySet):
+    def with_prices(self):
+        return self.annotate(
+            final_price=models.ExpressionWrapper(
+                F('quantity') * F('item__effective_price'),
+                output_field=money_field()),
+            amount_saved=models.ExpressionWrapper(
+                F('quantity') * (F('item__price') - F('item__effective_price')),
+                output_field=money_field()),
+        )
+
+
 class OrderItem(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
@@ -53,6 +171,18 @@ class OrderItem(models.Model):
     item = models.ForeignKey(Item,
                              on_delete=models.CASCADE)
     quantity = models.IntegerField(default=1)
+    # units taken out of the item's stock for this line at checkout
+    reserved = models.PositiveIntegerField(default=0)
+
+    objects = OrderItemQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the cart views look up a user's open line for an item
+            models.Index(fields=['user', 'item'],
+                         condition=models.Q(ordered=False),
+                         name='orderitem_open_line_idx'),
+        ]
 
     def __str__(self):
         return f'{self.item.title} of {self.quantity}'
@@ -64,18 +194,53 @@ class OrderItem(models.Model):
         return self.quantity * self.item.discount_price
 
     def get_amount_save(self):
-        return self.get_total_item_price() - self.get_total_discount_price()
+        if hasattr(self, 'amount_saved'):
+            return self.amount_saved
+        return self.get_total_item_price() - self.get_final_price()
 
     def get_final_price(self):
-        if self.item.discount_price:
-            return self.get_total_discount_price()
-        return self.get_total_item_price()
+        if hasattr(self, 'final_price'):
+            return self.final_price
+        return self.quantity * self.item.effective_price
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        # one GROUP BY over the order lines instead of summing in python;
+        # don't chain filters across `items` after this or rows get counted twice
+        unit_price = F('items__item__effective_price')
+        zero = Value(0, output_field=money_field())
+        return self.annotate(
+            subtotal=Coalesce(
+                Sum(F('items__quantity') * unit_price, output_field=money_field()),
+                zero),
+            savings=Coalesce(
+                Sum(F('items__quantity') * (F('items__item__price') - unit_price),
+                    output_field=money_field()),
+                zero),
+        ).annotate(
+            total=models.ExpressionWrapper(
+                F('subtotal') - Coalesce(F('coupon__amount'), zero,
+                                         output_field=money_field()),
+                output_field=money_field()),
+        )
+
+    def with_cart_items(self):
+        # fetch the order lines and their items up front so templates that
+        # walk `order.items.all` don't query once per row
+        return self.select_related('coupon').prefetch_related(
+            models.Prefetch('items',
+                            queryset=OrderItem.objects.select_related('item').with_prices())
+        )
+
+    def get_cart(self, user):
+        return self.with_totals().with_cart_items().get(user=user, ordered=False)
 
 
 class Order(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
-    ref_code = models.CharField(max_length=20)
+    ref_code = models.CharField(max_length=20, unique=True, null=True, blank=True)
     items = models.ManyToManyField(OrderItem)
     start_date = models.DateTimeField(auto_now_add=True)
     ordered_date = models.DateTimeField()
@@ -94,6 +259,26 @@ class Order(models.Model):
     received = models.BooleanField(default=False)
     refund_requested = models.BooleanField(default=False)
     refund_granted = models.BooleanField(default=False)
+    # when the lines' stock was reserved, for expiring abandoned checkouts
+    reserved_at = models.DateTimeField(null=True, blank=True)
+    # roughly when the cart was last touched, see `get_cart_for_update`
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = OrderQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['reserved_at'], condition=models.Q(ordered=False),
+                         name='order_open_reserved_idx'),
+            models.Index(fields=['updated'], condition=models.Q(ordered=False),
+                         name='order_open_updated_idx'),
+        ]
+        constraints = [
+            # also serves as the index for the `user=..., ordered=False` cart lookup
+            models.UniqueConstraint(fields=['user'],
+                                    condition=models.Q(ordered=False),
+                                    name='order_one_open_cart_per_user'),
+        ]
 
     # 1. Item added to cart
     # 2. Adding a billing address
@@ -108,6 +293,8 @@ class Order(models.Model):
         return self.user.username
 
     def get_total_price(self):
+        if hasattr(self, 'total'):
+            return self.total
         total = 0
         for orderitem in self.items.all():
             total += orderitem.get_final_price()
@@ -134,24 +321,116 @@ class Address(models.Model):
 
 
 class Payment(models.Model):
-    stripe_charge_id = models.CharField(max_length=100)
+    stripe_charge_id = models.CharField(max_length=100, db_index=True)
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.SET_NULL, blank=True, null=True)
-    amount = models.FloatField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
     timestamp = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.user.username
 
 
+class PaymentJob(models.Model):
+    PENDING = 'P'
+    RUNNING = 'R'
+    SUCCEEDED = 'S'
+    FAILED = 'F'
+    IN_FLIGHT = (PENDING, RUNNING)
+
+    order = models.ForeignKey(Order, related_name='payment_jobs',
+                              on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    gateway = models.CharField(max_length=20, default='stripe')
+    token = models.CharField(max_length=100)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # set once the charge goes through, so it isn't taken twice
+    charge_id = models.CharField(max_length=100, blank=True)
+    # the coupon use claimed for this charge, released if it fails
+    coupon = models.ForeignKey('Coupon', on_delete=models.SET_NULL,
+                               blank=True, null=True)
+    status = models.CharField(max_length=1, choices=PAYMENT_JOB_STATUS_CHOICES,
+                              default=PENDING)
+    error = models.CharField(max_length=255, blank=True)
+    attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # the worker polls for the oldest pending jobs
+            models.Index(fields=['status', 'created'],
+                         name='paymentjob_queue_idx'),
+            models.Index(fields=['token'], name='paymentjob_token_idx'),
+        ]
+        constraints = [
+            # a token pays for one order; `jobs.enqueue_payment` refuses
+            # the failed ones' too, this catches racing submits
+            models.UniqueConstraint(fields=['gateway', 'token'],
+                                    condition=~models.Q(status='F'),
+                                    name='paymentjob_token_once'),
+        ]
+
+    def __str__(self):
+        return f'{self.order_id} ({self.get_status_display()})'
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+
+class FacetCount(models.Model):
+    """How many items have each category, label and price range, kept up to
+    date by signals so listing filters never GROUP BY the catalogue.
+    """
+    facet = models.CharField(max_length=10, choices=FACET_CHOICES)
+    value = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['facet', 'value'],
+                                    name='facetcount_unique_value'),
+        ]
+
+    def __str__(self):
+        return f'{self.facet}={self.value}: {self.count}'
+
+
 class Coupon(models.Model):
-    code = models.CharField(max_length=15)
-    amount = models.FloatField()
+    code = models.CharField(max_length=15, unique=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    valid_from = models.DateTimeField(blank=True, null=True)
+    valid_until = models.DateTimeField(blank=True, null=True)
+    # blank for no limit
+    max_uses = models.PositiveIntegerField(blank=True, null=True)
+    max_uses_per_user = models.PositiveIntegerField(blank=True, null=True)
+    # claimed when a payment is queued, given back if it fails
+    uses = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.code
 
 
+class CouponUse(models.Model):
+    """How many times a user has claimed a coupon, for `max_uses_per_user`."""
+    coupon = models.ForeignKey(Coupon, related_name='user_uses',
+                               on_delete=models.CASCADE)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    uses = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['coupon', 'user'],
+                                    name='couponuse_unique_user'),
+        ]
+
+    def __str__(self):
+        return f'{self.coupon} used by {self.user} ({self.uses})'
+
+
 class Refund(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     reason = models.TextField()
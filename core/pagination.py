@@ -0,0 +1,92 @@
+from django.db.models import Q
+
+
+class KeysetPage:
+    def __init__(self, object_list, before, after):
+        self.object_list = object_list
+        # cursors for the neighbouring pages, None when there isn't one
+        self.before = before
+        self.after = after
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_previous(self):
+        return self.before is not None
+
+    @property
+    def has_next(self):
+        return self.after is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+
+class KeysetPaginator:
+    """Paginate by primary key (newest first by default), or by another
+    column with the primary key breaking ties, without OFFSET or COUNT(*).
+
+    A page is addressed by the pk just outside it (`after` for the next page,
+    `before` for the previous one), so fetching any page is one range scan
+    of per_page + 1 rows on an index over (`field`, pk) however deep it is.
+    """
+
+    def __init__(self, queryset, per_page, field='pk', descending=True):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.field = field
+        self.descending = descending
+
+    def ordered(self, backwards=False):
+        # returns the queryset sorted in walking order and whether that's
+        # descending
+        descending = self.descending != backwards
+        prefix = '-' if descending else ''
+        fields = ['pk'] if self.field == 'pk' else [self.field, 'pk']
+        return self.queryset.order_by(*(prefix + f for f in fields)), descending
+
+    def past(self, queryset, pk, descending):
+        """Rows of `queryset` that come after the row `pk` when walking in
+        `descending` order.
+        """
+        lookup = 'lt' if descending else 'gt'
+        if self.field == 'pk':
+            return queryset.filter(**{f'pk__{lookup}': pk})
+        value = (self.queryset.model._default_manager.filter(pk=pk)
+                 .values_list(self.field, flat=True).first())
+        if value is None:
+            # the cursor row has gone away since the link was rendered
+            return queryset.none()
+        return queryset.filter(
+            Q(**{f'{self.field}__{lookup}': value})
+            | Q(**{self.field: value, f'pk__{lookup}': pk}))
+
+    def page(self, after=None, before=None):
+        if before is not None:
+            # walk back up the index, then restore page order
+            queryset, descending = self.ordered(backwards=True)
+            rows = list(self.past(queryset, before, descending)[:self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_previous, has_next = more, True
+        else:
+            queryset, descending = self.ordered()
+            if after is not None:
+                queryset = self.past(queryset, after, descending)
+            rows = list(queryset[:self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_previous, has_next = after is not None, more
+
+        if not rows:
+            return KeysetPage([], None, None)
+        return KeysetPage(
+            rows,
+            before=rows[0].pk if has_previous else None,
+            after=rows[-1].pk if has_next else None,
+        )
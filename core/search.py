@@ -0,0 +1,123 @@
+"""Full-text search over item titles and descriptions.
+
+PostgreSQL keeps a weighted tsvector per item in core_item_search behind a
+GIN index, SQLite keeps the same text in an FTS5 table, core_item_fts.
+Other databases fall back to icontains. The Item signals keep the index
+current; run `manage.py rebuild_search_index` after bulk changes.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Item
+
+POSTGRES_DOCUMENT = (
+    "setweight(to_tsvector('english', {title}), 'A') || "
+    "setweight(to_tsvector('english', {description}), 'B')"
+)
+
+REBUILD = {
+    'postgresql': [
+        "DELETE FROM core_item_search",
+        "INSERT INTO core_item_search (item_id, document) SELECT id, %s FROM core_item"
+        % POSTGRES_DOCUMENT.format(title='title', description='description'),
+    ],
+    'sqlite': [
+        "DELETE FROM core_item_fts",
+        "INSERT INTO core_item_fts (rowid, title, description) "
+        "SELECT id, title, description FROM core_item",
+    ],
+}
+
+INDEX = {
+    'postgresql': [
+        "INSERT INTO core_item_search (item_id, document) VALUES (%%s, %s) "
+        "ON CONFLICT (item_id) DO UPDATE SET document = EXCLUDED.document"
+        % POSTGRES_DOCUMENT.format(title='%s', description='%s'),
+    ],
+    'sqlite': [
+        "DELETE FROM core_item_fts WHERE rowid = %s",
+        "INSERT INTO core_item_fts (rowid, title, description) VALUES (%s, %s, %s)",
+    ],
+}
+
+UNINDEX = {
+    'postgresql': "DELETE FROM core_item_search WHERE item_id = %s",
+    'sqlite': "DELETE FROM core_item_fts WHERE rowid = %s",
+}
+
+# the best match first, newest first among equals
+SEARCH = {
+    'postgresql': (
+        "SELECT item_id FROM core_item_search, to_tsquery('english', %s) query "
+        "WHERE document @@ query "
+        "ORDER BY ts_rank(document, query) DESC, item_id DESC LIMIT %s OFFSET %s"
+    ),
+    'sqlite': (
+        "SELECT rowid FROM core_item_fts WHERE core_item_fts MATCH %s "
+        "ORDER BY bm25(core_item_fts, 10.0, 1.0), rowid DESC LIMIT %s OFFSET %s"
+    ),
+}
+
+MAX_TERMS = 10
+
+
+def rebuild_index():
+    with connection.cursor() as cursor:
+        for sql in REBUILD.get(connection.vendor, []):
+            cursor.execute(sql)
+
+
+def index_item(item):
+    if connection.vendor not in INDEX:
+        return
+    params = {
+        'postgresql': [[item.pk, item.title, item.description]],
+        'sqlite': [[item.pk], [item.pk, item.title, item.description]],
+    }[connection.vendor]
+    with connection.cursor() as cursor:
+        for sql, args in zip(INDEX[connection.vendor], params):
+            cursor.execute(sql, args)
+
+
+def unindex_item(pk):
+    if connection.vendor in UNINDEX:
+        with connection.cursor() as cursor:
+            cursor.execute(UNINDEX[connection.vendor], [pk])
+
+
+def search_terms(query):
+    # only plain words reach the backend's query syntax, each matched as a
+    # prefix so results show up while the last word is still being typed
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def search_ids(query, limit, offset=0):
+    """Return the pks of items matching every word in `query`, best
+    match first.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    if connection.vendor == 'postgresql':
+        match = ' & '.join(f'{term}:*' for term in terms)
+    elif connection.vendor == 'sqlite':
+        match = ' '.join(f'"{term}"*' for term in terms)
+    else:
+        items = Item.objects.all()
+        for term in terms:
+            items = items.filter(
+                Q(title__icontains=term) | Q(description__icontains=term))
+        return list(items.order_by('-pk')
+                    .values_list('pk', flat=True)[offset:offset + limit])
+    with connection.cursor() as cursor:
+        cursor.execute(SEARCH[connection.vendor], [match, limit, offset])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search_items(query, page=1, per_page=10):
+    """Return one page of matching items and whether there's another."""
+    pks = search_ids(query, per_page + 1, (page - 1) * per_page)
+    items = Item.objects.in_bulk(pks[:per_page])
+    return [items[pk] for pk in pks[:per_page] if pk in items], len(pks) > per_page
@@ -0,0 +1,332 @@
+"""Synthetic store data for benchmarks and local testing.
+
+Everything is generated from a `random.Random(seed)`, so the same seed
+gives the same catalogue, and is written with `bulk_create` in batches.
+Bulk creates skip the model signals, so the facet counts and the search
+index are rebuilt once at the end instead.
+
+`seed_store` generates a whole store (see the `seed_store` command). It
+works in chunks of customers, each with its own generator seeded from
+the chunk number, and gives rows explicit primary keys from a block
+reserved for the chunk. Rows can then point at each other without
+reading anything back, and chunks can be written in any order, by any
+number of processes, and come out the same.
+"""
+import io
+import multiprocessing
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import (CATAGORY_CHOICES, LABEL_CHOICES, Address, Item, Order,
+                     OrderItem, Payment)
+from .services import bulk_create_returning, refresh_catalogue
+
+BATCH_SIZE = 1000
+
+ADJECTIVES = ['classic', 'slim', 'relaxed', 'vintage', 'summer', 'winter',
+              'striped', 'plain', 'linen', 'denim', 'woollen', 'hooded']
+NOUNS = {
+    's': ['shirt', 'tee', 'polo', 'blouse', 'henley'],
+    'sw': ['jersey', 'track top', 'shorts', 'leggings', 'running vest'],
+    'ow': ['jacket', 'parka', 'coat', 'gilet', 'raincoat'],
+}
+
+
+def batched(objects, batch_size=BATCH_SIZE):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def synthetic_items(count, rng, prefix='seed', start=0, with_pks=False):
+    for n in range(start, start + count):
+        catagory = rng.choice(CATAGORY_CHOICES)[0]
+        title = f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS[catagory])}'.capitalize()
+        price = rng.randrange(500, 20000) / 100
+        discount_price = round(price * rng.uniform(0.5, 0.9), 2) if rng.random() < 0.3 else None
+        item = Item(
+            title=title,
+            image=f'{prefix}/item-{n}.jpg',
+            price=price,
+            discount_price=discount_price,
+            catagory=catagory,
+            label=rng.choice(LABEL_CHOICES)[0],
+            slug=f'{prefix}-item-{n}',
+            description=f'{title} in {rng.choice(ADJECTIVES)} cotton. Item {n}.',
+        )
+        item.effective_price = item.get_effective_price()
+        if with_pks:
+            item.pk = n
+        yield item
+
+
+def seed_items(count, seed=0, prefix='seed', batch_size=BATCH_SIZE):
+    """Create `count` items and bring the facets and search index up to date."""
+    rng = random.Random(seed)
+    for batch in batched(synthetic_items(count, rng, prefix), batch_size):
+        Item.objects.bulk_create(batch)
+    refresh_catalogue()
+
+
+def seed_users(count, password=None, prefix='seed', batch_size=BATCH_SIZE):
+    """Create `count` users who can all log in with `password`, or can't
+    log in with a password at all if it's None.
+    """
+    # hashing is deliberately slow, so hash once and share it
+    hashed = make_password(password)
+    User = get_user_model()
+    for batch in batched((User(username=f'{prefix}-user-{n}', password=hashed)
+                          for n in range(count)), batch_size):
+        User.objects.bulk_create(batch)
+    return User.objects.filter(username__startswith=f'{prefix}-user-')
+
+
+def seed_carts(users, items, lines, seed=0, batch_size=BATCH_SIZE):
+    """Give each of `users` an open cart of `lines` random `items`."""
+    rng = random.Random(seed)
+    users = list(users)
+    items = list(items)
+    now = timezone.now()
+    for batch in batched(users, batch_size):
+        Order.objects.bulk_create(
+            Order(user=user, ordered_date=now) for user in batch)
+        created = bulk_create_returning(
+            OrderItem, (OrderItem(user=user, item=item, quantity=rng.randint(1, 3))
+                        for user in batch
+                        for item in rng.sample(items, min(lines, len(items)))),
+            ['pk', 'user_id'], user__in=batch, order=None)
+        orders = dict(Order.objects.filter(user__in=batch, ordered=False)
+                      .values_list('user_id', 'pk'))
+        Order.items.through.objects.bulk_create(
+            Order.items.through(order_id=orders[user_id], orderitem_id=pk)
+            for pk, user_id in created)
+
+
+COUNTRIES = ['IN', 'US', 'GB', 'DE', 'FR', 'JP', 'AU', 'CA']
+OPEN_CART_RATE = 0.2
+
+
+def copy_value(value):
+    # COPY's CSV format reads an unquoted empty field as NULL and a quoted
+    # one as an empty string; the csv module can't tell None from ''
+    if value is None:
+        return ''
+    return '"%s"' % str(value).replace('"', '""')
+
+
+def copy_buffer(fields, objs):
+    """`objs` rendered for COPY ... WITH (FORMAT csv), a row per object.
+    Fills in auto_now fields as `bulk_create` would.
+    """
+    buffer = io.StringIO()
+    for obj in objs:
+        buffer.write(','.join(
+            copy_value(field.get_db_prep_save(field.pre_save(obj, True), connection))
+            for field in fields) + '\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(model, objs):
+    """Write `objs` with PostgreSQL's COPY, much faster than INSERTs for
+    big batches.
+    """
+    fields = [field for field in model._meta.concrete_fields
+              if not (field.primary_key and objs[0].pk is None)]
+    buffer = copy_buffer(fields, objs)
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f'COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) '
+            'FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def insert(model, objs, batch_size=BATCH_SIZE):
+    for batch in batched(objs, batch_size):
+        if connection.vendor == 'postgresql':
+            copy_rows(model, batch)
+        else:
+            model.objects.bulk_create(batch)
+
+
+def next_pks(models):
+    return {model: (model.objects.aggregate(pk=Max('pk'))['pk'] or 0) + 1
+            for model in models}
+
+
+class StorePlan:
+    """What `seed_store` writes, and where each chunk's primary keys start.
+
+    Customer `n` (counting from 0) has user and address pks `n` past the
+    first free ones, and order slots `n * max_orders` onwards; an order's
+    payment shares its slot, and its lines take `max_lines` pks from
+    `slot * max_lines`. Slots a customer doesn't use are left as gaps.
+    """
+
+    def __init__(self, items, customers, max_orders, max_lines, seed=0,
+                 prefix='seed', chunk_size=BATCH_SIZE, batch_size=BATCH_SIZE):
+        self.items = items
+        self.customers = customers
+        self.max_orders = max_orders
+        self.max_lines = max_lines
+        self.seed = seed
+        self.prefix = prefix
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.now = timezone.now()
+        self.first = next_pks([get_user_model(), Item, Address, Order, OrderItem, Payment])
+        # filled in by `prepare_customers` once the items are written
+        self.prices = None
+        self.hashed_password = None
+
+    def chunks(self):
+        for start in range(0, self.items, self.chunk_size):
+            yield ('items', start, min(self.chunk_size, self.items - start))
+        for start in range(0, self.customers, self.chunk_size):
+            yield ('customers', start, min(self.chunk_size, self.customers - start))
+
+    def rng(self, kind, start):
+        # str seeds hash the same in every process
+        return random.Random(f'{self.seed}:{kind}:{start}')
+
+    def write_items(self, start, count):
+        first = self.first[Item]
+        items = synthetic_items(count, self.rng('items', start), self.prefix,
+                                start=first + start, with_pks=True)
+        insert(Item, items, self.batch_size)
+        return {'items': count}
+
+    def prepare_customers(self):
+        items = Item.objects.all()
+        if self.items:
+            # orders are for the new items only
+            items = items.filter(pk__gte=self.first[Item])
+        self.prices = dict(items.values_list('pk', 'effective_price'))
+        # shared by every customer, as in `seed_users`
+        self.hashed_password = make_password(None)
+
+    def write_customers(self, start, count):
+        rng = self.rng('customers', start)
+        first = self.first
+        prices = self.prices
+        User = get_user_model()
+        item_pks = sorted(prices)
+        users, addresses, orders, lines, links, payments = [], [], [], [], [], []
+        for n in range(start, start + count):
+            user_pk = first[User] + n
+            users.append(User(pk=user_pk, username=f'{self.prefix}-user-{user_pk}',
+                              password=self.hashed_password))
+            address_pk = first[Address] + n
+            addresses.append(Address(
+                pk=address_pk, user_id=user_pk,
+                street_address=f'{rng.randint(1, 999)} {rng.choice(ADJECTIVES).title()} Street',
+                appertment_address='', country=[rng.choice(COUNTRIES)],
+                zip=str(rng.randint(10000, 99999)), address_type='B', default=True))
+
+            order_count = rng.randint(0, self.max_orders)
+            for j in range(order_count):
+                slot = n * self.max_orders + j
+                order_pk = first[Order] + slot
+                # only the latest order can still be a cart
+                is_open = j == order_count - 1 and rng.random() < OPEN_CART_RATE
+                total = Decimal('0.00')
+                for k, item_pk in enumerate(rng.sample(
+                        item_pks, min(rng.randint(1, self.max_lines), len(item_pks)))):
+                    line_pk = first[OrderItem] + slot * self.max_lines + k
+                    quantity = rng.randint(1, 3)
+                    total += prices[item_pk] * quantity
+                    lines.append(OrderItem(pk=line_pk, user_id=user_pk, item_id=item_pk,
+                                           quantity=quantity, ordered=not is_open))
+                    links.append(Order.items.through(order_id=order_pk, orderitem_id=line_pk))
+                order = Order(pk=order_pk, user_id=user_pk, ordered=not is_open,
+                              ordered_date=self.now - timedelta(minutes=rng.randint(0, 525600)))
+                if not is_open:
+                    payment_pk = first[Payment] + slot
+                    payments.append(Payment(pk=payment_pk, user_id=user_pk, amount=total,
+                                            stripe_charge_id=f'{self.prefix}_{payment_pk}'))
+                    order.payment_id = payment_pk
+                    order.ref_code = f'{self.prefix}-{order_pk}'
+                    order.billing_address_id = order.shipping_address_id = address_pk
+                orders.append(order)
+
+        for model, objs in [(User, users), (Address, addresses), (Payment, payments),
+                            (Order, orders), (OrderItem, lines), (Order.items.through, links)]:
+            insert(model, objs, self.batch_size)
+        return {'users': len(users), 'addresses': len(addresses), 'orders': len(orders),
+                'order items': len(lines), 'payments': len(payments)}
+
+
+def write_chunk(plan, kind, start, count):
+    with transaction.atomic():
+        if kind == 'items':
+            return plan.write_items(start, count)
+        return plan.write_customers(start, count)
+
+
+_worker_plan = None
+
+
+def _init_worker(plan):
+    global _worker_plan
+    _worker_plan = plan
+
+
+def _write_chunk(chunk):
+    # the process pool entry point
+    return write_chunk(_worker_plan, *chunk)
+
+
+def seed_store(plan, workers=1, progress=None):
+    """Write everything in `plan`, from `workers` processes. Calls
+    `progress(counts, seconds)` as each chunk finishes, with the running
+    totals. Returns the totals.
+    """
+    totals = {}
+    start = time.perf_counter()
+
+    def run(chunks):
+        if workers > 1:
+            # children inherit the parent's connections, they mustn't share them
+            connections.close_all()
+            # forked, so the plan (with its item prices) isn't pickled
+            context = multiprocessing.get_context('fork')
+            with context.Pool(workers, _init_worker, (plan,)) as pool:
+                yield from pool.imap_unordered(_write_chunk, chunks)
+        else:
+            for chunk in chunks:
+                yield write_chunk(plan, *chunk)
+
+    chunks = list(plan.chunks())
+    # every item is committed before any line can refer to it
+    for phase in ('items', 'customers'):
+        if phase == 'customers':
+            plan.prepare_customers()
+        for counts in run([chunk for chunk in chunks if chunk[0] == phase]):
+            for name, count in counts.items():
+                totals[name] = totals.get(name, 0) + count
+            if progress is not None:
+                progress(totals, time.perf_counter() - start)
+
+    if connection.vendor == 'postgresql':
+        # the explicit pks went past the sequences
+        models = [get_user_model(), Item, Address, Order, OrderItem, Payment]
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+    if plan.items:
+        refresh_catalogue()
+    return totals
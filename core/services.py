@@ -0,0 +1,228 @@
+import random
+import string
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Exists, F, Max, OuterRef
+from django.utils import timezone
+
+from .cache import bump_catalogue_version, invalidate_cart_item_count
+from . import coupons, facets, inventory, search
+from .models import Item, Order, OrderItem, Payment, PaymentJob
+
+
+CART_TOUCH_INTERVAL = timedelta(hours=1)
+
+
+class CartLocked(Exception):
+    """The cart has a payment in flight and can't change until it's done.
+    `message` is safe to show the customer.
+    """
+
+    def __init__(self):
+        self.message = "Your order is being paid for, it can't be changed right now"
+        super().__init__(self.message)
+
+
+def refresh_catalogue():
+    """Bring the facet counts, search index and cached pages up to date
+    after bulk changes to the items that skipped the model signals.
+    """
+    facets.rebuild_facets()
+    search.rebuild_index()
+    bump_catalogue_version()
+
+
+def create_ref_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+def get_cart_for_update(user, create=True):
+    """Return the user's open order, creating it if needed (or returning
+    None if `create` is False), locked until the surrounding transaction
+    ends. Raises CartLocked if a payment for it is in flight: the charge
+    is for the lines it was queued with.
+
+    Concurrent creators race on the one-open-cart constraint;
+    `get_or_create` recovers from the IntegrityError by re-reading.
+    """
+    now = timezone.now()
+    paying = PaymentJob.objects.filter(order=OuterRef('pk'), status__in=PaymentJob.IN_FLIGHT)
+    carts = Order.objects.select_for_update().annotate(paying=Exists(paying))
+    if create:
+        order, _ = carts.get_or_create(
+            user=user, ordered=False, defaults={'ordered_date': now})
+    else:
+        order = carts.filter(user=user, ordered=False).first()
+        if order is None:
+            return None
+    # `jobs.enqueue_payment` queues under the same lock; a new cart isn't
+    # annotated, and has nothing to pay for
+    if getattr(order, 'paying', False):
+        raise CartLocked()
+    # keeps `cleanup_carts` off carts in use without a write on every click
+    if order.updated < now - CART_TOUCH_INTERVAL:
+        order.updated = now
+        Order.objects.filter(pk=order.pk).update(updated=now)
+    return order
+
+
+def add_to_cart(user, item, quantity=1):
+    """Add `quantity` of `item` to the user's cart.
+
+    Returns True if a new line was created, False if an existing line was
+    incremented.
+    """
+    with transaction.atomic():
+        # the cart row lock serialises clicks from the same user so two of
+        # them can't both miss the line and create it twice
+        order = get_cart_for_update(user)
+        updated = OrderItem.objects.filter(order=order, item=item).update(
+            quantity=F('quantity') + quantity)
+        if not updated:
+            add_line(order, item, quantity)
+    invalidate_cart_item_count(user)
+    return not updated
+
+
+def add_line(order, item, quantity):
+    order_item = OrderItem.objects.create(
+        user_id=order.user_id, item=item, quantity=quantity)
+    Order.items.through.objects.create(order=order, orderitem=order_item)
+    return order_item
+
+
+def set_quantity(user, item, quantity):
+    """Set the quantity of `item` in the user's cart, adding the line if
+    it's missing and removing it at zero.
+    """
+    if quantity <= 0:
+        return remove_from_cart(user, item)
+    with transaction.atomic():
+        order = get_cart_for_update(user)
+        lines = OrderItem.objects.filter(order=order, item=item)
+        if order.reserved_at:
+            # checkout reserves the line again
+            inventory.release_reserved(lines.filter(reserved__gt=quantity))
+        if not lines.update(quantity=quantity):
+            add_line(order, item, quantity)
+    invalidate_cart_item_count(user)
+    return True
+
+
+def change_quantity(user, item, delta):
+    """Change the quantity of an existing cart line by `delta` without
+    letting it drop below zero. Returns True if the line was updated.
+    """
+    with transaction.atomic():
+        order = get_cart_for_update(user, create=False)
+        if order is None:
+            return False
+        lines = OrderItem.objects.filter(order=order, item=item)
+        if delta < 0:
+            lines = lines.filter(quantity__gte=-delta)
+            if order.reserved_at:
+                inventory.release_reserved(lines.filter(reserved__gt=F('quantity') + delta))
+        updated = lines.update(quantity=F('quantity') + delta)
+    invalidate_cart_item_count(user)
+    return bool(updated)
+
+
+def remove_from_cart(user, item):
+    """Delete the item's line from the user's cart. Returns True if there
+    was one.
+    """
+    with transaction.atomic():
+        order = get_cart_for_update(user, create=False)
+        if order is None:
+            return False
+        lines = OrderItem.objects.filter(order=order, item=item)
+        if order.reserved_at:
+            inventory.release_reserved(lines)
+        deleted = lines.delete()[0]
+    invalidate_cart_item_count(user)
+    return bool(deleted)
+
+
+def apply_coupon(user, code):
+    """Attach the coupon with `code` to the user's open order. Returns the
+    coupon, or None if there's no such code, and raises CouponError if it
+    isn't valid now.
+    """
+    coupon = coupons.get_coupon(code)
+    if coupon is not None:
+        coupons.check_coupon(coupon)
+        with transaction.atomic():
+            order = get_cart_for_update(user)
+            order.coupon = coupon
+            order.save(update_fields=['coupon'])
+    return coupon
+
+
+def bulk_create_returning(model, objs, fields, **lookups):
+    """`bulk_create` the unsaved `objs` and return a tuple of `fields` per
+    new row, as `values_list` would.
+
+    Backends that can't return the pks from the INSERT have the rows read
+    back: the ones past the highest pk before it, narrowed by `lookups` to
+    leave out any written by someone else meanwhile.
+    """
+    objs = list(objs)
+    if connection.features.can_return_rows_from_bulk_insert:
+        return [tuple(getattr(obj, field) for field in fields)
+                for obj in model.objects.bulk_create(objs)]
+    last = model.objects.aggregate(pk=Max('pk'))['pk'] or 0
+    model.objects.bulk_create(objs)
+    return list(model.objects.filter(pk__gt=last, **lookups).values_list(*fields))
+
+
+def bulk_add_to_cart(user, quantities):
+    """Add an {item pk: quantity} map (a `SessionCart`, a pasted wholesale
+    order) to the user's open order in one transaction, with a fixed number
+    of queries however many lines it has. Unknown pks are skipped.
+    """
+    with transaction.atomic():
+        order = get_cart_for_update(user)
+        quantities = {pk: quantity for pk, quantity in quantities.items()
+                      if quantity > 0}
+        item_ids = set(Item.objects.filter(pk__in=quantities)
+                       .values_list('pk', flat=True))
+        existing = list(OrderItem.objects.filter(order=order, item_id__in=item_ids))
+        for line in existing:
+            line.quantity += quantities[line.item_id]
+        OrderItem.objects.bulk_update(existing, ['quantity'])
+
+        new_ids = item_ids - {line.item_id for line in existing}
+        created = bulk_create_returning(
+            OrderItem, (OrderItem(user=user, item_id=pk, quantity=quantities[pk])
+                        for pk in new_ids),
+            ['pk'], user=user, item_id__in=new_ids, order=None)
+        Order.items.through.objects.bulk_create(
+            Order.items.through(order=order, orderitem_id=pk) for pk, in created)
+    invalidate_cart_item_count(user)
+    return order
+
+
+def finalize_order(order, charge_id, amount=None):
+    """Record the payment for `order` and mark it and its lines as ordered.
+
+    `amount` defaults to the order total; pass an order loaded through
+    `Order.objects.with_totals()` (as `get_cart` does) so it isn't summed
+    line by line.
+    """
+    total = order.get_total_price() if amount is None else amount
+    with transaction.atomic():
+        payment = Payment.objects.create(
+            stripe_charge_id=charge_id, user_id=order.user_id, amount=total)
+        # reserved stock has been sold now, it's no longer held for the cart
+        OrderItem.objects.filter(order=order).update(ordered=True, reserved=0)
+        order.ordered = True
+        order.payment = payment
+        order.ref_code = create_ref_code()
+        order.reserved_at = None
+        # it was the cart's creation time until now, start_date keeps that
+        order.ordered_date = payment.timestamp
+        order.save(update_fields=['ordered', 'ordered_date', 'payment', 'ref_code',
+                                  'reserved_at'])
+    invalidate_cart_item_count(order.user)
+    return payment
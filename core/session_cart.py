@@ -0,0 +1,109 @@
+from decimal import Decimal
+
+from .models import Item, OrderItem
+
+
+class CartFull(Exception):
+    """The session cart has no room for another line. `message` is safe to
+    show the visitor.
+    """
+
+    def __init__(self, max_lines):
+        self.message = f'Log in to add more than {max_lines} different items to your cart'
+        super().__init__(self.message)
+
+
+class SessionCart:
+    """Cart for visitors who haven't logged in.
+
+    Kept in the session as {item pk: quantity}, so with the signed cookie
+    session engine browsing and filling a cart costs no database writes.
+    It's merged into the user's open order when they log in.
+    """
+
+    session_key = 'cart'
+    coupon = None
+    # a cookie over 4KB is dropped by the browser, cart and all; 100 lines
+    # of 7 digit pks sign to under 1KB
+    max_lines = 100
+
+    def __init__(self, session):
+        self.session = session
+        # JSON session serialization turns the keys into strings
+        self.quantities = {int(pk): quantity for pk, quantity
+                           in session.get(self.session_key, {}).items()}
+
+    def __len__(self):
+        return len(self.quantities)
+
+    def save(self):
+        if self.quantities:
+            self.session[self.session_key] = {
+                str(pk): quantity for pk, quantity in self.quantities.items()}
+        else:
+            self.session.pop(self.session_key, None)
+
+    def check_room(self, pks):
+        """Raise CartFull unless the lines for `pks` fit."""
+        if len(self.quantities.keys() | set(pks)) > self.max_lines:
+            raise CartFull(self.max_lines)
+
+    def add(self, item, quantity=1):
+        """Same contract as `services.add_to_cart`, but raises CartFull
+        past `max_lines`.
+        """
+        self.check_room([item.pk])
+        created = item.pk not in self.quantities
+        self.quantities[item.pk] = self.quantities.get(item.pk, 0) + quantity
+        self.save()
+        return created
+
+    def bulk_add(self, quantities):
+        """Same contract as `services.bulk_add_to_cart`, but doesn't check
+        the pks exist. Adds nothing and raises CartFull if they don't all fit.
+        """
+        self.check_room(quantities)
+        for pk, quantity in quantities.items():
+            self.quantities[pk] = self.quantities.get(pk, 0) + quantity
+        self.save()
+
+    def change_quantity(self, item, delta):
+        """Same contract as `services.change_quantity`."""
+        quantity = self.quantities.get(item.pk)
+        if quantity is None or quantity + delta < 0:
+            return False
+        self.quantities[item.pk] = quantity + delta
+        self.save()
+        return True
+
+    def set_quantity(self, item, quantity):
+        """Same contract as `services.set_quantity`, but raises CartFull
+        past `max_lines`.
+        """
+        if quantity <= 0:
+            return self.remove(item)
+        self.check_room([item.pk])
+        self.quantities[item.pk] = quantity
+        self.save()
+        return True
+
+    def remove(self, item):
+        if self.quantities.pop(item.pk, None) is None:
+            return False
+        self.save()
+        return True
+
+    def clear(self):
+        self.quantities = {}
+        self.save()
+
+    def lines(self):
+        """Unsaved `OrderItem`s for the order summary, skipping items that
+        have been deleted since they were added.
+        """
+        items = Item.objects.in_bulk(self.quantities)
+        return [OrderItem(item=items[pk], quantity=quantity)
+                for pk, quantity in self.quantities.items() if pk in items]
+
+    def get_total_price(self):
+        return sum((line.get_final_price() for line in self.lines()), Decimal('0.00'))
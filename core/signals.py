@@ -0,0 +1,45 @@
+from allauth.account.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import coupons, facets, search, services
+from .cache import bump_catalogue_version
+from .models import Coupon, Item
+from .session_cart import SessionCart
+
+SEARCHED_FIELDS = {'title', 'description'}
+
+
+# queryset.update() and bulk_create() don't send these; call
+# facets.rebuild_facets(), search.rebuild_index() and bump the version by
+# hand after one
+@receiver(post_save, sender=Item)
+def item_saved(sender, instance, created, update_fields=None, **kwargs):
+    facets.item_saved(instance, created)
+    if update_fields is None or SEARCHED_FIELDS & set(update_fields):
+        search.index_item(instance)
+    bump_catalogue_version()
+
+
+@receiver(post_delete, sender=Item)
+def item_deleted(sender, instance, **kwargs):
+    facets.item_deleted(instance)
+    search.unindex_item(instance.pk)
+    bump_catalogue_version()
+
+
+@receiver(user_logged_in)
+def merge_session_cart(sender, request, user, **kwargs):
+    cart = SessionCart(request.session)
+    if cart:
+        try:
+            services.bulk_add_to_cart(user, cart.quantities)
+        except services.CartLocked:
+            # kept for the next login, the open order is being paid for
+            return
+        cart.clear()
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+def coupon_changed(sender, **kwargs):
+    coupons.clear_cache()
@@ -1,14 +1,12 @@
 from django import template
-from core.models import Order
+from core.cache import get_cart_item_count
+from core.session_cart import SessionCart
 
 register = template.Library()
 
 
 @register.filter
-def cart_item_count(user):
-    if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-        return 0
-    return 0
+def cart_item_count(request):
+    if request.user.is_authenticated:
+        return get_cart_item_count(request.user)
+    return len(SessionCart(request.session))
@@ -0,0 +1,15 @@
+from django import template
+
+from core import images
+
+register = template.Library()
+
+
+@register.simple_tag
+def variant_url(item, width, ext='webp'):
+    return images.variant_url(item, int(width), ext)
+
+
+@register.simple_tag
+def srcset(item, ext='webp'):
+    return images.srcset(item, ext)
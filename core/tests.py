@@ -1,3 +1,1863 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from PIL import Image
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import Max, Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (benchmark, coupons, exports, images, inventory, jobs, metrics, search, seed,
+               services, views)
+from .api import CartBatchView
+from .gateways import PaymentError, PayPalGateway, StripeGateway, get_gateway, reset_gateways
+from .cache import get_cart_item_count
+from .facets import filter_items, rebuild_facets
+from .models import Address, Item, OrderItem, Order, Coupon, Payment, PaymentJob, FacetCount
+from .pagination import KeysetPaginator
+from .session_cart import SessionCart
+
+
+def make_item(n, **kwargs):
+    fields = {
+        'title': f'Item {n}',
+        'image': f'item-{n}.jpg',
+        'price': 10.0 + n,
+        'catagory': 's',
+        'label': 'P',
+        'slug': f'item-{n}',
+        'description': f'Description of item {n}',
+    }
+    fields.update(kwargs)
+    return Item.objects.create(**fields)
+
+
+def make_cart(user, items, quantity=1):
+    order = Order.objects.create(user=user, ordered_date=timezone.now())
+    for item in items:
+        order_item = OrderItem.objects.create(
+            user=user, item=item, quantity=quantity)
+        order.items.add(order_item)
+    return order
+
+
+FAKE_GATEWAYS = {
+    'stripe': {'BACKEND': 'core.gateways.FakeGateway'},
+    'paypal': {'BACKEND': 'core.gateways.FakeGateway'},
+}
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    PAYMENT_GATEWAYS=FAKE_GATEWAYS)
+class StoreTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        coupons.clear_cache()
+        # fresh fake gateways, with no charges from other tests
+        reset_gateways('PAYMENT_GATEWAYS')
+        self.user = get_user_model().objects.create_user(
+            username='shopper', password='secret')
+        self.client.force_login(self.user)
+
+
+class CartQueryCountTests(StoreTestCase):
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_get_cart_prefetches_items(self):
+        make_cart(self.user, [make_item(n) for n in range(3)])
+        with self.assertNumQueries(2):
+            order = Order.objects.get_cart(self.user)
+            titles = [orderitem.item.title for orderitem in order.items.all()]
+            order.get_total_price()
+            order.items.count()
+        self.assertEqual(len(titles), 3)
+
+    def test_order_summary_queries_do_not_grow_with_cart(self):
+        items = [make_item(n) for n in range(30)]
+        order = make_cart(self.user, items[:1])
+        small = self.count_queries(reverse('core:ordersummary'))
+
+        for item in items[1:]:
+            order.items.add(OrderItem.objects.create(user=self.user, item=item))
+        large = self.count_queries(reverse('core:ordersummary'))
+
+        self.assertEqual(small, large)
+        # user, cart, cart lines and the nav badge; the session is a cookie
+        self.assertEqual(large, 4)
+
+    def test_checkout_queries_do_not_grow_with_cart(self):
+        items = [make_item(n) for n in range(30)]
+        order = make_cart(self.user, items[:1])
+        small = self.count_queries(reverse('core:checkout'))
+
+        for item in items[1:]:
+            order.items.add(OrderItem.objects.create(user=self.user, item=item))
+        large = self.count_queries(reverse('core:checkout'))
+
+        self.assertEqual(small, large)
+
+    def test_payment_queries_do_not_grow_with_cart(self):
+        items = [make_item(n) for n in range(30)]
+        order = make_cart(self.user, items[:1])
+        url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+        small = self.count_queries(url)
+
+        for item in items[1:]:
+            order.items.add(OrderItem.objects.create(user=self.user, item=item))
+        large = self.count_queries(url)
+
+        self.assertEqual(small, large)
+
+
+class OrderTotalsTests(StoreTestCase):
+    def test_with_totals_matches_python_totals(self):
+        plain = make_item(1, price=20.0)
+        discounted = make_item(2, price=50.0, discount_price=40.0)
+        order = make_cart(self.user, [plain, discounted], quantity=3)
+        order.coupon = Coupon.objects.create(code='SAVE5', amount=5.0)
+        order.save()
+        empty = make_cart(get_user_model().objects.create_user('other'), [])
+
+        expected = Order.objects.get(pk=order.pk).get_total_price()
+        with self.assertNumQueries(1):
+            totals = {o.pk: o for o in Order.objects.with_totals()}
+
+        self.assertEqual(totals[order.pk].subtotal, 180.0)
+        self.assertEqual(totals[order.pk].savings, 30.0)
+        self.assertEqual(totals[order.pk].total, expected)
+        self.assertEqual(totals[order.pk].get_total_price(), 175.0)
+        self.assertEqual(totals[empty.pk].total, 0)
+
+    def test_line_prices_use_annotation(self):
+        item = make_item(1, price=50.0, discount_price=40.0)
+        make_cart(self.user, [item], quantity=2)
+        order_item = OrderItem.objects.with_prices().get()
+        with self.assertNumQueries(0):
+            self.assertEqual(order_item.get_final_price(), 80.0)
+            self.assertEqual(order_item.get_amount_save(), 20.0)
+
+    def test_totals_are_exact(self):
+        item = make_item(1, price=Decimal('19.99'), discount_price=Decimal('0.10'))
+        order = make_cart(self.user, [item, make_item(2, price=Decimal('0.20'))], quantity=3)
+        order.coupon = Coupon.objects.create(code='CENTS', amount=Decimal('0.30'))
+        order.save()
+        total = Order.objects.with_totals().get(pk=order.pk).get_total_price()
+        self.assertEqual(total, Decimal('0.60'))
+        self.assertEqual(Order.objects.get(pk=order.pk).get_total_price(), total)
+
+
+class EffectivePriceTests(StoreTestCase):
+    def test_kept_in_step_with_prices(self):
+        item = make_item(1, price=Decimal('50.00'))
+        self.assertEqual(Item.objects.get().effective_price, Decimal('50.00'))
+        item.discount_price = Decimal('35.50')
+        item.save(update_fields=['discount_price'])
+        self.assertEqual(Item.objects.get().effective_price, Decimal('35.50'))
+        item.discount_price = Decimal('0')
+        item.save()
+        self.assertEqual(Item.objects.get().effective_price, Decimal('50.00'))
+
+    def test_price_filter_reads_the_column(self):
+        make_item(1, price=30.0)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get('/?min_price=25')
+        sql = ' '.join(q['sql'] for q in ctx if '"core_item"' in q['sql'])
+        self.assertIn('"effective_price" >=', sql)
+        self.assertNotIn('COALESCE', sql)
+
+    def test_price_sorted_pages(self):
+        # equal prices are ordered by pk so no item is skipped or repeated
+        for n in range(25):
+            make_item(n, price=Decimal(30 - n % 5))
+        by_price = list(Item.objects.order_by('effective_price', 'pk'))
+        paginator = KeysetPaginator(Item.objects.all(), 10, 'effective_price', False)
+        first = paginator.page()
+        second = paginator.page(after=first.after)
+        third = paginator.page(after=second.after)
+        self.assertEqual(list(first) + list(second) + list(third), by_price)
+        self.assertFalse(third.has_next)
+        self.assertEqual(list(paginator.page(before=third.before)), list(second))
+
+        response = self.client.get('/?sort=-price')
+        self.assertContains(response, f'?sort=-price&after={by_price[-10].pk}')
+        titles = [item['title'] for item in self.client.get(
+            reverse('core:api-items') + '?sort=-price').json()['items']]
+        self.assertEqual(titles, [item.title for item in by_price[::-1][:10]])
+
+
+class CartBadgeTests(StoreTestCase):
+    def test_count_is_cached(self):
+        make_cart(self.user, [make_item(1), make_item(2)])
+        with self.assertNumQueries(1):
+            self.assertEqual(get_cart_item_count(self.user), 2)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_item_count(self.user), 2)
+
+    def test_cart_views_invalidate_count(self):
+        first, second = make_item(1), make_item(2)
+        self.assertEqual(get_cart_item_count(self.user), 0)
+
+        self.client.get(reverse('core:add_to_cart', kwargs={'slug': first.slug}))
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        self.client.get(reverse('core:add_to_cart', kwargs={'slug': second.slug}))
+        self.assertEqual(get_cart_item_count(self.user), 2)
+        self.client.get(reverse('core:remove_from_cart', kwargs={'slug': first.slug}))
+        self.assertEqual(get_cart_item_count(self.user), 1)
+
+
+class SessionCartTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+        self.shirt, self.hat = make_item(1), make_item(2)
+
+    def test_browsing_cart_writes_nothing(self):
+        url = reverse('core:add_to_cart', kwargs={'slug': self.shirt.slug})
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(url)
+            self.client.get(url)
+            self.client.get(reverse('core:add_to_cart', kwargs={'slug': self.hat.slug}))
+            self.client.get(reverse('core:remove_single_item_from_cart',
+                                    kwargs={'task': 'remove', 'slug': self.hat.slug}))
+        writes = [q['sql'] for q in ctx
+                  if not q['sql'].startswith(('SELECT', 'SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(writes, [])
+        self.assertEqual(self.client.session['cart'],
+                         {str(self.shirt.pk): 2, str(self.hat.pk): 0})
+        self.assertEqual(OrderItem.objects.count(), 0)
+
+    def test_order_summary(self):
+        self.client.get(reverse('core:add_to_cart', kwargs={'slug': self.shirt.slug}))
+        self.client.get(reverse('core:add_to_cart', kwargs={'slug': self.shirt.slug}))
+        response = self.client.get(reverse('core:ordersummary'))
+        self.assertContains(response, 'Item 1')
+        self.assertContains(response, '$22.00')
+        self.assertContains(response, '<span class="badge red z-depth-1 mr-1"> 1</span>', html=True)
+
+    def test_checkout_asks_to_log_in(self):
+        response = self.client.get(reverse('core:checkout'))
+        self.assertRedirects(response, reverse('account_login') + '?next=/checkout/',
+                             fetch_redirect_response=False)
+
+    def test_merged_on_login(self):
+        make_cart(self.user, [self.shirt], quantity=3)
+        gone = make_item(3)
+        session = self.client.session
+        session['cart'] = {str(self.shirt.pk): 2, str(self.hat.pk): 1, str(gone.pk): 1}
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        gone.delete()
+
+        self.client.post(reverse('account_login'),
+                         {'login': 'shopper', 'password': 'secret'})
+        order = Order.objects.get_cart(self.user)
+        self.assertEqual(
+            {line.item_id: line.quantity for line in order.items.all()},
+            {self.shirt.pk: 5, self.hat.pk: 1})
+        self.assertNotIn('cart', self.client.session)
+        self.assertEqual(get_cart_item_count(self.user), 2)
+
+    def test_cart_is_capped_to_fit_the_cookie(self):
+        self.assertLess(SessionCart.max_lines, CartBatchView.max_lines)
+        items = [make_item(10 + n) for n in range(SessionCart.max_lines)]
+        lines = [{'slug': item.slug} for item in items]
+        response = self.client.post(reverse('core:api-cart-batch'), {'lines': lines},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.post(reverse('core:api-cart-batch'),
+                                    {'lines': [{'slug': self.shirt.slug}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('core:add_to_cart', kwargs={'slug': self.hat.slug}),
+                                   follow=True)
+        self.assertContains(response, 'Log in to add more than')
+        # a line already there can still change
+        self.client.get(reverse('core:add_to_cart', kwargs={'slug': items[0].slug}))
+        self.assertEqual(self.client.session['cart'][str(items[0].pk)], 2)
+        self.assertEqual(len(self.client.session['cart']), SessionCart.max_lines)
+
+    def test_merge_queries_do_not_grow_with_cart(self):
+        def merge(count):
+            user = get_user_model().objects.create_user(f'merge-{count}')
+            items = [make_item(100 * count + n) for n in range(count)]
+            make_cart(user, items[:1])
+            with CaptureQueriesContext(connection) as ctx:
+                services.bulk_add_to_cart(user, {item.pk: 1 for item in items})
+            self.assertEqual(Order.objects.get_cart(user).items.count(), count)
+            return len(ctx)
+        self.assertEqual(merge(2), merge(20))
+
+
+class CartAPITests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shirt = make_item(1, price=Decimal('20.00'))
+        self.hat = make_item(2, price=Decimal('15.00'), discount_price=Decimal('12.50'))
+
+    def patch(self, item, body):
+        return self.client.patch(
+            reverse('core:api-cart-line', kwargs={'slug': item.slug}),
+            json.dumps(body), content_type='application/json')
+
+    def test_patch_sets_quantity_and_returns_totals(self):
+        empty = self.client.get(reverse('core:api-cart')).json()
+        self.assertEqual((empty['count'], empty['total']), (0, '0.00'))
+        self.patch(self.shirt, {'quantity': 2})
+        data = self.patch(self.hat, {'quantity': 3}).json()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['total'], '77.50')
+        self.assertEqual(
+            {line['item']['slug']: line['quantity'] for line in data['lines']},
+            {'item-1': 2, 'item-2': 3})
+
+        data = self.patch(self.hat, {'quantity': 1}).json()
+        self.assertEqual(data['total'], '52.50')
+        self.assertEqual(get_cart_item_count(self.user), 2)
+
+        data = self.patch(self.hat, {'quantity': 0}).json()
+        self.assertEqual([line['item']['slug'] for line in data['lines']], ['item-1'])
+
+    def test_patch_query_count(self):
+        self.patch(self.shirt, {'quantity': 1})
+        with CaptureQueriesContext(connection) as ctx:
+            self.patch(self.shirt, {'quantity': 4})
+        queries = [q for q in ctx if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # user, item, locked cart, update, cart with totals, its lines
+        self.assertEqual(len(queries), 6)
+
+    def test_delete_removes_line(self):
+        self.patch(self.shirt, {'quantity': 1})
+        response = self.client.delete(
+            reverse('core:api-cart-line', kwargs={'slug': self.shirt.slug}))
+        self.assertEqual(response.json()['lines'], [])
+
+    def test_bad_requests(self):
+        for body in ({'quantity': -1}, {'quantity': '2'}, {'quantity': True}, {}, [1],
+                     {'quantity': 1001}, {'quantity': 10 ** 20}):
+            self.assertEqual(self.patch(self.shirt, body).status_code, 400)
+        response = self.client.patch(
+            reverse('core:api-cart-line', kwargs={'slug': self.shirt.slug}),
+            'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.patch(Item(slug='missing'), {'quantity': 1}).status_code, 404)
+
+    def test_coupon(self):
+        Coupon.objects.create(code='FIVE', amount=Decimal('5.00'))
+        self.patch(self.shirt, {'quantity': 1})
+        url = reverse('core:api-cart-coupon')
+        response = self.client.post(url, {'code': 'NOPE'}, content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        data = self.client.post(url, {'code': 'FIVE'}, content_type='application/json').json()
+        self.assertEqual(data['coupon'], {'code': 'FIVE', 'amount': '5.00'})
+        self.assertEqual(data['total'], '15.00')
+
+    def test_anonymous_cart(self):
+        self.client.logout()
+        data = self.patch(self.hat, {'quantity': 2}).json()
+        self.assertEqual(data['total'], '25.00')
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(OrderItem.objects.count(), 0)
+        response = self.client.post(reverse('core:api-cart-coupon'), {'code': 'X'},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+
+class CartBatchTests(StoreTestCase):
+    def post(self, lines):
+        return self.client.post(reverse('core:api-cart-batch'), {'lines': lines},
+                                content_type='application/json')
+
+    def test_adds_all_lines(self):
+        items = [make_item(n) for n in range(3)]
+        make_cart(self.user, items[:1], quantity=2)
+        data = self.post([
+            {'slug': 'item-0', 'quantity': 3},
+            {'slug': 'item-1', 'quantity': 1},
+            {'slug': 'item-1', 'quantity': 4},
+            {'slug': 'item-2'},
+        ]).json()
+        self.assertEqual(
+            {line['item']['slug']: line['quantity'] for line in data['lines']},
+            {'item-0': 5, 'item-1': 5, 'item-2': 1})
+        self.assertEqual(data['count'], 3)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        def count(n):
+            user = get_user_model().objects.create_user(f'wholesale-{n}')
+            self.client.force_login(user)
+            items = [make_item(1000 * n + i) for i in range(n)]
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.post([{'slug': item.slug, 'quantity': 2} for item in items])
+            self.assertEqual(len(response.json()['lines']), n)
+            return len(ctx)
+        # 150 lines still fit one of SQLite's 999-parameter INSERT batches
+        self.assertEqual(count(2), count(150))
+
+    def test_leaves_orphan_lines_out(self):
+        item = make_item(1)
+        # a line left behind by an old cart, see `cleanup_carts`
+        orphan = OrderItem.objects.create(user=self.user, item=item, quantity=7)
+        services.bulk_add_to_cart(self.user, {item.pk: 2})
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual([(line.item_id, line.quantity) for line in order.items.all()],
+                         [(item.pk, 2)])
+        self.assertFalse(orphan.order_set.exists())
+
+        seed.seed_carts([get_user_model().objects.create_user('seeded')], [item], 1)
+        self.assertFalse(orphan.order_set.exists())
+
+    def test_rejects_the_whole_batch(self):
+        make_item(1)
+        response = self.post([{'slug': 'item-1'}, {'slug': 'nope'}, {'slug': 'gone'}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['slugs'], ['gone', 'nope'])
+        for lines in ([], [{'slug': 'item-1', 'quantity': 0}], ['item-1'],
+                      [{'quantity': 1}], [{'slug': 'item-1'}] * 501,
+                      [{'slug': 'item-1', 'quantity': 10 ** 20}],
+                      [{'slug': 'item-1', 'quantity': 600}] * 2):
+            self.assertEqual(self.post(lines).status_code, 400)
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_anonymous(self):
+        self.client.logout()
+        make_item(1)
+        data = self.post([{'slug': 'item-1', 'quantity': 2}]).json()
+        self.assertEqual(data['lines'][0]['quantity'], 2)
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class CouponTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.order = make_cart(self.user, [make_item(1)])
+        self.payment_url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+
+    def apply(self, code):
+        return self.client.post(reverse('core:add-coupon'), {'code': code})
+
+    def pay(self, token='tok_visa'):
+        return self.client.post(self.payment_url, {'stripeToken': token})
+
+    def test_lookups_are_cached_until_a_coupon_changes(self):
+        coupon = Coupon.objects.create(code='SPRING', amount=5)
+        coupons.get_coupon('SPRING')
+        coupons.get_coupon('NOPE')
+        with self.assertNumQueries(0):
+            self.assertEqual(coupons.get_coupon('SPRING'), coupon)
+            self.assertIsNone(coupons.get_coupon('NOPE'))
+        Coupon.objects.create(code='NOPE', amount=1)
+        self.assertIsNotNone(coupons.get_coupon('NOPE'))
+        coupon.delete()
+        self.assertIsNone(coupons.get_coupon('SPRING'))
+
+    def test_unknown_code_is_not_stored(self):
+        response = self.apply('NOPE')
+        self.assertRedirects(response, reverse('core:checkout'), fetch_redirect_response=False)
+        self.assertIsNone(Order.objects.get().coupon)
+
+    def test_validity_window(self):
+        now = timezone.now()
+        Coupon.objects.create(code='LATER', amount=5, valid_from=now + timedelta(days=1))
+        Coupon.objects.create(code='GONE', amount=5, valid_until=now)
+        Coupon.objects.create(code='NOW', amount=5, valid_from=now, valid_until=now + timedelta(days=1))
+        self.apply('LATER')
+        self.apply('GONE')
+        self.assertIsNone(Order.objects.get().coupon)
+        response = self.client.post(reverse('core:api-cart-coupon'), {'code': 'GONE'},
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'error': 'This coupon has expired'})
+        self.apply('NOW')
+        self.assertEqual(Order.objects.get().coupon.code, 'NOW')
+
+    def test_uses_are_claimed_on_payment_and_released_on_failure(self):
+        coupon = Coupon.objects.create(code='ONCE', amount=5, max_uses=1)
+        self.apply('ONCE')
+        self.pay('decline')
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.uses, 1)
+        self.assertEqual(PaymentJob.objects.get().amount, 6)
+
+        jobs.process_payment_jobs()
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.uses, 0)
+        self.assertEqual(coupon.user_uses.get().uses, 0)
+
+    def test_used_up_coupon_is_removed_at_payment(self):
+        Coupon.objects.create(code='ONCE', amount=5, max_uses=1)
+        self.apply('ONCE')
+        other = get_user_model().objects.create_user('other')
+        coupons.redeem_coupon(Coupon.objects.get(), other.pk)
+
+        response = self.pay()
+        self.assertRedirects(response, reverse('core:checkout'), fetch_redirect_response=False)
+        self.assertFalse(PaymentJob.objects.exists())
+        self.assertIsNone(Order.objects.get().coupon)
+
+    def test_per_user_limit(self):
+        coupon = Coupon.objects.create(code='WELCOME', amount=5, max_uses_per_user=1)
+        coupons.redeem_coupon(coupon, self.user.pk)
+        with self.assertRaisesMessage(coupons.CouponError, 'already used'):
+            coupons.redeem_coupon(coupon, self.user.pk)
+        coupon.refresh_from_db()
+        # the failed claim didn't count against the coupon
+        self.assertEqual(coupon.uses, 1)
+        coupons.redeem_coupon(coupon, get_user_model().objects.create_user('other').pk)
+
+
+class StockTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.item = make_item(1, stock=5)
+        self.untracked = make_item(2)
+        self.order = make_cart(self.user, [self.item, self.untracked], quantity=3)
+
+    def stock(self):
+        return Item.objects.get(pk=self.item.pk).stock
+
+    def test_reserve_and_re_reserve(self):
+        inventory.reserve_stock(self.order)
+        self.assertEqual(self.stock(), 2)
+        self.assertIsNotNone(Order.objects.get().reserved_at)
+
+        # the cart changed after checkout: the reservation follows it
+        OrderItem.objects.filter(item=self.item).update(quantity=4)
+        inventory.reserve_stock(self.order)
+        self.assertEqual(self.stock(), 1)
+
+        OrderItem.objects.filter(item=self.item).update(quantity=7)
+        with self.assertRaisesMessage(inventory.OutOfStock, 'Only 5 of "Item 1" left'):
+            inventory.reserve_stock(self.order)
+        # the earlier reservation still stands
+        self.assertEqual(self.stock(), 1)
+
+    def test_items_are_claimed_in_order(self):
+        first = make_item(3, stock=5)
+        order = make_cart(get_user_model().objects.create_user('buyer'), [self.item, first][::-1])
+        with CaptureQueriesContext(connection) as ctx:
+            inventory.reserve_stock(order)
+        claimed = [re.search(r'"id" = (\d+)', query['sql']).group(1) for query in ctx
+                   if query['sql'].startswith('UPDATE "core_item"')]
+        self.assertEqual(claimed, [str(self.item.pk), str(first.pk)])
+
+    def test_payment_consumes_reservation(self):
+        self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                         {'stripeToken': 'tok_visa'})
+        self.assertEqual(self.stock(), 2)
+        jobs.process_payment_jobs()
+        self.assertEqual(self.stock(), 2)
+        self.assertEqual(OrderItem.objects.get(item=self.item).reserved, 0)
+        self.assertEqual(inventory.release_expired(timeout=0), 0)
+        self.assertEqual(self.stock(), 2)
+
+    def test_out_of_stock_at_payment(self):
+        Item.objects.filter(pk=self.item.pk).update(stock=2)
+        response = self.client.post(reverse('core:payment', kwargs={'payment_option': 'stripe'}),
+                                    {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, reverse('core:ordersummary'), fetch_redirect_response=False)
+        self.assertFalse(PaymentJob.objects.exists())
+
+    def test_changing_the_cart_gives_back_its_reservation(self):
+        inventory.reserve_stock(self.order)
+        services.change_quantity(self.user, self.item, 1)
+        self.assertEqual(self.stock(), 2)
+        services.change_quantity(self.user, self.item, -2)
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(OrderItem.objects.get(item=self.item).reserved, 0)
+
+        inventory.reserve_stock(self.order)
+        services.set_quantity(self.user, self.item, 1)
+        self.assertEqual(self.stock(), 5)
+
+        inventory.reserve_stock(self.order)
+        services.remove_from_cart(self.user, self.item)
+        self.assertEqual(self.stock(), 5)
+        self.assertEqual(inventory.release_expired(timeout=0), 1)
+        self.assertEqual(self.stock(), 5)
+
+    def test_abandoned_checkouts_are_released(self):
+        inventory.reserve_stock(self.order)
+        other = make_cart(get_user_model().objects.create_user('payer'), [self.item])
+        inventory.reserve_stock(other)
+        jobs.enqueue_payment(other, 'tok_visa')
+        self.assertEqual(self.stock(), 1)
+
+        self.assertEqual(inventory.release_expired(timeout=60), 0)
+        out = StringIO()
+        call_command('release_stock', timeout=0, stdout=out)
+        self.assertIn('Released stock from 1 abandoned checkout(s)', out.getvalue())
+        # the checkout with a payment in flight keeps its unit
+        self.assertEqual(self.stock(), 4)
+        self.assertIsNone(Order.objects.get(pk=self.order.pk).reserved_at)
+
+
+class CleanupCartsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.item = make_item(1, stock=5)
+        users = get_user_model().objects
+        self.stale = [make_cart(users.create_user(f'idle{n}'), [self.item], quantity=2)
+                      for n in range(3)]
+        inventory.reserve_stock(self.stale[0])
+        self.paying = make_cart(users.create_user('payer'), [self.item])
+        jobs.enqueue_payment(self.paying, 'tok_visa')
+        old = timezone.now() - timedelta(days=40)
+        Order.objects.update(updated=old)
+        self.fresh = make_cart(self.user, [self.item])
+        self.orphan = OrderItem.objects.create(user=self.user, item=self.item)
+        self.ordered = OrderItem.objects.create(user=self.user, item=self.item, ordered=True)
+
+    def cleanup(self, **kwargs):
+        out = StringIO()
+        call_command('cleanup_carts', batch_size=2, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_dry_run(self):
+        output = self.cleanup(dry_run=True)
+        self.assertIn('Would delete 3 cart(s) and 1 orphaned line(s)', output)
+        self.assertEqual(Order.objects.count(), 5)
+        self.assertEqual(OrderItem.objects.count(), 7)
+
+    def test_cleanup(self):
+        output = self.cleanup()
+        self.assertIn('Deleted 2 cart(s) so far', output)
+        self.assertIn('Deleted 3 cart(s) with 3 line(s), and 1 orphaned line(s)', output)
+        self.assertEqual(set(Order.objects.all()), {self.paying, self.fresh})
+        self.assertFalse(OrderItem.objects.filter(pk=self.orphan.pk).exists())
+        self.assertTrue(OrderItem.objects.filter(pk=self.ordered.pk).exists())
+        # the deleted checkout's reservation went back on the shelf, the
+        # one being paid for is still held
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stock, 4)
+
+        self.assertIn('Deleted 0 cart(s) with 0 line(s), and 0 orphaned', self.cleanup())
+
+    def test_cart_in_use_is_kept(self):
+        user = self.stale[1].user
+        services.add_to_cart(user, make_item(2))
+        self.cleanup()
+        self.assertTrue(Order.objects.filter(user=user, ordered=False).exists())
+
+
+class CartIndexTests(StoreTestCase):
+    def assertUsesIndex(self, queryset, index_name=None):
+        if connection.vendor == 'postgresql':
+            # the test tables are tiny, so stop the planner preferring a seq scan
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+            self.assertNotIn('Seq Scan', plan)
+        else:
+            plan = queryset.explain()
+            self.assertIn('USING INDEX', plan)
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_open_cart_lookup_uses_index(self):
+        self.assertUsesIndex(
+            Order.objects.filter(user=self.user, ordered=False),
+            'order_one_open_cart_per_user')
+
+    def test_open_line_lookup_uses_index(self):
+        item = make_item(1)
+        self.assertUsesIndex(
+            OrderItem.objects.filter(item=item, user=self.user, ordered=False),
+            'orderitem_open_line_idx')
+
+    def test_slug_and_ref_code_lookups_use_index(self):
+        self.assertUsesIndex(Item.objects.filter(slug='item-1'))
+        self.assertUsesIndex(Order.objects.filter(ref_code='abc'))
+
+    def test_one_open_cart_per_user(self):
+        make_cart(self.user, [])
+        Order.objects.filter(user=self.user).update(ordered=True)
+        # completed orders don't count against the open cart
+        make_cart(self.user, [])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            make_cart(self.user, [])
+
+
+class CartServiceTests(StoreTestCase):
+    def test_add_creates_cart_then_increments(self):
+        item = make_item(1)
+        self.assertTrue(services.add_to_cart(self.user, item))
+        self.assertFalse(services.add_to_cart(self.user, item))
+        order = Order.objects.get(user=self.user, ordered=False)
+        self.assertEqual(order.items.get().quantity, 2)
+
+    def test_add_to_existing_line_is_cheap(self):
+        item = make_item(1)
+        services.add_to_cart(self.user, item)
+        with CaptureQueriesContext(connection) as ctx:
+            services.add_to_cart(self.user, item)
+        statements = [q['sql'] for q in ctx
+                      if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        # cart lock and the line UPDATE
+        self.assertEqual(len(statements), 2)
+
+    def test_change_quantity_stops_at_zero(self):
+        item = make_item(1)
+        services.add_to_cart(self.user, item)
+        self.assertTrue(services.change_quantity(self.user, item, -1))
+        self.assertFalse(services.change_quantity(self.user, item, -1))
+        self.assertEqual(OrderItem.objects.get().quantity, 0)
+
+    def test_change_quantity_ignores_items_outside_cart(self):
+        item = make_item(1)
+        OrderItem.objects.create(user=self.user, item=item)
+        self.assertFalse(services.change_quantity(self.user, item, 1))
+
+    def test_remove_deletes_line(self):
+        item = make_item(1)
+        services.add_to_cart(self.user, item)
+        self.assertTrue(services.remove_from_cart(self.user, item))
+        self.assertFalse(services.remove_from_cart(self.user, item))
+        self.assertFalse(OrderItem.objects.exists())
+
+
+class ConcurrencyMixin:
+    threads = 8
+    clicks = 5
+
+    def run_concurrently(self, target):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(self.clicks):
+                    retry_on_lock(target)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class ConcurrentCartTests(ConcurrencyMixin, TransactionTestCase):
+    def test_concurrent_adds_lose_no_updates(self):
+        user = get_user_model().objects.create_user('shopper')
+        item = make_item(1)
+
+        self.run_concurrently(lambda: services.add_to_cart(user, item))
+
+        order = Order.objects.get(user=user, ordered=False)
+        self.assertEqual(order.items.count(), 1)
+        self.assertEqual(order.items.get().quantity, self.threads * self.clicks)
+
+    def test_concurrent_decrements_lose_no_updates(self):
+        user = get_user_model().objects.create_user('shopper')
+        item = make_item(1)
+        services.add_to_cart(user, item, quantity=self.threads * self.clicks + 3)
+
+        self.run_concurrently(lambda: services.change_quantity(user, item, -1))
+
+        self.assertEqual(OrderItem.objects.get().quantity, 3)
+
+
+class ConcurrentCouponTests(ConcurrencyMixin, TransactionTestCase):
+    def test_concurrent_redeems_respect_max_uses(self):
+        coupon = Coupon.objects.create(code='FLASH', amount=5, max_uses=7)
+        users = [get_user_model().objects.create_user(f'user-{n}')
+                 for n in range(self.threads)]
+        claimed = []
+
+        def redeem():
+            user = users[threading.get_ident() % self.threads]
+            try:
+                coupons.redeem_coupon(coupon, user.pk)
+            except coupons.CouponError:
+                return
+            claimed.append(user.pk)
+
+        self.run_concurrently(redeem)
+        self.assertEqual(len(claimed), 7)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.uses, 7)
+        self.assertEqual(sum(coupon.user_uses.values_list('uses', flat=True)), 7)
+
+
+class ConcurrentPaymentTests(ConcurrencyMixin, TransactionTestCase):
+    # every submit is for the same order, so they all queue on its lock
+    threads = 4
+    clicks = 2
+
+    def test_concurrent_submits_queue_one_charge(self):
+        user = get_user_model().objects.create_user('shopper')
+        coupon = Coupon.objects.create(code='ONCE', amount=1, max_uses=1)
+        order = make_cart(user, [make_item(1, stock=10)])
+        Order.objects.filter(pk=order.pk).update(coupon=coupon)
+
+        self.run_concurrently(lambda: jobs.enqueue_payment(order, 'tok_visa'))
+
+        self.assertEqual(PaymentJob.objects.count(), 1)
+        self.assertEqual(Coupon.objects.get().uses, 1)
+        self.assertEqual(Item.objects.get().stock, 9)
+
+
+class ConcurrentStockTests(ConcurrencyMixin, TransactionTestCase):
+    def test_last_units_are_not_oversold(self):
+        stock = 25
+        item = make_item(1, stock=stock)
+        other = make_item(2, stock=stock + 5)
+        # carts sharing items in either order, claimed in the same order
+        orders = [make_cart(get_user_model().objects.create_user(f'buyer-{n}'),
+                            [item, other] if n % 2 else [other, item])
+                  for n in range(self.threads * self.clicks)]
+        lock = threading.Lock()
+        sold, refused = [], []
+
+        def checkout():
+            with lock:
+                order = orders.pop()
+            try:
+                retry_on_lock(lambda: inventory.reserve_stock(order))
+            except inventory.OutOfStock:
+                refused.append(order.pk)
+            except OperationalError:
+                # rolled back, so it's still to check out when retried
+                with lock:
+                    orders.append(order)
+                raise
+            else:
+                sold.append(order.pk)
+
+        self.run_concurrently(checkout)
+        self.assertEqual(len(sold), stock)
+        self.assertEqual(len(refused), self.threads * self.clicks - stock)
+        self.assertEqual(Item.objects.get(pk=item.pk).stock, 0)
+        self.assertEqual(Item.objects.get(pk=other.pk).stock, 5)
+        self.assertEqual(sum(OrderItem.objects.values_list('reserved', flat=True)), stock * 2)
+
+
+def retry_on_lock(func, attempts=50):
+    # sqlite reports a competing writer as an error instead of waiting for it
+    for attempt in range(attempts):
+        try:
+            return func()
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(0.01)
+
+
+class FinalizeOrderTests(StoreTestCase):
+    def finalize(self, lines):
+        make_cart(self.user, [make_item(n) for n in range(lines)], quantity=2)
+        order = Order.objects.get_cart(self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            payment = services.finalize_order(order, 'ch_test')
+        return payment, len(ctx)
+
+    def test_marks_order_and_lines_ordered(self):
+        payment, _ = self.finalize(3)
+        order = Order.objects.get()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment, payment)
+        self.assertEqual(len(order.ref_code), 20)
+        self.assertEqual(payment.amount, 2 * (10.0 + 11.0 + 12.0))
+        self.assertFalse(OrderItem.objects.filter(ordered=False).exists())
+
+    def test_queries_do_not_grow_with_cart(self):
+        _, small = self.finalize(1)
+        Order.objects.all().delete()
+        Item.objects.all().delete()
+        _, large = self.finalize(30)
+        self.assertEqual(small, large)
+        self.assertEqual(Payment.objects.count(), 2)
+
+
+class OrderExportTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.coupon = Coupon.objects.create(code='TENOFF', amount=10)
+        self.address = Address.objects.create(
+            user=self.user, street_address='1 Main St', appertment_address='',
+            country='IN', zip='400001', address_type='B')
+        self.orders = []
+        for day, lines in [(1, 2), (2, 1), (3, 3)]:
+            make_cart(self.user, [make_item(day * 10 + n) for n in range(lines)], quantity=2)
+            order = Order.objects.with_totals().get(ordered=False)
+            services.finalize_order(order, f'ch_{day}')
+            Order.objects.filter(pk=order.pk).update(
+                ordered_date=timezone.make_aware(timezone.datetime(2026, 3, day, 12)))
+            self.orders.append(order)
+        Order.objects.filter(pk=self.orders[0].pk).update(
+            coupon=self.coupon, billing_address=self.address)
+        make_cart(self.user, [make_item(99)])
+
+    def export(self, *args):
+        out = StringIO()
+        call_command('export_orders', *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv(self):
+        rows = list(csv.DictReader(StringIO(self.export())))
+        self.assertEqual(len(rows), 6)
+        first = rows[0]
+        self.assertEqual(first['order'], str(self.orders[0].pk))
+        self.assertEqual(first['charge_id'], 'ch_1')
+        self.assertEqual(first['amount_paid'], '82.00')
+        self.assertEqual((first['coupon'], first['coupon_amount']), ('TENOFF', '10.00'))
+        self.assertEqual((first['billing_street'], first['billing_country']), ('1 Main St', 'IN'))
+        self.assertEqual((first['item'], first['quantity'], first['unit_price']),
+                         ('item-10', '2', '20.00'))
+        self.assertEqual(rows[2]['coupon'], '')
+
+    def test_json_and_date_range(self):
+        orders = json.loads(self.export(
+            '--format=json', '--since=2026-03-02', '--until=2026-03-03'))
+        self.assertEqual([order['order'] for order in orders],
+                         [order.pk for order in self.orders[1:]])
+        self.assertEqual([len(order['lines']) for order in orders], [1, 3])
+        self.assertEqual(orders[1]['lines'][0],
+                         {'item': 'item-30', 'title': 'Item 30', 'quantity': 2,
+                          'unit_price': '40.00'})
+
+    def test_ordered_date_is_when_it_was_paid_for(self):
+        order = Order.objects.with_totals().get(ordered=False)
+        Order.objects.filter(pk=order.pk).update(ordered_date=order.ordered_date - timedelta(days=3))
+        order.refresh_from_db()
+        payment = services.finalize_order(order, 'ch_late')
+        self.assertEqual(Order.objects.get(pk=order.pk).ordered_date, payment.timestamp)
+        today = timezone.localdate(payment.timestamp)
+        self.assertEqual(list(exports.orders_between(since=today, until=today)), [order])
+
+    def test_one_query_however_many_orders(self):
+        with self.assertNumQueries(1):
+            rows = list(exports.export_rows(exports.orders_between(), chunk_size=2))
+        self.assertEqual(len(rows), 6)
+
+    def test_admin_action(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        response = self.client.post(reverse('admin:core_order_changelist'), {
+            'action': 'export_orders_csv',
+            '_selected_action': [order.pk for order in Order.objects.all()],
+        })
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="orders.csv"')
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode())))
+        # a header and the placed orders' lines, not the open cart
+        self.assertEqual(len(rows), 7)
+
+
+class PaymentJobTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        make_cart(self.user, [make_item(1)])
+        self.url = reverse('core:payment', kwargs={'payment_option': 'stripe'})
+
+    def pay(self, token='tok_visa'):
+        response = self.client.post(self.url, {'stripeToken': token})
+        job = PaymentJob.objects.get()
+        self.assertRedirects(
+            response, reverse('core:payment-status', kwargs={'pk': job.pk}),
+            fetch_redirect_response=False)
+        return job
+
+    def test_view_enqueues_without_charging(self):
+        job = self.pay()
+        self.assertEqual(job.status, PaymentJob.PENDING)
+        self.assertEqual(job.gateway, 'stripe')
+        self.assertEqual(job.amount, 11.0)
+        self.assertFalse(Order.objects.get().ordered)
+
+        response = self.client.get(
+            reverse('core:payment-status', kwargs={'pk': job.pk}))
+        self.assertTemplateUsed(response, 'payment_pending.html')
+
+    def test_resubmitting_reuses_pending_job(self):
+        self.pay()
+        self.client.post(self.url, {'stripeToken': 'tok_visa'})
+        self.assertEqual(PaymentJob.objects.count(), 1)
+
+    def test_payment_page_needs_a_cart(self):
+        Order.objects.all().delete()
+        for response in (self.client.get(self.url),
+                         self.client.post(self.url, {'stripeToken': 'tok_visa'})):
+            self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertRedirects(response, f"{reverse('account_login')}?next={self.url}",
+                             fetch_redirect_response=False)
+
+    def test_unknown_payment_option_is_rejected(self):
+        url = reverse('core:payment', kwargs={'payment_option': 'bitcoin'})
+        response = self.client.post(url, {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, reverse('core:checkout'),
+                             fetch_redirect_response=False)
+        self.assertFalse(PaymentJob.objects.exists())
+
+    def test_worker_charges_and_finalizes(self):
+        job = self.pay()
+        self.assertEqual(jobs.process_payment_jobs(), 1)
+
+        charge = get_gateway('stripe').charges[0]
+        self.assertEqual(charge['amount'], 11.0)
+        self.assertEqual(charge['token'], 'tok_visa')
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.SUCCEEDED)
+        order = Order.objects.get()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment.stripe_charge_id, 'fake_1')
+
+        response = self.client.get(
+            reverse('core:payment-status', kwargs={'pk': job.pk}))
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    def test_paypal_orders_use_paypal_gateway(self):
+        url = reverse('core:payment', kwargs={'payment_option': 'paypal'})
+        self.client.post(url, {'paypalOrderID': 'PAYPAL-ORDER-1'})
+        jobs.process_payment_jobs()
+        self.assertEqual(get_gateway('paypal').charges[0]['token'], 'PAYPAL-ORDER-1')
+        self.assertEqual(get_gateway('stripe').charges, [])
+
+    def test_paypal_order_is_created_for_the_cart_total(self):
+        response = self.client.post(reverse('core:paypal-order'))
+        paypal_order = response.json()['id']
+        self.assertEqual(get_gateway('paypal').orders[paypal_order], Decimal('11.00'))
+
+        url = reverse('core:payment', kwargs={'payment_option': 'paypal'})
+        self.client.post(url, {'paypalOrderID': paypal_order})
+        jobs.process_payment_jobs()
+        self.assertEqual(PaymentJob.objects.get().status, PaymentJob.SUCCEEDED)
+
+    def test_paypal_order_for_another_amount_is_refused(self):
+        # made in the browser for a cent
+        paypal_order = get_gateway('paypal').create_order(Decimal('0.01'))
+        url = reverse('core:payment', kwargs={'payment_option': 'paypal'})
+        self.client.post(url, {'paypalOrderID': paypal_order})
+        jobs.process_payment_jobs()
+        job = PaymentJob.objects.get()
+        self.assertEqual(job.status, PaymentJob.FAILED)
+        self.assertEqual(job.error, "The PayPal payment doesn't match your order total")
+        self.assertFalse(Order.objects.get().ordered)
+
+    def test_used_token_is_refused(self):
+        self.pay('PAYPAL-ORDER-1')
+        jobs.process_payment_jobs()
+        make_cart(self.user, [make_item(2)])
+        response = self.client.post(self.url, {'stripeToken': 'PAYPAL-ORDER-1'})
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        self.assertEqual(PaymentJob.objects.count(), 1)
+        self.assertEqual(Order.objects.filter(ordered=True).count(), 1)
+
+    def test_paypal_page_renders_paypal_buttons(self):
+        response = self.client.get(
+            reverse('core:payment', kwargs={'payment_option': 'paypal'}))
+        self.assertContains(response, 'paypal-button-container')
+        self.assertNotContains(response, 'js.stripe.com')
+
+    def test_declined_card_fails_job(self):
+        job = self.pay('decline_card')
+        jobs.process_payment_jobs()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.FAILED)
+        self.assertEqual(job.error, 'Your card was declined.')
+        self.assertFalse(Order.objects.get().ordered)
+
+    def test_network_errors_are_retried(self):
+        job = self.pay('offline')
+        jobs.process_payment_jobs(limit=1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.PENDING)
+
+        jobs.process_payment_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.FAILED)
+        self.assertEqual(job.attempts, jobs.MAX_ATTEMPTS)
+
+    def test_claimed_job_is_not_handed_out_twice(self):
+        self.pay()
+        self.assertIsNotNone(jobs.claim_next_job())
+        self.assertIsNone(jobs.claim_next_job())
+
+    def test_other_users_cannot_see_job(self):
+        job = self.pay()
+        self.client.force_login(get_user_model().objects.create_user('other'))
+        response = self.client.get(
+            reverse('core:payment-status', kwargs={'pk': job.pk}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_cart_is_locked_while_paying(self):
+        item = make_item(2, stock=5)
+        self.pay()
+        with self.assertRaises(services.CartLocked):
+            services.add_to_cart(self.user, item, quantity=3)
+        response = self.client.patch(
+            reverse('core:api-cart-line', kwargs={'slug': 'item-1'}),
+            json.dumps({'quantity': 0}), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+
+        jobs.process_payment_jobs()
+        order = Order.objects.get()
+        self.assertTrue(order.ordered)
+        # only what was charged for
+        self.assertEqual([line.item.slug for line in order.items.all()], ['item-1'])
+        self.assertEqual(Item.objects.get(pk=item.pk).stock, 5)
+        # a new cart can be filled again
+        services.add_to_cart(self.user, item)
+
+    def test_status_page_refreshes_the_cart_badge(self):
+        job = self.pay()
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        # as if the worker ran with its own cache
+        with mock.patch.object(services, 'invalidate_cart_item_count'):
+            jobs.process_payment_jobs()
+        self.assertEqual(get_cart_item_count(self.user), 1)
+        self.client.get(reverse('core:payment-status', kwargs={'pk': job.pk}))
+        self.assertEqual(get_cart_item_count(self.user), 0)
+
+    def test_checkout_waits_for_the_payment(self):
+        address = {'street_address': '1 Main St', 'country': 'IN', 'zip': '400001',
+                   'payment_options': 'S'}
+        response = self.client.post(reverse('core:checkout'), address)
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        self.assertIsNotNone(Order.objects.get().billing_address)
+
+        self.pay()
+        response = self.client.post(reverse('core:checkout'), address)
+        self.assertRedirects(response, reverse('core:ordersummary'),
+                             fetch_redirect_response=False)
+        self.assertEqual(Address.objects.count(), 1)
+        jobs.process_payment_jobs()
+        # the paid order wasn't written over
+        order = Order.objects.get()
+        self.assertTrue(order.ordered)
+        self.assertIsNotNone(order.ref_code)
+
+    def test_failed_finalize_is_retried_without_charging_again(self):
+        job = self.pay()
+        with mock.patch.object(services, 'finalize_order', side_effect=RuntimeError):
+            with self.assertLogs('core.jobs', 'ERROR'):
+                jobs.process_payment_jobs(limit=1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.charge_id), (PaymentJob.PENDING, 'fake_1'))
+
+        jobs.process_payment_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, PaymentJob.SUCCEEDED)
+        self.assertEqual(len(get_gateway('stripe').charges), 1)
+        self.assertEqual(Order.objects.get().payment.stripe_charge_id, 'fake_1')
+
+    def test_stuck_job_is_reclaimed(self):
+        job = self.pay()
+        self.assertIsNotNone(jobs.claim_next_job())
+        # the worker charged it, then died
+        get_gateway('stripe').charge(job.amount, job.token,
+                                     idempotency_key=f'payment-job-{job.pk}')
+        self.assertEqual(jobs.process_payment_jobs(), 0)
+
+        PaymentJob.objects.update(
+            updated=timezone.now() - timedelta(seconds=jobs.JOB_TIMEOUT + 1))
+        with self.assertLogs('core.jobs', 'WARNING'):
+            self.assertEqual(jobs.process_payment_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (PaymentJob.SUCCEEDED, 2))
+        self.assertEqual(len(get_gateway('stripe').charges), 1)
+
+
+class RequestMetricsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        make_item(1)
+
+    def test_records_view_totals(self):
+        with self.assertLogs('core.metrics', 'INFO') as logs:
+            response = self.client.get(reverse('core:home'))
+            self.client.get(reverse('core:home'))
+        totals = metrics.registry.snapshot()['core:home']
+        self.assertEqual(totals['requests'], 2)
+        self.assertGreater(totals['queries'], 0)
+        self.assertGreater(totals['render_seconds'], 0)
+        self.assertEqual(totals['response_bytes'], 2 * len(response.content))
+        self.assertEqual(totals['over_query_budget'], 0)
+        record = logs.records[0].metrics
+        self.assertEqual((record['view'], record['status']), ('core:home', 200))
+
+    @override_settings(VIEW_QUERY_BUDGETS={'core:home': 0})
+    def test_flags_requests_over_budget(self):
+        with self.assertLogs('core.metrics', 'WARNING') as logs:
+            self.client.get(reverse('core:home'))
+        self.assertIn('over query budget (0) view=core:home', logs.output[0])
+        self.assertEqual(metrics.registry.snapshot()['core:home']['over_query_budget'], 1)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_prometheus_endpoint(self):
+        self.client.get(reverse('core:product', kwargs={'slug': 'item-1'}))
+        url = reverse('core:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('# TYPE ecommerce_view_queries_total counter', body)
+        self.assertIn('ecommerce_view_requests_total{view="core:product"} 1', body)
+
+    def test_endpoint_is_staff_only_without_token(self):
+        self.assertEqual(self.client.get(reverse('core:metrics')).status_code, 403)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('core:metrics')).status_code, 200)
+
+
+class ImportItemsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.media = os.path.join(self.tmp.name, 'media')
+        self.images_dir = os.path.join(self.tmp.name, 'images')
+        os.makedirs(os.path.join(self.images_dir, 'shirts'))
+        for name, size in [('shirts/blue.png', (1200, 800)), ('shirts/red.png', (200, 100))]:
+            Image.new('RGBA', size, 'blue').save(os.path.join(self.images_dir, name))
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def run_import(self, path, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_items', path, '--workers=1', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import(self):
+        path = self.write('items.csv', (
+            'slug,title,price,discount_price,catagory,label,description,image\n'
+            'blue-tee,Blue tee,30.00,,s,P,A blue tee,shirts/blue.png\n'
+            'red-tee,Red tee,20.00,15.00,sw,S,A red tee,shirts/red.png\n'
+            'bad-price,Bad,lots,,s,P,Nope,shirts/red.png\n'
+            'bad-cat,Bad,1,,xx,P,Nope,shirts/red.png\n'
+            'no-image,No image,1,,s,P,Nope,\n'
+        ))
+        out, err = self.run_import(path, f'--images-dir={self.images_dir}')
+        self.assertIn('Created 2 and updated 0 item(s), with 2 image(s) and 3 error(s)', out)
+        self.assertIn("line 4: price: “lots” value must be a decimal number.", err)
+        self.assertIn("line 5: catagory: Value 'xx' is not a valid choice.", err)
+        self.assertIn('line 6: image: This field cannot be blank.', err)
+
+        blue = Item.objects.get(slug='blue-tee')
+        self.assertEqual(blue.effective_price, Decimal('30.00'))
+        self.assertEqual(Item.objects.get(slug='red-tee').effective_price, Decimal('15.00'))
+        self.assertTrue(os.path.exists(os.path.join(self.media, 'shirts/blue.png')))
+        for width in images.THUMBNAIL_WIDTHS:
+            for ext in images.FORMATS:
+                name = images.variant_name(blue.image_hash, width, ext)
+                with Image.open(os.path.join(self.media, name)) as variant:
+                    self.assertEqual(variant.size, (width, width * 2 // 3))
+        # the catalogue was refreshed after the bulk writes
+        self.assertEqual(FacetCount.objects.get(facet='catagory', value='s').count, 1)
+        self.assertEqual(search.search_items('blue')[0], [blue])
+
+        response = self.client.get(reverse('core:home'))
+        self.assertContains(response, images.variant_url(blue, 300, 'jpg'))
+        self.assertContains(response, images.srcset(blue))
+        self.assertIn(f'{blue.image_hash}-300w.jpg', images.variant_url(blue, 300, 'jpg'))
+
+    def test_jsonl_update(self):
+        blue = make_item(1, slug='blue-tee', image='shirts/blue.png', image_hash='abc')
+        path = self.write('items.jsonl', '\n'.join([
+            json.dumps({'slug': 'blue-tee', 'price': '8.50'}),
+            '',
+            json.dumps({'slug': 'green-tee', 'title': 'Green tee'}),
+            json.dumps({'slug': 'blue-tee', 'discount_price': '7.00', 'stock': 4}),
+            '["blue-tee"]',
+            '42',
+        ]))
+        out, err = self.run_import(path)
+        self.assertIn('Created 0 and updated 1 item(s), with 0 image(s) and 3 error(s)', out)
+        self.assertIn('line 3: new items need catagory, description, image, label, price', err)
+        self.assertIn('line 5: expected an object', err)
+        self.assertIn('line 6: expected an object', err)
+        blue.refresh_from_db()
+        # the later row for the slug won, and the columns it didn't have kept
+        self.assertEqual((blue.price, blue.discount_price, blue.stock, blue.title),
+                         (Decimal('11.00'), Decimal('7.00'), 4, 'Item 1'))
+        self.assertEqual(blue.image_hash, 'abc')
+
+        path = self.write('image.jsonl', json.dumps({'slug': 'blue-tee', 'image': 'shirts/red.png'}))
+        self.run_import(path, '--skip-images')
+        blue.refresh_from_db()
+        # the old renditions aren't of the new image
+        self.assertEqual((blue.image.name, blue.image_hash), ('shirts/red.png', ''))
+        self.assertEqual(images.variant_url(blue, 300),
+                         reverse('core:image', kwargs={'pk': blue.pk, 'width': 300, 'ext': 'webp'}))
+
+
+class ImageVariantTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.media = tmp.name
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(self.media, 'shirts'))
+        Image.new('RGB', (1000, 500), 'red').save(os.path.join(self.media, 'shirts/red.jpg'))
+        self.item = make_item(1, image='shirts/red.jpg')
+
+    def test_variant_is_made_on_demand(self):
+        url = images.variant_url(self.item, 600)
+        response = self.client.get(url)
+        self.item.refresh_from_db()
+        self.assertRedirects(response, images.variant_url(self.item, 600),
+                             fetch_redirect_response=False)
+        self.assertIn('max-age=3600', response['Cache-Control'])
+
+        response = self.client.get(images.variant_url(self.item, 600))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn(f'max-age={views.VARIANT_MAX_AGE}', response['Cache-Control'])
+        self.assertNotIn('Vary', response)
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as variant:
+            self.assertEqual((variant.format, variant.size), ('WEBP', (600, 300)))
+        name = images.variant_name(self.item.image_hash, 600, 'webp')
+        self.assertTrue(os.path.exists(os.path.join(self.media, name)))
+        # only what was asked for
+        self.assertFalse(os.path.exists(os.path.join(
+            self.media, images.variant_name(self.item.image_hash, 300, 'webp'))))
+
+        # served from disk from then on, and never bigger than the original
+        with mock.patch.object(images, 'render_variant', side_effect=AssertionError):
+            self.assertEqual(self.client.get(images.variant_url(self.item, 600)).status_code, 200)
+        response = self.client.get(images.variant_url(self.item, 1200, 'jpg'))
+        with Image.open(BytesIO(b''.join(response.streaming_content))) as variant:
+            self.assertEqual((variant.format, variant.size), ('JPEG', (1000, 500)))
+
+    def test_stale_hash_redirects(self):
+        images.get_variant(self.item, 300, 'webp')
+        old_url = images.variant_url(self.item, 300)
+        Image.new('RGB', (400, 400), 'green').save(os.path.join(self.media, 'shirts/green.jpg'))
+        self.item = Item.objects.get(pk=self.item.pk)
+        self.item.image = 'shirts/green.jpg'
+        self.item.save()
+        self.item.refresh_from_db()
+        # a new image gets new renditions
+        self.assertEqual(self.item.image_hash, '')
+        response = self.client.get(old_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotEqual(response['Location'], old_url)
+
+    def test_unknown_sizes_and_broken_images_404(self):
+        kwargs = {'pk': self.item.pk, 'width': 301, 'ext': 'webp'}
+        self.assertEqual(self.client.get(reverse('core:image', kwargs=kwargs)).status_code, 404)
+        kwargs.update(width=300, ext='gif')
+        self.assertEqual(self.client.get(reverse('core:image', kwargs=kwargs)).status_code, 404)
+        broken = make_item(2, image='shirts/missing.jpg')
+        self.assertEqual(self.client.get(images.variant_url(broken, 300)).status_code, 404)
+
+    def test_srcset_lists_every_width(self):
+        self.assertEqual(images.srcset(self.item, 'jpg').count(', '),
+                         len(images.VARIANT_WIDTHS) - 1)
+        response = self.client.get(reverse('core:product', kwargs={'slug': 'item-1'}))
+        self.assertContains(response, images.srcset(self.item, 'webp'))
+
+
+class GatewayTests(TestCase):
+    def test_gateway_is_built_once(self):
+        with override_settings(PAYMENT_GATEWAYS=FAKE_GATEWAYS):
+            self.assertIs(get_gateway('stripe'), get_gateway('stripe'))
+            self.assertIsNot(get_gateway('stripe'), get_gateway('paypal'))
+
+    def test_stripe_gateway_converts_amount(self):
+        gateway = StripeGateway(api_key='sk_test')
+        with mock.patch('stripe.Charge.create', return_value={'id': 'ch_1'}) as create:
+            self.assertEqual(gateway.charge(11.5, 'tok_visa', idempotency_key='job-1'), 'ch_1')
+        self.assertEqual(create.call_args[1]['amount'], 11 * 77)
+        self.assertEqual(create.call_args[1]['api_key'], 'sk_test')
+        self.assertEqual(create.call_args[1]['idempotency_key'], 'job-1')
+
+    def paypal_gateway(self, order_amount, capture_amount):
+        gateway = PayPalGateway(client_id='id', secret='secret')
+        gateway.access_token = lambda: 'token'
+        responses = [
+            {'purchase_units': [{'amount': {'currency_code': 'USD', 'value': order_amount}}]},
+            {'purchase_units': [{'payments': {'captures': [
+                {'id': 'CAPTURE-1', 'amount': {'currency_code': 'USD', 'value': capture_amount}},
+            ]}}]},
+        ]
+        gateway.session = mock.Mock()
+        gateway.session.request.side_effect = [
+            mock.Mock(status_code=200, ok=True, **{'json.return_value': data})
+            for data in responses]
+        return gateway
+
+    def test_paypal_gateway_checks_amounts(self):
+        gateway = self.paypal_gateway('11.50', '11.50')
+        self.assertEqual(gateway.charge(Decimal('11.5'), 'ORDER-1', idempotency_key='job-1'),
+                         'CAPTURE-1')
+        method, url = gateway.session.request.call_args[0]
+        self.assertEqual((method, url), ('POST', f'{gateway.base_url}/v2/checkout/orders/ORDER-1/capture'))
+        self.assertEqual(gateway.session.request.call_args[1]['headers']['PayPal-Request-Id'], 'job-1')
+
+        # approved for less: never captured
+        gateway = self.paypal_gateway('0.01', '0.01')
+        with self.assertRaises(PaymentError):
+            gateway.charge(Decimal('11.50'), 'ORDER-1')
+        self.assertEqual(gateway.session.request.call_count, 1)
+
+        gateway = self.paypal_gateway('11.50', '0.01')
+        with self.assertRaises(PaymentError):
+            gateway.charge(Decimal('11.50'), 'ORDER-1')
+
+    def test_stripe_errors_become_payment_errors(self):
+        gateway = StripeGateway(api_key='sk_test')
+        cases = [
+            (stripe.error.CardError('Your card was declined.', None, 'card_declined'),
+             'Your card was declined.', False),
+            (stripe.error.APIConnectionError('offline'), 'Network Error', True),
+            (stripe.error.AuthenticationError('bad key'), 'Not authenticated', False),
+        ]
+        for error, message, retryable in cases:
+            with mock.patch('stripe.Charge.create', side_effect=error):
+                with self.assertRaises(PaymentError) as ctx:
+                    gateway.charge(10, 'tok_visa')
+            self.assertEqual(ctx.exception.message, message)
+            self.assertEqual(ctx.exception.retryable, retryable)
+
+
+class CatalogueCacheTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.logout()
+        self.item = make_item(1)
+
+    def test_home_grid_is_cached(self):
+        self.client.get('/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/')
+        self.assertContains(response, 'Item 1')
+
+    def test_pages_are_cached_separately(self):
+        for n in range(2, 13):
+            make_item(n)
+        self.assertNotContains(
+            self.client.get(f'/?after={self.item.pk + 2}'), 'Item 12<')
+        self.assertContains(self.client.get('/'), 'Item 12')
+
+    def test_saving_item_invalidates_grid_and_detail(self):
+        url = self.item.get_absolute_url()
+        self.client.get('/')
+        self.client.get(url)
+
+        self.item.title = 'Renamed'
+        self.item.description = 'Now in blue'
+        self.item.save()
+        self.assertContains(self.client.get('/'), 'Renamed')
+        self.assertContains(self.client.get(url), 'Now in blue')
+
+    def test_deleting_item_invalidates_detail(self):
+        url = self.item.get_absolute_url()
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.item.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_cart_badge_is_not_cached_with_grid(self):
+        self.client.get('/')
+        make_cart(self.user, [self.item])
+        self.client.force_login(self.user)
+        response = self.client.get('/')
+        self.assertContains(response, '<span class="badge red z-depth-1 mr-1"> 1</span>', html=True)
+
+
+def bulk_items(count):
+    Item.objects.bulk_create(
+        Item(title=f'Item {n}', image=f'item-{n}.jpg', price=10.0, effective_price=10.0,
+             catagory='s', label='P', slug=f'item-{n}', description='')
+        for n in range(count))
+
+
+class KeysetPaginationTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        bulk_items(25)
+        self.pks = list(Item.objects.order_by('-pk').values_list('pk', flat=True))
+
+    def test_walks_forward_and_back(self):
+        paginator = KeysetPaginator(Item.objects.all(), 10)
+        first = paginator.page()
+        self.assertEqual([i.pk for i in first], self.pks[:10])
+        self.assertFalse(first.has_previous)
+
+        second = paginator.page(after=first.after)
+        self.assertEqual([i.pk for i in second], self.pks[10:20])
+        last = paginator.page(after=second.after)
+        self.assertEqual([i.pk for i in last], self.pks[20:])
+        self.assertFalse(last.has_next)
+
+        back = paginator.page(before=last.before)
+        self.assertEqual([i.pk for i in back], self.pks[10:20])
+        self.assertEqual(paginator.page(before=back.before).object_list,
+                         first.object_list)
+        self.assertFalse(paginator.page(before=back.before).has_previous)
+
+    def test_home_page_has_no_count_or_offset(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(f'/?after={self.pks[9]}')
+        self.assertContains(response, f'?after={self.pks[19]}')
+        self.assertContains(response, f'?before={self.pks[10]}')
+        item_queries = [q['sql'] for q in ctx if '"core_item"' in q['sql']]
+        self.assertEqual(len(item_queries), 1)
+        self.assertNotIn('COUNT(', item_queries[0])
+        self.assertNotIn('OFFSET', item_queries[0])
+
+    def test_bad_cursor_is_404(self):
+        self.assertEqual(self.client.get('/?after=abc').status_code, 404)
+
+    def test_json_listing(self):
+        response = self.client.get(reverse('core:api-items'))
+        data = response.json()
+        self.assertEqual([i['id'] for i in data['items']], self.pks[:10])
+        self.assertIsNone(data['previous'])
+        data = self.client.get(data['next']).json()
+        self.assertEqual([i['id'] for i in data['items']], self.pks[10:20])
+        self.assertEqual(data['items'][0]['url'],
+                         reverse('core:product', kwargs={'slug': data['items'][0]['slug']}))
+
+
+class KeysetPaginationBenchmark(TestCase):
+    """Page 1000 of the catalogue should cost about the same as page 1."""
+
+    per_page = 10
+    pages = 1000
+
+    def time_page(self, paginator, after=None, runs=7):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            list(paginator.page(after=after))
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings)
+
+    def test_deep_page_latency_matches_first_page(self):
+        bulk_items(self.per_page * self.pages)
+        paginator = KeysetPaginator(Item.objects.all(), self.per_page)
+        deep_cursor = Item.objects.order_by('-pk').values_list(
+            'pk', flat=True)[self.per_page * (self.pages - 1) - 1]
+
+        first = self.time_page(paginator)
+        deep = self.time_page(paginator, after=deep_cursor)
+        self.assertEqual(len(paginator.page(after=deep_cursor)), self.per_page)
+        # generous bounds: an OFFSET scan of 10k rows would blow well past them
+        self.assertLess(deep, first * 3 + 0.002,
+                        f'page 1: {first * 1000:.2f}ms, page {self.pages}: {deep * 1000:.2f}ms')
+
+
+class SeedStoreTests(StoreTestCase):
+    def seed(self, prefix, **kwargs):
+        options = {'items': 30, 'customers': 12, 'max_orders': 3, 'max_lines': 4,
+                   'chunk_size': 5, 'seed': 7}
+        options.update(kwargs)
+        out = StringIO()
+        call_command('seed_store', prefix=prefix, stdout=out, **options)
+        return out.getvalue()
+
+    def test_seeds_a_consistent_store(self):
+        output = self.seed('one')
+        self.assertIn('Created 30 items, 12 users, 12 addresses', output)
+        self.assertEqual(Item.objects.count(), 30)
+        self.assertEqual(FacetCount.objects.filter(facet='catagory')
+                         .aggregate(total=Sum('count'))['total'], 30)
+        orders = Order.objects.filter(user__username__startswith='one-').with_totals()
+        self.assertTrue(orders.exists())
+        for order in orders:
+            self.assertTrue(order.items.exists())
+            self.assertEqual(order.items.filter(ordered=order.ordered).count(),
+                             order.items.count())
+            if order.ordered:
+                self.assertEqual(order.payment.amount, order.get_total_price())
+                self.assertIsNotNone(order.billing_address)
+            else:
+                self.assertIsNone(order.payment_id)
+        # new rows still get pks after the explicit ones
+        self.assertGreater(make_item(999).pk, Item.objects.exclude(slug='item-999')
+                           .aggregate(pk=Max('pk'))['pk'])
+
+    def test_copy_buffer_writes_null_unquoted(self):
+        fields = [Item._meta.get_field(name)
+                  for name in ['title', 'description', 'price', 'discount_price', 'stock']]
+        item = Item(title='The "big" tee', description='', price=Decimal('1.50'))
+        self.assertEqual(seed.copy_buffer(fields, [item]).getvalue(),
+                         '"The ""big"" tee","","1.50",,\n')
+
+    def test_same_seed_same_store(self):
+        def store(prefix):
+            users = get_user_model().objects.filter(username__startswith=f'{prefix}-')
+            return [
+                [(order.ordered, sorted((line.item.title, line.quantity)
+                                        for line in order.items.all()))
+                 for order in Order.objects.filter(user=user).order_by('pk')]
+                for user in users.order_by('pk')
+            ]
+
+        self.seed('catalogue', customers=0)
+        self.seed('one', items=0)
+        self.seed('two', items=0)
+        self.assertEqual(store('one'), store('two'))
+        self.seed('three', items=0, seed=8)
+        self.assertNotEqual(store('one'), store('three'))
+
+
+@override_settings(
+    STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+    PAYMENT_GATEWAYS=FAKE_GATEWAYS)
+class StorefrontBenchmarkTests(TransactionTestCase):
+    """Replays the saved benchmark and holds every step to the query counts
+    in benchmarks/baseline.json. Timings are left to the `benchmark`
+    command, they depend on the machine.
+
+    Not a TestCase: its savepoints would add queries the command doesn't see.
+    """
+
+    baseline_path = settings.BASE_DIR + '/benchmarks/baseline.json'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_query_counts_match_baseline(self):
+        baseline = benchmark.load_baseline(self.baseline_path)
+        params = baseline['params']
+        seed.seed_items(params['items'], seed=params['seed'])
+        users = seed.seed_users(params['users'])
+        seed.seed_carts(users, Item.objects.all(), params['cart_lines'], seed=params['seed'])
+
+        report = benchmark.run_benchmark(
+            users.order_by('pk'), journeys=params['journeys'], picks=params['picks'],
+            seed=params['seed'])
+        summary = report.summary()
+        self.assertEqual(set(summary), set(benchmark.STEPS))
+        self.assertEqual(sum(row['errors'] for row in summary.values()), 0)
+        self.assertEqual(benchmark.compare(summary, baseline, tolerance=float('inf')), [])
+        # every journey was paid for
+        self.assertEqual(Order.objects.filter(ordered=True).count(),
+                         params['users'] * params['journeys'])
+
+    def test_compare(self):
+        baseline = {'steps': {'home': {'queries': 2.0, 'p50_ms': 10.0, 'p95_ms': 12.0}}}
+        # the p95 is too noisy to fail on
+        self.assertEqual(benchmark.compare(
+            {'home': {'queries': 2.0, 'p50_ms': 14.0, 'p95_ms': 100.0}}, baseline), [])
+        self.assertEqual(benchmark.compare(
+            {'home': {'queries': 3.0, 'p50_ms': 16.0, 'p95_ms': 16.0}}, baseline), [
+                'home: 3.0 queries per request, baseline 2.0',
+                'home: p50 16.0ms, baseline 10.0ms',
+        ])
+
+    def test_compare_errors_and_missing_steps(self):
+        baseline = {'steps': {
+            'home': {'errors': 0, 'queries': 2.0, 'p50_ms': 10.0},
+            'payment': {'errors': 0, 'queries': 14.0, 'p50_ms': 20.0},
+        }}
+        self.assertEqual(benchmark.compare(
+            {'home': {'errors': 3, 'queries': 2.0, 'p50_ms': 10.0}}, baseline), [
+                'home: 3 errors, baseline 0',
+                'payment: missing from the run',
+        ])
+
+
+def facet_counts():
+    return {(row.facet, row.value): row.count
+            for row in FacetCount.objects.filter(count__gt=0)}
+
+
+class FacetTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shirt = make_item(1, catagory='s', label='P', price=20.0)
+        self.wear = make_item(2, catagory='sw', label='S', price=60.0, discount_price=40.0)
+        self.outwear = make_item(3, catagory='ow', label='D', price=120.0)
+
+    def test_counts_follow_saves_and_deletes(self):
+        self.assertEqual(facet_counts(), {
+            ('catagory', 's'): 1, ('catagory', 'sw'): 1, ('catagory', 'ow'): 1,
+            ('label', 'P'): 1, ('label', 'S'): 1, ('label', 'D'): 1,
+            ('price', '0-25'): 1, ('price', '25-50'): 1, ('price', '100-'): 1,
+        })
+
+        item = Item.objects.get(pk=self.shirt.pk)
+        item.catagory = 'sw'
+        item.price = 30.0
+        item.save()
+        counts = facet_counts()
+        self.assertNotIn(('catagory', 's'), counts)
+        self.assertEqual(counts[('catagory', 'sw')], 2)
+        self.assertEqual(counts[('price', '25-50')], 2)
+
+        Item.objects.get(pk=self.outwear.pk).delete()
+        counts = facet_counts()
+        self.assertNotIn(('catagory', 'ow'), counts)
+        self.assertNotIn(('price', '100-'), counts)
+
+    def test_rebuild_matches_incremental_counts(self):
+        Item.objects.get(pk=self.wear.pk).delete()
+        make_item(4, catagory='ow', label='P', price=75.0)
+        incremental = facet_counts()
+        FacetCount.objects.all().delete()
+        rebuild_facets()
+        self.assertEqual(facet_counts(), incremental)
+
+    def test_filter_items(self):
+        def titles(**filters):
+            return sorted(filter_items(Item.objects.all(), filters)
+                          .values_list('title', flat=True))
+        self.assertEqual(titles(catagory='sw'), ['Item 2'])
+        self.assertEqual(titles(label='D'), ['Item 3'])
+        # the discounted price is what counts
+        self.assertEqual(titles(min_price=25.0, max_price=50.0), ['Item 2'])
+        self.assertEqual(titles(min_price=100.0), ['Item 3'])
+        self.assertEqual(titles(catagory='s', label='D'), [])
+
+    def test_listing_is_filtered_and_shows_facets(self):
+        response = self.client.get('/?catagory=ow')
+        self.assertContains(response, 'Item 3')
+        self.assertNotContains(response, 'Item 1<')
+        self.assertContains(response, '?catagory=sw')
+        self.assertContains(response, '?catagory=ow&amp;label=D')
+        self.assertContains(response, '?catagory=ow&amp;max_price=50&amp;min_price=25')
+
+    def test_price_filters_are_cached_exactly(self):
+        Item.objects.filter(title='Item 3').update(price=Decimal('12345.68'), discount_price=None,
+                                                   effective_price=Decimal('12345.68'))
+        self.assertContains(self.client.get('/?min_price=12345.67'), 'Item 3')
+        response = self.client.get('/?min_price=12345.69')
+        self.assertNotContains(response, 'Item 3')
+        self.assertContains(response, '?min_price=12345.69&amp;sort=price')
+        self.assertEqual(views.filter_query({'min_price': Decimal('25.00')}), 'min_price=25')
+        self.assertEqual(views.filter_query({'min_price': Decimal('1234567')}),
+                         'min_price=1234567')
+
+    def test_bad_filter_values_are_ignored(self):
+        response = self.client.get('/?catagory=nope&min_price=abc')
+        self.assertContains(response, 'Item 1')
+        self.assertContains(response, 'Item 3')
+
+    def test_cached_filtered_page_skips_counting(self):
+        self.client.get('/?label=S')
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get('/?label=S')
+        self.assertContains(response, 'Item 2')
+        self.assertFalse([q for q in ctx if 'GROUP BY' in q['sql']
+                          or 'core_item' in q['sql']])
+
+    def test_json_listing_keeps_filters(self):
+        for n in range(4, 16):
+            make_item(n, catagory='ow')
+        data = self.client.get(reverse('core:api-items') + '?catagory=ow').json()
+        self.assertTrue(data['next'].startswith(
+            reverse('core:api-items') + '?catagory=ow&after='))
+        data = self.client.get(data['next']).json()
+        self.assertEqual([i['title'] for i in data['items']], ['Item 5', 'Item 4', 'Item 3'])
+
+
+class SearchTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shirt = make_item(1, title='Blue Shirt', description='Cotton, slim fit')
+        self.jacket = make_item(2, title='Denim Jacket', description='Goes with any blue shirt')
+        self.hat = make_item(3, title='Straw Hat', description='For the beach')
+
+    def titles(self, query):
+        return [item.title for item in search.search_items(query)[0]]
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.titles('shirt'), ['Blue Shirt', 'Denim Jacket'])
+        self.assertEqual(self.titles('blue shirts'), ['Blue Shirt', 'Denim Jacket'])
+
+    def test_prefix_and_all_words(self):
+        self.assertEqual(self.titles('sli'), ['Blue Shirt'])
+        self.assertEqual(self.titles('denim beach'), [])
+
+    def test_query_syntax_is_not_passed_through(self):
+        self.assertEqual(self.titles('"hat* OR'), [])
+        self.assertEqual(self.titles('straw) NEAR(hat'), [])
+        self.assertEqual(self.titles('"""'), [])
+        self.assertEqual(self.titles('straw "hat"'), ['Straw Hat'])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.hat.title = 'Panama Hat'
+        self.hat.save()
+        self.assertEqual(self.titles('straw'), [])
+        self.assertEqual(self.titles('panama'), ['Panama Hat'])
+        self.jacket.delete()
+        self.assertEqual(self.titles('shirt'), ['Blue Shirt'])
+
+    def test_rebuild_index(self):
+        Item.objects.bulk_create(
+            Item(title=f'Sandal {n}', image='sandal.jpg', price=10.0, effective_price=10.0,
+                 catagory='s', label='P', slug=f'sandal-{n}', description='')
+            for n in range(3))
+        self.assertEqual(self.titles('sandal'), [])
+        search.rebuild_index()
+        self.assertEqual(len(self.titles('sandal')), 3)
+
+    def test_pages(self):
+        for n in range(4, 16):
+            make_item(n, title=f'Shirt {n}')
+        items, has_next = search.search_items('shirt', page=1, per_page=10)
+        self.assertTrue(has_next)
+        more, has_next = search.search_items('shirt', page=2, per_page=10)
+        self.assertFalse(has_next)
+        self.assertEqual(len(items) + len(more), 14)
+        self.assertFalse({i.pk for i in items} & {i.pk for i in more})
+
+    def test_search_page_uses_the_index(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse('core:search') + '?q=jacket')
+        self.assertContains(response, 'Denim Jacket')
+        self.assertNotContains(response, 'Straw Hat')
+        sql = ' '.join(q['sql'] for q in ctx)
+        self.assertIn('MATCH', sql)
+        self.assertNotIn('LIKE', sql)
+
+    def test_search_page_links_next_page(self):
+        for n in range(4, 16):
+            make_item(n, title=f'Shirt {n}')
+        response = self.client.get(reverse('core:search') + '?q=shirt')
+        self.assertContains(response, '?q=shirt&amp;page=2')
+        self.assertEqual(
+            self.client.get(reverse('core:search') + '?q=shirt&page=x').status_code, 404)
+
+    def test_json_search(self):
+        data = self.client.get(reverse('core:api-search') + '?q=hat').json()
+        self.assertEqual([i['slug'] for i in data['items']], ['item-3'])
+        self.assertIsNone(data['next'])
@@ -1,20 +1,38 @@
 from django.urls import path
+from .api import (CartBatchView, CartCouponView, CartLineView, CartView,
+                  ItemListView, ItemSearchView)
+from .metrics import metrics_view
 from .views import (HomeView, ItemDetailView, add_to_cart, remove_from_cart,
-                    OrderSummaryView, remove_single_item_from_cart, CheckoutView, PaymentView, AddCoupon, RequestRefund)
+                    OrderSummaryView, remove_single_item_from_cart, CheckoutView, PaymentView, PaymentStatusView, AddCoupon,
+                    PayPalOrderView, RequestRefund, SearchView, image_variant)
 
 app_name = "core"
 
 urlpatterns = [
     path('', HomeView.as_view(), name="home"),
+    path('search/', SearchView.as_view(), name="search"),
     path('order-summary/', OrderSummaryView.as_view(), name="ordersummary"),
     path('checkout/', CheckoutView.as_view(), name="checkout"),
     path('payment/<payment_option>', PaymentView.as_view(), name="payment"),
-    path('product/<slug>/', ItemDetailView.as_view(), name='product'),
+    path('payment/status/<int:pk>/', PaymentStatusView.as_view(),
+         name="payment-status"),
+    path('payment/paypal/order/', PayPalOrderView.as_view(), name="paypal-order"),
+    path('product/<slug:slug>/', ItemDetailView.as_view(), name='product'),
     path('add-coupon/', AddCoupon.as_view(), name='add-coupon'),
     path('add_to_cart/<slug>/', add_to_cart, name='add_to_cart'),
     path('remove_from_cart/<slug>/', remove_from_cart, name='remove_from_cart'),
     path('remove_single_item_from_cart/<str:task>/<slug>/',
          remove_single_item_from_cart, name='remove_single_item_from_cart'),
     path('request-refund/', RequestRefund.as_view(), name='request-refund'),
+    path('api/items/', ItemListView.as_view(), name='api-items'),
+    path('api/search/', ItemSearchView.as_view(), name='api-search'),
+    path('api/cart/', CartView.as_view(), name='api-cart'),
+    path('api/cart/coupon/', CartCouponView.as_view(), name='api-cart-coupon'),
+    path('api/cart/batch/', CartBatchView.as_view(), name='api-cart-batch'),
+    path('api/cart/<slug:slug>/', CartLineView.as_view(), name='api-cart-line'),
+    path('metrics/', metrics_view, name='metrics'),
+    path('images/<int:pk>/<int:width>w.<ext>', image_variant, name='image'),
+    path('images/<int:pk>/<str:image_hash>-<int:width>w.<ext>', image_variant,
+         name='image-variant'),
 
 ]
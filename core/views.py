@@ -1,23 +1,47 @@
+from decimal import Decimal
+from functools import partial
+
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import FileResponse, Http404, JsonResponse
 from django.shortcuts import render, get_object_or_404, redirect
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
+from django.utils.http import urlencode
+from django.utils.safestring import mark_safe
+from .models import Item, Order, Address, Refund, PaymentJob
 from django.views.generic import ListView, DetailView, View
-from django.utils import timezone
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from .forms import CheckoutForm, CouponForm, RefundForm
-import random
-import string
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from .forms import CheckoutForm, CouponForm, RefundForm, ItemFilterForm, SORT_CHOICES
+from . import images, jobs, services
+from .coupons import CouponError
+from .gateways import PaymentError, get_gateway
+from .inventory import OutOfStock, reserve_stock
+from .cache import CATALOGUE_TIMEOUT, catalogue_key, invalidate_cart_item_count
+from .facets import facet_summary, filter_items
+from .pagination import KeysetPaginator
+from .search import search_items
+from .session_cart import CartFull, SessionCart
+
 
-# `source` is obtained with Stripe.js; see https://stripe.com/docs/payments/accept-a-payment-charges#web-create-token
+def filter_query(filters):
+    """Canonical query string for a set of cleaned listing filters."""
+    return urlencode(sorted(
+        # 25, 25.0 and 25.00 are the same filter
+        (name, f'{value.normalize():f}' if isinstance(value, Decimal) else value)
+        for name, value in filters.items()))
 
 
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+# KeysetPaginator field and direction for each listing sort
+SORT_ORDERS = {
+    'price': ('effective_price', False),
+    '-price': ('effective_price', True),
+}
 
 
 class HomeView(ListView):
@@ -25,13 +49,125 @@ class HomeView(ListView):
     paginate_by = 10
     template_name = "home-page.html"
 
+    def get_cursor(self):
+        cursor = {}
+        for name in ('after', 'before'):
+            value = self.request.GET.get(name)
+            if value is not None:
+                if not value.isdigit():
+                    raise Http404("Invalid page cursor")
+                cursor[name] = int(value)
+        return cursor
+
+    def get_filters(self):
+        # invalid values are dropped rather than failing the whole listing
+        form = ItemFilterForm(self.request.GET)
+        form.is_valid()
+        return {name: value for name, value in form.cleaned_data.items()
+                if value not in (None, '')}
+
+    def get_queryset(self):
+        return filter_items(super().get_queryset(), self.filters)
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        field, descending = SORT_ORDERS.get(self.filters.get('sort'), ('pk', True))
+        return KeysetPaginator(queryset, per_page, field, descending)
+
+    def paginate_queryset(self, queryset, page_size):
+        # keyset pages cost the same at any depth and need no COUNT(*)
+        paginator = self.get_paginator(queryset, page_size)
+        page = paginator.page(**self.cursor)
+        return paginator, page, page.object_list, page.has_other_pages
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['filter_query'] = filter_query(self.filters)
+        return context
+
+    def get_facet_links(self):
+        links = {}
+        for facet, entries in facet_summary().items():
+            keys = ('min_price', 'max_price') if facet == 'price' else (facet,)
+            others = {k: v for k, v in self.filters.items() if k not in keys}
+            links[facet] = [{
+                'name': name,
+                'count': count,
+                'query': filter_query({**others, **params}),
+                'active': all(self.filters.get(k) == params.get(k) for k in keys),
+            } for params, name, count in entries]
+        others = {k: v for k, v in self.filters.items() if k != 'sort'}
+        links['sort'] = [{
+            'name': name,
+            'query': filter_query({**others, 'sort': value}),
+            'active': self.filters.get('sort') == value,
+        } for value, name in SORT_CHOICES]
+        return links
+
+    def get(self, request, *args, **kwargs):
+        self.cursor = self.get_cursor()
+        self.filters = self.get_filters()
+        key = catalogue_key(
+            'home', filter_query(self.filters),
+            *(f'{name}={pk}' for name, pk in sorted(self.cursor.items())))
+        grid = cache.get(key)
+        if grid is None:
+            self.object_list = self.get_queryset()
+            grid = render_to_string('product_grid.html', self.get_context_data())
+            cache.set(key, grid, CATALOGUE_TIMEOUT)
+        # the nav badge and messages stay outside the cached markup
+        return render(request, self.template_name, {
+            'product_grid': mark_safe(grid),
+            'filters': self.filters,
+            'facets': self.get_facet_links(),
+            'all_catagories_query': filter_query(
+                {k: v for k, v in self.filters.items() if k != 'catagory'}),
+        })
+
+
+class SearchView(View):
+    paginate_by = 10
+    template_name = 'search.html'
+
+    def get_page(self):
+        page = self.request.GET.get('page', '1')
+        if not page.isdigit() or int(page) < 1:
+            raise Http404("Invalid page")
+        return int(page)
+
+    def search(self):
+        self.query = self.request.GET.get('q', '').strip()
+        self.page = self.get_page()
+        if not self.query:
+            return [], False
+        return search_items(self.query, self.page, self.paginate_by)
+
+    def page_query(self, page):
+        return urlencode({'q': self.query, 'page': page})
+
+    def get(self, *args, **kwargs):
+        items, has_next = self.search()
+        return render(self.request, self.template_name, {
+            'query': self.query,
+            'object_list': items,
+            'page': self.page,
+            'previous_query': self.page_query(self.page - 1) if self.page > 1 else None,
+            'next_query': self.page_query(self.page + 1) if has_next else None,
+        })
+
 
-class OrderSummaryView(View, LoginRequiredMixin):
+class OrderSummaryView(View):
     def get(self, *args, **kwargs):
+        if not self.request.user.is_authenticated:
+            cart = SessionCart(self.request.session)
+            return render(self.request, "order_summary.html", {
+                'object': cart,
+                'lines': cart.lines(),
+            })
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.get_cart(self.request.user)
             context = {
-                'object': order
+                'object': order,
+                'lines': order.items.all(),
             }
         except ObjectDoesNotExist:
             messages.error(self.request, 'You don\'t have an active order ')
@@ -44,104 +180,113 @@ class ItemDetailView(DetailView):
     model = Item
     template_name = "product-page.html"
 
+    def get(self, request, *args, **kwargs):
+        key = catalogue_key('item', kwargs['slug'])
+        detail = cache.get(key)
+        if detail is None:
+            self.object = self.get_object()
+            detail = render_to_string(
+                'product_detail.html', self.get_context_data(object=self.object))
+            cache.set(key, detail, CATALOGUE_TIMEOUT)
+        return render(request, self.template_name, {'product_detail': mark_safe(detail)})
+
+
+class PaymentView(LoginRequiredMixin, View):
+    # the form field each checkout page posts its payment token in
+    TOKEN_FIELDS = {
+        'stripe': 'stripeToken',
+        'paypal': 'paypalOrderID',
+    }
+
+    def dispatch(self, request, *args, **kwargs):
+        if kwargs['payment_option'] not in settings.PAYMENT_GATEWAYS:
+            messages.warning(request, 'Invalid payment Option')
+            return redirect('core:checkout')
+        return super().dispatch(request, *args, **kwargs)
 
-class PaymentView(View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        try:
+            order = Order.objects.get_cart(self.request.user)
+        except ObjectDoesNotExist:
+            messages.error(self.request, 'You don\'t have an active order ')
+            return redirect('/')
+        paypal = settings.PAYMENT_GATEWAYS.get('paypal', {})
         context = {
             'order': order,
+            'payment_option': kwargs['payment_option'],
+            'PAYPAL_CLIENT_ID': paypal.get('OPTIONS', {}).get('client_id'),
             'DISPLAY_COUPON_FORM': False
         }
         return render(self.request, 'payment.html', context)
 
     def post(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
-        token = self.request.POST.get('stripeToken')
-        amount = int(order.get_total_price()) * 77
-        print(amount)
+        payment_option = kwargs['payment_option']
         try:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency="inr",
-                source=token,
-                description="My First Test Charge (created for API docs)",
-            )
-            # payment set
-            payment = Payment()
-            payment.stripe_charge_id = charge['id']
-            payment.user = self.request.user
-            payment.amount = order.get_total_price()
-            payment.save()
-
-            # order set\
-            order_items = order.items.all()
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-            order.ordered = True
-            order.payment = payment
-            # TODO assign the ref code
-            ref_code = create_ref_code()
-            print(ref_code)
-            order.ref_code = ref_code
-            order.save()
-
-            messages.success(self.request, "order has succesfully done")
-            return redirect('/')
-
-        except stripe.error.CardError as e:
-            # Since it's a decline, stripe.error.CardError will be caught
-            messages.error(self.request, f"{e.error.message}")
-
-            print('Status is: %s' % e.http_status)
-            print('Type is: %s' % e.error.type)
-            print('Code is: %s' % e.error.code)
-            # param is '' in this case
-            print('Param is: %s' % e.error.param)
-            print('Message is: %s' % e.error.message)
-
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.error(self.request, f"{e.error.message}")
+            order = Order.objects.get_cart(self.request.user)
+        except ObjectDoesNotExist:
+            messages.error(self.request, 'You don\'t have an active order ')
             return redirect('/')
+        token = self.request.POST.get(
+            self.TOKEN_FIELDS.get(payment_option, 'token'))
+        if not token:
+            messages.warning(self.request, 'Failed Checkout')
+            return redirect('core:payment', payment_option=payment_option)
+        # the charge runs in the `process_payments` worker, not this request
+        try:
+            job = jobs.enqueue_payment(order, token, gateway=payment_option)
+        except OutOfStock as e:
+            messages.warning(self.request, e.message)
+            return redirect('core:ordersummary')
+        except CouponError as e:
+            Order.objects.filter(pk=order.pk).update(coupon=None)
+            messages.warning(
+                self.request, f'{e.message}, it was removed from your order')
+            return redirect('core:checkout')
+        except PaymentError as e:
+            messages.warning(self.request, e.message)
+            return redirect('core:payment', payment_option=payment_option)
+        return redirect('core:payment-status', pk=job.pk)
 
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            print(e)
-            messages.error(self.request, "Invalid Parameters")
-            return redirect('/')
 
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.error(self.request, "Not authenticated")
-            return redirect('/')
+class PayPalOrderView(LoginRequiredMixin, View):
+    """Creates the PayPal order the buyer approves, for the cart's total as
+    priced here rather than by the browser.
+    """
 
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.error(self.request, "Network Error")
-            return redirect('/')
+    def post(self, *args, **kwargs):
+        if 'paypal' not in settings.PAYMENT_GATEWAYS:
+            raise Http404
+        order = get_object_or_404(Order.objects.with_totals(),
+                                  user=self.request.user, ordered=False)
+        try:
+            paypal_order = get_gateway('paypal').create_order(
+                order.get_total_price(), description=f"Order {order.pk}")
+        except PaymentError as e:
+            return JsonResponse({'error': e.message}, status=502)
+        return JsonResponse({'id': paypal_order})
 
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send
-            # yourself an email
-            messages.error(
-                self.request, "Something went wrong please try again.")
-            return redirect('/')
 
-        except Exception as e:
-            # send an email to ourselves
-            print(e)
-            messages.error(
-                self.request, "A serious error occurred, we have been notified")
+class PaymentStatusView(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        job = get_object_or_404(
+            PaymentJob, pk=kwargs['pk'], user=self.request.user)
+        if job.status == PaymentJob.SUCCEEDED:
+            # the worker finalized the order, but only cleared the count in
+            # its own cache if the backend isn't shared
+            invalidate_cart_item_count(self.request.user)
+            messages.success(self.request, "order has succesfully done")
             return redirect('/')
+        if job.status == PaymentJob.FAILED:
+            messages.error(self.request, job.error)
+            return redirect('core:payment', payment_option=job.gateway)
+        return render(self.request, 'payment_pending.html', {'job': job})
 
 
-class CheckoutView(View):
+class CheckoutView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         # forms
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.get_cart(self.request.user)
             form = CheckoutForm()
             context = {
                 'form': form,
@@ -160,10 +305,14 @@ class CheckoutView(View):
         }
         return render(self.request, 'checkout.html', context)
 
+    @method_decorator(transaction.atomic)
     def post(self, *args, **kwargs):
         form = CheckoutForm(self.request.POST or None)
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            # locked, so a payment finishing meanwhile isn't written over
+            order = services.get_cart_for_update(self.request.user, create=False)
+            if order is None:
+                raise Order.DoesNotExist
             if form.is_valid():
                 street_address = form.cleaned_data.get('street_address')
                 appertment_address = form.cleaned_data.get(
@@ -181,7 +330,13 @@ class CheckoutView(View):
                 billing_address.save()
                 order.billing_address = billing_address
                 order.shipping_address = billing_address
-                order.save()
+                order.save(update_fields=['billing_address', 'shipping_address'])
+                # hold the stock while the customer pays
+                try:
+                    reserve_stock(order)
+                except OutOfStock as e:
+                    messages.warning(self.request, e.message)
+                    return redirect('core:ordersummary')
                 if payment_options == 'S':
                     return redirect('core:payment', payment_option='stripe')
                 elif payment_options == 'P':
@@ -192,122 +347,89 @@ class CheckoutView(View):
 
             messages.warning(self.request, 'Failed Checkout')
             return redirect('core:checkout')
+        except services.CartLocked as e:
+            messages.warning(self.request, e.message)
+            return redirect('core:ordersummary')
         except ObjectDoesNotExist:
-            messages.error('You don\'t have an active order ')
+            messages.error(self.request, 'You don\'t have an active order ')
             return redirect('core:checkout')
 
 
-@login_required
 def add_to_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-    order_item, create = OrderItem.objects.get_or_create(
-        item=item, user=request.user, ordered=False)
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(
-                request, "This item quantity was updated to your cart")
+    try:
+        if request.user.is_authenticated:
+            created = services.add_to_cart(request.user, item)
         else:
-            order.items.add(order_item)
-            messages.info(request, "This item was added to your cart")
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
+            created = SessionCart(request.session).add(item)
+    except (services.CartLocked, CartFull) as e:
+        messages.warning(request, e.message)
+        return redirect("core:product", slug=slug)
+    if created:
         messages.info(request, "This item was added to your cart")
-
+    else:
+        messages.info(request, "This item quantity was updated to your cart")
     return redirect("core:product", slug=slug)
 
 
-@login_required
 def remove_from_cart(request, slug):
     item = get_object_or_404(Item, slug=slug)
-
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False)[0]
-            order.items.remove(order_item)
-            messages.info(request, "This item was removed from your cart")
+    try:
+        if request.user.is_authenticated:
+            removed = services.remove_from_cart(request.user, item)
         else:
-            messages.info(request, "This item was not in your cart")
-            return redirect("core:product", slug=slug)
-    else:
-        messages.info(request, "You do not have any active order")
+            removed = SessionCart(request.session).remove(item)
+    except services.CartLocked as e:
+        messages.warning(request, e.message)
         return redirect("core:product", slug=slug)
+    if removed:
+        messages.info(request, "This item was removed from your cart")
+    else:
+        messages.info(request, "This item was not in your cart")
     return redirect("core:product", slug=slug)
 
 
-@login_required
 def remove_single_item_from_cart(request, task, slug):
     item = get_object_or_404(Item, slug=slug)
-
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderItem.objects.filter(
-                item=item, user=request.user, ordered=False)[0]
-            if task == 'add':
-                order_item.quantity += 1
-                order_item.save()
-                messages.info(
-                    request, "This item quantity was updated to your cart")
-                return redirect("core:ordersummary")
-            else:
-                if order_item.quantity > 0:
-                    order_item.quantity -= 1
-                    order_item.save()
-                    messages.info(
-                        request, "This item quantity was updated to your cart")
-                    return redirect("core:ordersummary")
-                else:
-                    messages.info(
-                        request, "You have no item to remove.")
-                    return redirect("core:ordersummary")
-
+    if request.user.is_authenticated:
+        change_quantity = partial(services.change_quantity, request.user, item)
+    else:
+        change_quantity = partial(SessionCart(request.session).change_quantity, item)
+    try:
+        changed = change_quantity(1 if task == 'add' else -1)
+    except services.CartLocked as e:
+        messages.warning(request, e.message)
+        return redirect("core:ordersummary")
+    if task == 'add':
+        if changed:
+            messages.info(
+                request, "This item quantity was updated to your cart")
         else:
             messages.info(request, "This item was not in your cart")
-            return redirect("core:ordersummary")
     else:
-        messages.info(request, "You do not have any active order")
-        return redirect("core:ordersummary")
+        if changed:
+            messages.info(
+                request, "This item quantity was updated to your cart")
+        else:
+            messages.info(request, "You have no item to remove.")
     return redirect("core:ordersummary")
 
 
-def get_coupon(request, code):
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except ObjectDoesNotExist:
-        messages.info(request, "This is not a valid coupon")
-        return redirect("core:checkout")
-
-
-class AddCoupon(View):
+class AddCoupon(LoginRequiredMixin, View):
     def post(self, *args, **kwargs):
         form = CouponForm(self.request.POST or None)
         if form.is_valid():
+            code = form.cleaned_data.get('code')
             try:
-                code = form.cleaned_data.get('code')
-                order = Order.objects.get(
-                    user=self.request.user, ordered=False)
-                order.coupon = get_coupon(self.request, code)
-                order.save()
-                messages.success(self.request, "successully added coupon")
-                return redirect("core:checkout")
-            except ObjectDoesNotExist:
-                messages.info(self.request, "You do not have any active order")
-                return redirect("core:checkout")
+                coupon = services.apply_coupon(self.request.user, code)
+            except (CouponError, services.CartLocked) as e:
+                messages.info(self.request, e.message)
+            else:
+                if coupon is None:
+                    messages.info(self.request, "This is not a valid coupon")
+                else:
+                    messages.success(self.request, "successully added coupon")
+        return redirect("core:checkout")
 
 
 class RequestRefund(View):
@@ -343,3 +465,34 @@ class RequestRefund(View):
         else:
             messages.info(self.request, 'given information is wrong')
             return redirect('core:request-refund')
+
+
+# a year, the longest caches are asked to keep anything
+VARIANT_MAX_AGE = 365 * 24 * 60 * 60
+# how long a browser may keep following an unhashed or stale image URL
+VARIANT_REDIRECT_MAX_AGE = 60 * 60
+
+
+def image_variant(request, pk, width, ext, image_hash=''):
+    """An item's image at one of the rendition widths, made on first use.
+    The hashed URLs never change what they serve; any other is redirected
+    to the current one.
+    """
+    if width not in images.VARIANT_WIDTHS or ext not in images.FORMATS:
+        raise Http404
+    item = get_object_or_404(Item.objects.only('image', 'image_hash'), pk=pk)
+    if not item.image:
+        raise Http404
+    name = None
+    if image_hash == item.image_hash or not item.image_hash:
+        try:
+            name = images.get_variant(item, width, ext)
+        except images.ImageError:
+            raise Http404
+    if image_hash != item.image_hash:
+        response = redirect(images.variant_url(item, width, ext))
+        patch_cache_control(response, public=True, max_age=VARIANT_REDIRECT_MAX_AGE)
+        return response
+    response = FileResponse(default_storage.open(name), content_type=images.CONTENT_TYPES[ext])
+    patch_cache_control(response, public=True, max_age=VARIANT_MAX_AGE, immutable=True)
+    return response
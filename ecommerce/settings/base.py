@@ -29,6 +29,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
 
+    'core.metrics.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -44,7 +45,8 @@ ROOT_URLCONF = 'ecommerce.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the stock backend, timing renders for the request metrics
+        'BACKEND': 'core.metrics.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -63,6 +65,48 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'ecommerce.wsgi.application'
 
+# falls back to an in-process cache when no shared backend is configured
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND',
+                          default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='ecommerce'),
+    }
+}
+
+# anonymous carts live in the session, so signed cookies keep browsing from
+# writing to the database
+SESSION_ENGINE = config('SESSION_ENGINE',
+                        default='django.contrib.sessions.backends.signed_cookies')
+
+# request instrumentation, see core.metrics: requests running more queries
+# than their view's budget are logged as warnings
+QUERY_BUDGET = config('QUERY_BUDGET', default=30, cast=int)
+VIEW_QUERY_BUDGETS = {
+    'core:home': 10,
+    'core:search': 10,
+    'core:api-items': 10,
+    'core:api-cart': 10,
+}
+# bearer token for scraping /metrics/, staff only without one
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        # INFO logs every request, WARNING only the ones over budget
+        'core.metrics': {
+            'handlers': ['console'],
+            'level': config('METRICS_LOG_LEVEL', default='WARNING'),
+            'propagate': False,
+        },
+    },
+}
+
 LANGUAGE_CODE = 'en-us'
 
 TIME_ZONE = 'UTC'
@@ -97,3 +141,28 @@ LOGIN_REDIRECT_URL = "/"
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
+# payment processors, keyed by the checkout `payment_option`
+STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY')
+PAYMENT_GATEWAYS = {
+    'stripe': {
+        'BACKEND': 'core.gateways.StripeGateway',
+        'OPTIONS': {
+            'api_key': STRIPE_SECRET_KEY,
+            'timeout': 10,
+            'max_retries': 2,
+        },
+    },
+    'paypal': {
+        'BACKEND': 'core.gateways.PayPalGateway',
+        'OPTIONS': {
+            'client_id': config('PAYPAL_CLIENT_ID', default=''),
+            'secret': config('PAYPAL_SECRET', default=''),
+            'mode': config('PAYPAL_MODE', default='sandbox'),
+            # the JS SDK is loaded for the same currency, see payment.html
+            'currency': 'USD',
+            'timeout': 10,
+            'max_retries': 2,
+        },
+    },
+}
@@ -44,7 +44,9 @@ DEBUG_TOOLBAR_PANELS = [
 
 
 def show_toolbar(request):
-    return True
+    # the test runner forces DEBUG off and doesn't route the toolbar urls
+    from django.conf import settings
+    return settings.DEBUG
 
 
 DEBUG_TOOLBAR_CONFIG = {
@@ -52,4 +54,9 @@ DEBUG_TOOLBAR_CONFIG = {
     'SHOW_TOOLBAR_CALLBACK': show_toolbar
 }
 
-STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY')
+# route every payment option through the in-process fake gateway, e.g. to
+# benchmark checkout offline
+if config('FAKE_PAYMENTS', default=False, cast=bool):
+    for gateway in PAYMENT_GATEWAYS.values():
+        gateway['BACKEND'] = 'core.gateways.FakeGateway'
+        gateway['OPTIONS'] = {}
@@ -21,5 +21,4 @@ DATABASES = {
         'HOST': config('DB_HOST'),
         'PORT': ''
     }
-}
-STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY')
+}
\ No newline at end of file